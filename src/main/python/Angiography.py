@@ -0,0 +1,150 @@
+import time
+import numpy as np
+
+METRIC_DECORRELATION = "decorrelation"  # 1 - mean normalized correlation of the amplitudes of consecutive repeats
+METRIC_SPECKLE_VARIANCE = "speckle_variance"  # Variance of the amplitude across repeats
+METRIC_COMPLEX_DIFFERENCE = "complex_difference"  # Mean magnitude of the difference of consecutive complex repeats
+METRICS = [METRIC_DECORRELATION, METRIC_SPECKLE_VARIANCE, METRIC_COMPLEX_DIFFERENCE]
+
+EPSILON = 1e-12  # Keeps decorrelation finite where there is no signal
+
+
+class AngiographyAccumulator:
+    """
+    OCT angiography over repeated B-scans, computed as the repeats arrive. Each repeat of every B-line location is added
+    with add; only the previous repeat and running sums are kept, so memory does not grow with the number of repeats.
+    All arithmetic is vectorized over the whole batch of locations and done in preallocated buffers.
+    """
+
+    def __init__(self, shape, repeats, metric=METRIC_DECORRELATION):
+        """
+        :param shape: Shape of the angiogram, (z, A-lines, B-line locations)
+        :param repeats: Number of times each B-line is repeated. At least 2
+        :param metric: One of METRICS
+        """
+        if metric not in METRICS:
+            raise ValueError('Unknown angiography metric ' + str(metric))
+        if repeats < 2:
+            raise ValueError('Angiography requires at least 2 repeats, got ' + str(repeats))
+        self.shape = list(shape)
+        self.repeats = int(repeats)
+        self.metric = metric
+        self._added = 0  # Repeats added since the last reset
+
+        self._amp = np.empty(shape, dtype=np.float32)  # Amplitude of the repeat being added
+        self._tmp = np.empty(shape, dtype=np.float32)
+        self._sum = np.zeros(shape, dtype=np.float32)  # Running sum of the metric's per-repeat or per-pair term
+        if metric == METRIC_DECORRELATION:
+            self._prev = np.empty(shape, dtype=np.float32)  # Amplitude of the previous repeat
+            self._prev_power = np.empty(shape, dtype=np.float32)
+            self._power = np.empty(shape, dtype=np.float32)
+        elif metric == METRIC_SPECKLE_VARIANCE:
+            self._sum_power = np.zeros(shape, dtype=np.float32)  # Running sum of the squared amplitude
+        else:
+            self._prev = np.empty(shape, dtype=np.complex64)  # Previous complex repeat
+            self._diff = np.empty(shape, dtype=np.complex64)
+
+    def reset(self):
+        self._added = 0
+        self._sum[:] = 0
+        if self.metric == METRIC_SPECKLE_VARIANCE:
+            self._sum_power[:] = 0
+
+    def get_added(self):
+        return self._added
+
+    def add(self, repeat):
+        """
+        Adds the next repeat of every location
+        :param repeat: Complex array of the angiogram's shape. May be a strided view
+        """
+        if self.metric == METRIC_DECORRELATION:
+            np.abs(repeat, out=self._amp)
+            np.square(self._amp, out=self._power)
+            if self._added > 0:
+                # A1 * A2 / ((A1^2 + A2^2) / 2), summed over consecutive pairs
+                np.multiply(self._prev, self._amp, out=self._tmp)
+                self._tmp *= 2
+                np.add(self._prev_power, self._power, out=self._prev_power)
+                self._prev_power += EPSILON
+                self._tmp /= self._prev_power
+                self._sum += self._tmp
+            self._prev, self._amp = self._amp, self._prev
+            self._prev_power, self._power = self._power, self._prev_power
+        elif self.metric == METRIC_SPECKLE_VARIANCE:
+            np.abs(repeat, out=self._amp)
+            self._sum += self._amp
+            np.square(self._amp, out=self._tmp)
+            self._sum_power += self._tmp
+        else:
+            if self._added > 0:
+                np.subtract(repeat, self._prev, out=self._diff)
+                np.abs(self._diff, out=self._tmp)
+                self._sum += self._tmp
+            np.copyto(self._prev, repeat)
+        self._added += 1
+
+    def result(self, out=None):
+        """
+        :param out: float32 array of the angiogram's shape to write to. Allocated if None
+        :return: The angiogram of the repeats added since the last reset
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+        n = max(self._added, 1)
+        pairs = max(self._added - 1, 1)
+        if self.metric == METRIC_DECORRELATION:
+            np.multiply(self._sum, -1 / pairs, out=out)
+            out += 1
+        elif self.metric == METRIC_SPECKLE_VARIANCE:
+            np.multiply(self._sum, 1 / n, out=self._tmp)
+            np.square(self._tmp, out=self._tmp)
+            np.multiply(self._sum_power, 1 / n, out=out)
+            out -= self._tmp
+            np.maximum(out, 0, out=out)  # Rounding can leave tiny negative variances
+        else:
+            np.multiply(self._sum, 1 / pairs, out=out)
+        return out
+
+    def process(self, volume, out=None):
+        """
+        Computes the angiogram of a volume whose repeats of each B-line are consecutive
+        :param volume: Complex volume, (z, A-lines, B-line locations * repeats)
+        :param out: float32 array of the angiogram's shape to write to. Allocated if None
+        :return: The angiogram, (z, A-lines, B-line locations)
+        """
+        repeats = np.reshape(volume, [self.shape[0], self.shape[1], self.shape[2], self.repeats])
+        self.reset()
+        for r in range(self.repeats):
+            self.add(repeats[:, :, :, r])
+        return self.result(out)
+
+
+if __name__ == "__main__":
+
+    # Check each metric against a direct computation over all repeats, then time a volume of each
+
+    Z, ALINES, BLINES, REPEATS = 400, 256, 64, 4
+
+    rng = np.random.default_rng(0)
+    volume = (rng.standard_normal((Z, ALINES, BLINES * REPEATS)) +
+              1j * rng.standard_normal((Z, ALINES, BLINES * REPEATS))).astype(np.complex64)
+    stacked = volume.reshape(Z, ALINES, BLINES, REPEATS).astype(np.complex128)
+    amp = np.abs(stacked)
+    expected = {
+        METRIC_DECORRELATION: 1 - np.mean(amp[..., :-1] * amp[..., 1:] /
+                                          (0.5 * (amp[..., :-1] ** 2 + amp[..., 1:] ** 2) + EPSILON), axis=-1),
+        METRIC_SPECKLE_VARIANCE: np.var(amp, axis=-1),
+        METRIC_COMPLEX_DIFFERENCE: np.mean(np.abs(np.diff(stacked, axis=-1)), axis=-1)
+    }
+    out = np.empty([Z, ALINES, BLINES], dtype=np.float32)
+    for metric in METRICS:
+        accumulator = AngiographyAccumulator([Z, ALINES, BLINES], REPEATS, metric)
+        accumulator.process(volume, out=out)
+        error = np.max(np.abs(out - expected[metric])) / np.max(np.abs(expected[metric]))
+        t0 = time.perf_counter()
+        for i in range(5):
+            accumulator.process(volume, out=out)
+        elapsed = (time.perf_counter() - t0) / 5
+        print(metric + ':', '%.1f' % (elapsed * 1000), 'ms per volume of', BLINES * REPEATS, 'B-scans,',
+              'relative error %.1e' % error)
@@ -0,0 +1,143 @@
+import time
+import numpy as np
+
+from Angiography import AngiographyAccumulator
+from Averaging import RepeatAverager
+from Projection import SlabProjector
+
+
+class VolumeAssembler:
+    """
+    Assembles the volumes published by the controller from cropped B-lines as they are acquired. Each B-line is copied
+    into its column of the volume and projected en face, or, if the repeats are averaged, added to the average of its
+    location. Each group of B-line repeats is reduced to its averaged column and its angiogram as soon as its last
+    repeat arrives, so nothing is buffered beyond one B-scan of scratch per accumulator.
+    """
+
+    def __init__(self, z, alines, blines, a_repeat=1, b_repeat=1, averaging=None, angiography=None, slabs=None):
+        """
+        :param z: Depth of the cropped B-lines
+        :param alines: A-lines per B-line, including repeats
+        :param blines: B-lines per volume, including repeats
+        :param a_repeat: Number of consecutive acquisitions of each A-line
+        :param b_repeat: Number of consecutive acquisitions of each B-line
+        :param averaging: One of Averaging.AVERAGING_MODES the repeats are averaged with, or None to keep them all
+        :param angiography: One of Angiography.METRICS computed over the B-line repeats, or None
+        :param slabs: [start, stop] depths, relative to the crop, of the en face projections, or None
+        """
+        self.z = int(z)
+        self.alines = int(alines)
+        self.blines = int(blines)
+        self.a_repeat = int(a_repeat or 1)
+        self.b_repeat = int(b_repeat or 1)
+        self.shape = [self.z, self.alines, self.blines]  # Shape of the volume
+        self.angio_shape = None  # Shape of the angiogram, or None if there is none
+        self.projection_shape = None  # Shape of the projections, or None if there are none
+
+        self._averager = None  # RepeatAverager of the B-line location being acquired
+        if averaging is not None and self.a_repeat * self.b_repeat > 1:
+            self.shape = [self.z, self.alines // self.a_repeat, self.blines // self.b_repeat]
+            self._averager = RepeatAverager(self.shape[1::-1], self.a_repeat, self.b_repeat, averaging)
+        self._angiography = None  # AngiographyAccumulator of the B-line location being acquired
+        if angiography is not None and self.b_repeat > 1:
+            self.angio_shape = [self.z, self.alines, self.blines // self.b_repeat]
+            self._angiography = AngiographyAccumulator([self.alines, self.z], self.b_repeat, angiography)
+        self._projector = None
+        if slabs:
+            self._projector = SlabProjector(slabs, self.shape[1], self.shape[2])
+            self.projection_shape = self._projector.shape
+
+    def add_blines(self, lines, first, volume, angio=None, projection=None):
+        """
+        Adds consecutive B-lines, as acquired, to the volume and its angiogram and projections
+        :param lines: Complex cropped B-lines, (n, A-lines, z). May be a strided view of an acquisition buffer
+        :param first: Index of the first B-line in the volume, counting repeats
+        :param volume: complex64 array of shape the B-lines, or their averages, are written to
+        :param angio: float32 array of angio_shape, or None if there is no angiogram
+        :param projection: float32 array of projection_shape, or None if there are no projections
+        """
+        n = len(lines)
+        if self._averager is None:
+            np.copyto(volume[:, :, first:first + n], np.transpose(lines, (2, 1, 0)))
+            if self._projector is not None:
+                self._projector.project_blines(lines, projection, first)
+        if self._averager is None and self._angiography is None:
+            return
+        for i in range(n):
+            location, r = divmod(first + i, self.b_repeat)
+            if r == 0:
+                if self._averager is not None:
+                    self._averager.reset()
+                if self._angiography is not None:
+                    self._angiography.reset()
+            if self._averager is not None:
+                repeats = lines[i].reshape(self.shape[1], self.a_repeat, self.z)
+                for ra in range(self.a_repeat):
+                    self._averager.add(repeats[:, ra])
+            if self._angiography is not None:
+                self._angiography.add(lines[i])
+            if r == self.b_repeat - 1:  # The location's last repeat
+                if self._averager is not None:
+                    column = self._averager.result(out=volume[:, :, location].T)
+                    if self._projector is not None:
+                        self._projector.project_blines(column[np.newaxis], projection, location)
+                if self._angiography is not None:
+                    self._angiography.result(out=angio[:, :, location].T)
+
+
+if __name__ == "__main__":
+
+    # Compare B-line by B-line assembly with processing the whole volume after the fact, then time both
+
+    from Angiography import METRICS
+    from Averaging import AVERAGING_MODES
+    from Projection import PROJECTION_MAX
+
+    Z, ALINES, BLINES, REPEATS = 400, 256, 64, 4
+    SLABS = [[0, 400], [100, 200]]
+
+    rng = np.random.default_rng(0)
+    lines = (rng.standard_normal((BLINES * REPEATS, ALINES, Z)) +
+             1j * rng.standard_normal((BLINES * REPEATS, ALINES, Z))).astype(np.complex64)
+    volume = np.empty([Z, ALINES, BLINES * REPEATS], dtype=np.complex64)
+    for metric in METRICS:
+        assembler = VolumeAssembler(Z, ALINES, BLINES * REPEATS, b_repeat=REPEATS, angiography=metric, slabs=SLABS)
+        angio = np.empty(assembler.angio_shape, dtype=np.float32)
+        projection = np.empty(assembler.projection_shape, dtype=np.float32)
+        t0 = time.perf_counter()
+        for j in range(len(lines)):
+            assembler.add_blines(lines[j:j + 1], j, volume, angio, projection)
+        t_blines = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        expected = np.ascontiguousarray(lines.transpose(2, 1, 0))
+        expected_angio = AngiographyAccumulator(assembler.angio_shape, REPEATS, metric).process(expected)
+        expected_projection = SlabProjector(SLABS, ALINES, BLINES * REPEATS).project(expected)
+        t_volume = time.perf_counter() - t0
+
+        error = np.max(np.abs(angio - expected_angio)) / np.max(np.abs(expected_angio))
+        print(metric + ': %.2f ms per B-line as they arrive, %.1f ms for the whole volume after the fact,' %
+              (t_blines * 1000 / len(lines), t_volume * 1000), 'volume equal', np.array_equal(volume, expected),
+              'angiogram relative error %.1e,' % error, 'MIP equal',
+              np.array_equal(projection[:, PROJECTION_MAX], expected_projection[:, PROJECTION_MAX]))
+
+    A_REPEAT = 2
+    averaged = np.empty([Z, ALINES // A_REPEAT, BLINES], dtype=np.complex64)
+    for mode in AVERAGING_MODES:
+        assembler = VolumeAssembler(Z, ALINES, BLINES * REPEATS, A_REPEAT, REPEATS, mode, slabs=SLABS)
+        projection = np.empty(assembler.projection_shape, dtype=np.float32)
+        t0 = time.perf_counter()
+        for j in range(len(lines)):
+            assembler.add_blines(lines[j:j + 1], j, averaged, projection=projection)
+        t_blines = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        expected = RepeatAverager([Z, ALINES // A_REPEAT, BLINES], A_REPEAT, REPEATS, mode).average(
+            np.ascontiguousarray(lines.transpose(2, 1, 0)))
+        expected_projection = SlabProjector(SLABS, ALINES // A_REPEAT, BLINES).project(expected)
+        t_volume = time.perf_counter() - t0
+
+        error = np.max(np.abs(averaged - expected)) / np.max(np.abs(expected))
+        print(mode + ' averaging: %.2f ms per B-line as they arrive, %.1f ms for the whole volume after the fact,' %
+              (t_blines * 1000 / len(lines), t_volume * 1000), 'average relative error %.1e,' % error, 'MIP equal',
+              np.allclose(projection[:, PROJECTION_MAX], expected_projection[:, PROJECTION_MAX]))
@@ -0,0 +1,105 @@
+import time
+import numpy as np
+
+AVERAGING_MAGNITUDE = "magnitude"  # Mean of the magnitudes of the repeats. Insensitive to phase noise between repeats
+AVERAGING_COMPLEX = "complex"  # Mean of the complex repeats. Requires phase stable repeats
+AVERAGING_MODES = [AVERAGING_MAGNITUDE, AVERAGING_COMPLEX]
+
+
+class RepeatAverager:
+    """
+    Averages repeated A-lines and B-lines as they arrive. Each repeat is added to a running sum held in a preallocated
+    buffer the size of one repeat, so the repeats need not be kept once added. VolumeAssembler averages each B-line
+    location this way, holding no more than one B-scan of sums.
+    """
+
+    def __init__(self, shape, a_repeat=1, b_repeat=1, mode=AVERAGING_MAGNITUDE):
+        """
+        :param shape: Shape of the averaged volume, (z, A-line locations, B-line locations)
+        :param a_repeat: Number of consecutive repeats of each A-line
+        :param b_repeat: Number of consecutive repeats of each B-line
+        :param mode: One of AVERAGING_MODES
+        """
+        if mode not in AVERAGING_MODES:
+            raise ValueError('Unknown averaging mode ' + str(mode))
+        self.shape = list(shape)
+        self.a_repeat = int(a_repeat)
+        self.b_repeat = int(b_repeat)
+        self.mode = mode
+        self._added = 0  # Repeats added since the last reset
+        if mode == AVERAGING_MAGNITUDE:
+            self._sum = np.zeros(shape, dtype=np.float32)
+            self._magnitude = np.empty(shape, dtype=np.float32)
+        else:
+            self._sum = np.zeros(shape, dtype=np.complex64)
+
+    def reset(self):
+        self._added = 0
+        self._sum[:] = 0
+
+    def get_added(self):
+        return self._added
+
+    def add(self, repeat):
+        """
+        Adds the next repeat of every location
+        :param repeat: Complex array of the averaged volume's shape. May be a strided view
+        """
+        if self.mode == AVERAGING_MAGNITUDE:
+            np.abs(repeat, out=self._magnitude)
+            self._sum += self._magnitude
+        else:
+            self._sum += repeat
+        self._added += 1
+
+    def result(self, out=None):
+        """
+        :param out: complex64 array of the averaged volume's shape to write to. Allocated if None
+        :return: The mean of the repeats added since the last reset. Magnitude averages have no imaginary part
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=np.complex64)
+        np.multiply(self._sum, 1 / max(self._added, 1), out=out)
+        return out
+
+    def average(self, volume, out=None):
+        """
+        Averages a volume whose repeats of each A-line and of each B-line are consecutive
+        :param volume: Complex volume, (z, A-line locations * a_repeat, B-line locations * b_repeat)
+        :param out: complex64 array of the averaged volume's shape to write to. Allocated if None
+        :return: The averaged volume, (z, A-line locations, B-line locations)
+        """
+        repeats = np.reshape(volume, [self.shape[0], self.shape[1], self.a_repeat, self.shape[2], self.b_repeat])
+        self.reset()
+        for rb in range(self.b_repeat):
+            for ra in range(self.a_repeat):
+                self.add(repeats[:, :, ra, :, rb])
+        return self.result(out)
+
+
+if __name__ == "__main__":
+
+    # Compare with averaging a stack of all repeats after the fact
+
+    Z, ALINES, BLINES = 400, 128, 64
+    REPEATS = 3
+
+    rng = np.random.default_rng(0)
+    for a_repeat, b_repeat in [[1, REPEATS], [REPEATS, 1], [2, 2]]:
+        volume = (rng.standard_normal((Z, ALINES * a_repeat, BLINES * b_repeat)) +
+                  1j * rng.standard_normal((Z, ALINES * a_repeat, BLINES * b_repeat))).astype(np.complex64)
+        out = np.empty([Z, ALINES, BLINES], dtype=np.complex64)
+        for mode in AVERAGING_MODES:
+            averager = RepeatAverager([Z, ALINES, BLINES], a_repeat, b_repeat, mode)
+            t0 = time.perf_counter()
+            averager.average(volume, out=out)
+            t_stream = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            stacked = volume.reshape(Z, ALINES, a_repeat, BLINES, b_repeat)
+            if mode == AVERAGING_MAGNITUDE:
+                stacked = np.abs(stacked)
+            expected = stacked.mean(axis=(2, 4))
+            t_stack = time.perf_counter() - t0
+            error = np.max(np.abs(out - expected)) / np.max(np.abs(expected))
+            print('A-repeat', a_repeat, 'B-repeat', b_repeat, mode + ': running sum', '%.1f' % (t_stream * 1000),
+                  'ms, stacked mean', '%.1f' % (t_stack * 1000), 'ms, relative error %.1e' % error)
@@ -0,0 +1,186 @@
+"""
+Chunked, indexed recording container. A recording saved to path consists of
+
+    path_header.json  Layout, sample format and acquisition parameters of the recording
+    path_index.bin    One INDEX_DTYPE record per volume, appended as each volume is written
+    path_000.dat...   Chunk files holding the volumes back to back
+
+Each volume is stored B-line major, (B-lines, A-lines, z), so that a single B-scan is one contiguous run of bytes.
+Volume k is found by reading record k of the index, so any volume or B-scan is located without reading the rest of
+the recording.
+"""
+import os
+import json
+import numpy as np
+
+CONTAINER_TYPE = ".oct"  # WriterConfig.type which selects the container
+CONTAINER_VERSION = 1
+ZPAD = 3
+
+INDEX_DTYPE = np.dtype([
+    ("frame", "<i8"),  # Number of the volume in the recording
+    ("timestamp", "<f8"),  # Time the volume was handed to the writer in seconds since the epoch
+    ("file", "<i4"),  # Number of the chunk file holding the volume
+    ("offset", "<i8"),  # Offset of the volume in the chunk file in bytes
+    ("shape", "<i4", (3,))  # Shape of the volume, (z, A-lines, B-lines)
+])
+
+
+def header_path(path):
+    return path + "_header.json"
+
+
+def index_path(path):
+    return path + "_index.bin"
+
+
+def chunk_path(path, number):
+    return path + "_" + str(number).zfill(ZPAD) + ".dat"
+
+
+class ContainerWriter:
+    """
+    Writes volumes to a container recording. Chunk files are started when the next volume would take the open one past
+    max_bytes.
+    """
+
+    def __init__(self, path, max_bytes, dtype, metadata=None, params=None, bline_major=False):
+        """
+        :param path: Path of the recording, without extension
+        :param max_bytes: Size in bytes at which a new chunk file is started
+        :param dtype: dtype of the samples
+        :param metadata: Sample format of the volumes, as given by SampleEncoder.metadata
+        :param params: JSON-serializable acquisition parameters to embed in the header
+        :param bline_major: If True, the volumes written are already B-line major, (B-lines, A-lines, z), as raw
+        spectra are acquired, and are written as they are
+        """
+        self.path = path
+        self._max_bytes = max_bytes
+        self._dtype = np.dtype(dtype)
+        self._bline_major = bline_major
+        self._chunk = None  # Open chunk file
+        self._chunk_number = -1
+        self._chunk_bytes = 0  # Bytes written to the open chunk file
+        self._count = 0  # Volumes written to the recording
+        self._scratch = None  # Volume reordered B-line major
+        self._record = np.zeros(1, dtype=INDEX_DTYPE)
+        header = {
+            "version": CONTAINER_VERSION,
+            "layout": ["bline", "aline", "z"],
+            "dtype": self._dtype.str,
+            "max_bytes": int(max_bytes),
+            "index_dtype": np.lib.format.dtype_to_descr(INDEX_DTYPE),
+            "encoding": metadata,
+            "params": params
+        }
+        with open(header_path(path), 'w') as fp:
+            json.dump(header, fp)
+        self._index = open(index_path(path), 'wb')
+
+    def write(self, f, timestamp):
+        """
+        :param f: Array of volumes, (volumes, z, A-lines, B-lines), or (volumes, B-lines, A-lines, z) if bline_major
+        :param timestamp: Time f was acquired in seconds since the epoch
+        """
+        for volume in f:
+            if self._bline_major:
+                data = np.ascontiguousarray(volume, dtype=self._dtype)
+            else:
+                if self._scratch is None or self._scratch.shape != volume.shape[::-1]:
+                    self._scratch = np.empty(volume.shape[::-1], dtype=self._dtype)
+                np.copyto(self._scratch, volume.T)
+                data = self._scratch
+            if self._chunk is None or (self._chunk_bytes > 0 and self._chunk_bytes + data.nbytes > self._max_bytes):
+                self._next_chunk()
+            record = self._record[0]
+            record["frame"] = self._count
+            record["timestamp"] = timestamp
+            record["file"] = self._chunk_number
+            record["offset"] = self._chunk_bytes
+            record["shape"] = data.shape[::-1]
+            self._chunk.write(data.data)
+            self._chunk.flush()  # The index never points past the data on disk
+            self._index.write(self._record.tobytes())
+            self._index.flush()
+            self._chunk_bytes += data.nbytes
+            self._count += 1
+
+    def close(self):
+        if self._chunk is not None:
+            self._chunk.close()
+            self._chunk = None
+        self._index.close()
+
+    def _next_chunk(self):
+        if self._chunk is not None:
+            self._chunk.close()
+        self._chunk_number += 1
+        self._chunk_bytes = 0
+        path = chunk_path(self.path, self._chunk_number)
+        print("ContainerWriter: saving", path)
+        self._chunk = open(path, 'wb')
+
+
+class ContainerReader:
+    """
+    Random access to the volumes and B-scans of a container recording. Chunk files are memory mapped, so only the
+    bytes of the volumes and B-scans that are used are read from disk. Samples are returned as saved; decode them with
+    SampleEncoder.from_metadata(reader.encoding).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the recording as passed to ContainerWriter, or of its header
+        """
+        if path.endswith("_header.json"):
+            path = path[:-len("_header.json")]
+        self.path = path
+        with open(header_path(path), 'r') as fp:
+            self.header = json.load(fp)
+        self.dtype = np.dtype(self.header["dtype"])
+        self.encoding = self.header["encoding"]
+        self.params = self.header["params"]
+        self._chunks = {}  # Memory maps of the chunk files by number
+        self.index = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rereads the index, picking up volumes written since the reader was opened
+        """
+        records = os.path.getsize(index_path(self.path)) // INDEX_DTYPE.itemsize
+        self.index = np.fromfile(index_path(self.path), dtype=INDEX_DTYPE, count=records)
+        self._chunks = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def volume(self, k):
+        """
+        :return: Read-only view of volume k, (z, A-lines, B-lines)
+        """
+        record = self.index[k]
+        z, alines, blines = (int(n) for n in record["shape"])
+        chunk = self._chunk(int(record["file"]))
+        start = int(record["offset"]) // self.dtype.itemsize
+        return chunk[start:start + z * alines * blines].reshape(blines, alines, z).T
+
+    def bscan(self, k, j):
+        """
+        :return: Read-only view of B-scan j of volume k, (z, A-lines)
+        """
+        record = self.index[k]
+        z, alines, blines = (int(n) for n in record["shape"])
+        if not -blines <= j < blines:
+            raise IndexError('B-scan ' + str(j) + ' of volume with ' + str(blines) + ' B-lines')
+        chunk = self._chunk(int(record["file"]))
+        start = int(record["offset"]) // self.dtype.itemsize + (j % blines) * z * alines
+        return chunk[start:start + z * alines].reshape(alines, z).T
+
+    def timestamps(self):
+        return self.index["timestamp"]
+
+    def _chunk(self, number):
+        if number not in self._chunks:
+            self._chunks[number] = np.memmap(chunk_path(self.path, number), dtype=self.dtype, mode='r')
+        return self._chunks[number]
@@ -5,18 +5,31 @@ import pyqtgraph as pyqtgraph
 import sys  # We need sys so that we can pass argv to QApplication
 import os
 import time
-import nidaqmx
-from PyIMAQ import PyIMAQ
-from nidaqmx.stream_writers import AnalogMultiChannelWriter
-from nidaqmx.constants import LineGrouping, Edge, AcquisitionType, Signal
+try:
+    import nidaqmx
+    from nidaqmx.stream_writers import AnalogMultiChannelWriter
+    from nidaqmx.constants import LineGrouping, Edge, AcquisitionType, Signal
+except ImportError:  # Machines without the NI drivers can still use the simulated and replay backends
+    nidaqmx = None
+try:
+    from PyIMAQ import PyIMAQ
+except ImportError:
+    PyIMAQ = None
 from PyScanPattern.Patterns import Figure8ScanPattern, RasterScanPattern, LineScanPattern
 import numpy as np
-from queue import Empty, Full
+from queue import Empty, Full, Queue
 import multiprocessing as mp
 from dataclasses import dataclass
 import threading
 from NpyWriterProcess import *
 from SharedCircularBuffer import *
+from SimulatedHardware import SimulatedIMAQ, ReplayIMAQ, SimulatedScanTask
+from ProcessingPool import ProcessingPool
+from Processing import OCTProcessor, get_default_cache
+from Assembly import VolumeAssembler
+from Motion import PhaseCorrelator, DEFAULT_NPEAK
+from Projection import PROJECTION_MAX
+from Display import SliceRenderer
 
 # HardwareControlProcess messages
 VOID = 0  # Do nothing
@@ -34,6 +47,22 @@ STATUS_NOT_READY = -2  # No interface exists or interface failed to open
 STATUS_ACQUIRING = 1  # The interface is currently busy with a scan
 STATUS_EXITING = -1  # The process's lifetime has ended
 
+WRITER_TIMEOUT_SEC = 0.01  # Longest the controller waits for the writer to free a slot before a volume goes unsaved
+WRITER_CLOSE_TIMEOUT_SEC = 10  # Time the writers are given at exit to write what they were handed and close their files
+# Time the GUI gives the controller to exit: the processed and angiography writers close in turn, after the pipeline,
+# hardware interface and processing pool have stopped
+CLOSE_TIMEOUT_SEC = 2 * WRITER_CLOSE_TIMEOUT_SEC + 5
+RAW_DISPLAY_DECIMATION = 4  # While saving raw spectra, only every nth volume is processed for display
+ANGIOGRAPHY_SUFFIX = "_angio"  # Appended to the path of a recording to name its angiography channel
+MAX_SLABS = 4  # Most depth slabs projected en face by the controller
+BLINE_BUFFER_MAX = 16  # B-scans held by the ring which streams them as they are acquired
+ERROR_MESSAGE_MAX = 256  # Longest error message reported to the GUI, in bytes
+
+# NIOCTControlProcess backends
+BACKEND_NI = "ni"  # NI IMAQ camera and DAQmx scanner
+BACKEND_SIMULATED = "simulated"  # Synthetic spectrometer, no hardware required
+BACKEND_REPLAY = "replay"  # Streams previously saved raw spectra, no hardware required
+
 
 # -- Data structures ---------------------------------------------------------------------------------------------------
 
@@ -42,6 +71,20 @@ class SlotStruct:
     def get_slots(self):
         return self.__slots__
 
+    def to_dict(self):
+        """
+        :return: The slots as a JSON-serializable dict. Arrays are converted to lists
+        """
+        d = {}
+        for slot in self.__slots__:
+            value = getattr(self, slot)
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            elif isinstance(value, np.generic):
+                value = value.item()
+            d[slot] = value
+        return d
+
 
 class Message:
     """
@@ -57,7 +100,7 @@ class NIConfig(SlotStruct):
     Fast access structure for NI IMAQ and DAQmx initial setup parameters
     """
     __slots__ = ["cam_device", "dac_device", "line_trig_ch", "frame_trig_ch", "x_ch", "y_ch",
-                 "number_of_imaq_buffers", "dac_rate"]
+                 "number_of_imaq_buffers", "dac_rate", "backend", "line_rate", "replay_path"]
 
     def __init__(self):
         self.cam_device = None
@@ -68,18 +111,24 @@ class NIConfig(SlotStruct):
         self.y_ch = None
         self.number_of_imaq_buffers = None
         self.dac_rate = None
+        self.backend = BACKEND_NI  # One of BACKEND_NI, BACKEND_SIMULATED, BACKEND_REPLAY
+        self.line_rate = None  # A-line rate of the simulated and replay backends in Hz. None runs them unthrottled
+        self.replay_path = None  # .npy file of raw spectra streamed by the replay backend
 
 
 class WriterConfig(SlotStruct):
     """
-    Fast access structure for line scan signals to galvos x, y and line and frame triggers
+    Fast access structure for writer parameters. fpath may be a list of paths, one per target disk, across which
+    consecutive volumes are striped
     """
-    __slots__ = ["fpath", "max_bytes", "type"]
+    __slots__ = ["fpath", "max_bytes", "type", "preallocate", "encoding"]
 
     def __init__(self):
         self.fpath = None
         self.max_bytes = 0
-        self.type = None
+        self.type = None  # CONTAINER_TYPE saves a chunked, indexed container. Otherwise .npy files
+        self.preallocate = False  # If True, each file is allocated at max_bytes and written through a memory map
+        self.encoding = ENCODING_COMPLEX64  # Sample format volumes are saved in, one of NpyWriterProcess.ENCODINGS
 
 
 class ScanSignals(SlotStruct):
@@ -97,7 +146,8 @@ class ScanSignals(SlotStruct):
 
 class OCTConfig(SlotStruct):
     __slots__ = ["aline_size", "alines_per_buffer", "alines_per_bline", "number_of_blines", "apod_window",
-                 "lambda_data", "ztop", "zbottom"]
+                 "lambda_data", "lambda_range", "resampling", "ztop", "zbottom", "a_repeat", "b_repeat", "angiography",
+                 "averaging", "slabs"]
 
     def __init__(self):
         self.aline_size = None
@@ -105,9 +155,16 @@ class OCTConfig(SlotStruct):
         self.alines_per_bline = None
         self.number_of_blines = None
         self.apod_window = None
-        self.lambda_data = None
+        self.lambda_data = None  # Wavelength of each spectrometer pixel. Ignored unless resampling is set
+        self.lambda_range = None  # [min, max] wavelength of the spectrometer. If set, lambda_data is filled from it
+        self.resampling = None  # lambda to k resampling method, one of Processing.METHODS, or None not to resample
         self.ztop = None
         self.zbottom = None
+        self.a_repeat = 1  # Consecutive A-lines acquired at each point. Included in alines_per_bline
+        self.b_repeat = 1  # Consecutive acquisitions of each B-line. Included in number_of_blines
+        self.angiography = None  # One of Angiography.METRICS computed over the B-line repeats, or None
+        self.averaging = None  # One of Averaging.AVERAGING_MODES to keep only the mean of the repeats, or None
+        self.slabs = None  # [start, stop] depths, between ztop and zbottom, of up to MAX_SLABS en face projections
 
 
 class MotionOCTMessage(Message):
@@ -120,11 +177,11 @@ class MotionOCTMessage(Message):
         self.oct = OCTConfig()
 
         # Motion processing parameters
-        self.phase_corr_apod_filter_2d = None
-        self.zstart = None
-        self.npeak = None
-        self.nrepeat = None
-        self.time_lags = None
+        self.phase_corr_apod_filter_2d = None  # Weights of the cross-power spectrum, (z, A-lines // 2 + 1), or None
+        self.zstart = None  # First axial index of the region correlated. ztop if None
+        self.npeak = None  # Width in pixels of the neighborhood of the correlation peak fit
+        self.nrepeat = None  # Number of consecutive pairs of B-scans averaged for each estimate
+        self.time_lags = None  # Lags, in B-scans, between the B-scans correlated
 
 
 class OCTAMessage(Message):
@@ -146,12 +203,38 @@ class Frame:
     pass
 
 
-class MotionOCTFrame(Frame):
-    __slots__ = ["b", "mot", "spec"]
+class OCTAFrame(Frame):
+    __slots__ = ["rr", "raw", "angio", "proj", "preview", "preview_view", "spec", "dc", "index", "timestamp"]
 
 
-class OCTAFrame(Frame):
-    __slots__ = ["rr", "raw", "spec"]
+class BLineFrame(Frame):
+    """
+    B-scan published as soon as it is acquired. frame is the number of the frame it belongs to, bline its index in that
+    frame and index its B-line sequence number, counted over all frames
+    """
+    __slots__ = ["rr", "frame", "bline", "index", "timestamp"]
+
+
+class MotionOCTFrame(OCTAFrame):
+    __slots__ = ["mot"]  # Displacements between the B-scans of rr, (time lags, estimates, [z, x]) in pixels, or None
+
+
+# -- Processing --------------------------------------------------------------------------------------------------------
+
+def crop_alines(src, out, halfwidth, ztop, zbottom):
+    """
+    Crops and reshapes consecutive spatial A-lines into a volume with a single strided copy
+    :param src: Flat buffer of A-lines of length halfwidth, ordered A-line fastest then B-line
+    :param out: [zbottom - ztop, alines per B-line, number of B-lines] destination array
+    :param halfwidth: Length of each spatial A-line in src
+    :param ztop: First axial index kept
+    :param zbottom: Axial index after the last one kept
+    :return: out
+    """
+    alines, blines = np.shape(out)[1], np.shape(out)[2]
+    lines = src[:halfwidth * alines * blines].reshape(blines, alines, halfwidth)
+    np.copyto(out, lines[:, :, ztop:zbottom].transpose(2, 1, 0))
+    return out
 
 
 # -- Process managers --------------------------------------------------------------------------------------------------
@@ -177,6 +260,10 @@ class HardwareControlProcess(mp.Process):
         self.status = mp.Value('i', STATUS_NOT_READY)  # Process status
         self.saving = mp.Value('i', 0)  # If true, frames are enqueued with writer process
         self.dropped_frames = mp.Value('i', 0)
+        self.skipped_frames = mp.Value('i', 0)  # Frames passed over by consumers grabbing only the latest
+        self.status_changed = mp.Event()  # Set whenever status or saving changes. Cleared by the consumer watching it
+        self.status_changed.set()  # So that the consumer picks up the initial status
+        self.error = mp.Array('c', ERROR_MESSAGE_MAX)  # Last error reported to the consumer, empty once taken
 
         # Protected
         self._exit_event = exit_event
@@ -191,17 +278,78 @@ class HardwareControlProcess(mp.Process):
         except Empty:
             pass
 
+    def _set_status(self, status):
+        self.status.value = status
+        self.status_changed.set()
+
+    def _set_saving(self, saving):
+        self.saving.value = saving
+        self.status_changed.set()
+
+    def _report_error(self, message):
+        """
+        Prints an error and hands it to the consumer, which is notified through status_changed
+        """
+        print(type(self).__name__ + ': ' + message)
+        self.error.value = message.encode()[:ERROR_MESSAGE_MAX - 1]
+        self.status_changed.set()
+
+    def take_error(self):
+        """
+        :return: The last error reported since the previous call, or None
+        """
+        with self.error.get_lock():
+            message = self.error.value.decode(errors='replace')
+            self.error.value = b''
+        return message or None
+
     def send_msg(self, msg):
         self.msg_queue.put(msg, timeout=False)
 
     def get_frame_buffer(self):
         return self.frame_queue
 
-    def grab_frame(self):
+    def grab_frame(self, timeout=None, latest=False):
+        """
+        :param timeout: Seconds to wait for a frame. Waits indefinitely if None, returns at once if 0
+        :param latest: If True, frames queued behind the first are taken too and only the last is returned. The
+        others are counted in skipped_frames
+        :return: a Frame object or None
+        """
         try:
-            return self.frame_queue.get(timeout=None)
+            f = self.frame_queue.get(timeout=timeout)
         except Empty:
             return None
+        if latest:
+            skipped = 0
+            while True:
+                try:
+                    f = self.frame_queue.get_nowait()
+                    skipped += 1
+                except Empty:
+                    break
+            if skipped > 0:
+                with self.skipped_frames.get_lock():
+                    self.skipped_frames.value += skipped
+        return f
+
+    def release_frame(self):
+        """
+        Called by the consumer once it is done with the frame returned by grab_frame
+        """
+        pass
+
+    def publish_frame(self, f):
+        """
+        Makes a frame returned by acquire_frame available to grab_frame
+        :param f: a Frame object
+        :return: True on success, False if the frame was dropped
+        """
+        try:
+            self.frame_queue.put(f, timeout=False)
+            return True
+        except Full:
+            return False
 
     def run(self):
         """
@@ -218,17 +366,16 @@ class HardwareControlProcess(mp.Process):
                 self._poll_msg_buffer(timeout=False)
                 f = self.acquire_frame()
                 if f is not None:
-                    try:
-                        self.frame_queue.put(f, timeout=False)
+                    if self.publish_frame(f):
                         self._total_grabbed += 1
-                    except Full:
+                    else:
                         print(type(self).__name__ + ': dropped a frame! Buffer was full...')
                         with self.dropped_frames.get_lock():
                             self.dropped_frames.value += 1
             else:
                 self._poll_msg_buffer(timeout=1)  # Block and wait for messages if not scanning
             # -- end optimized --------------------------------------------------------------------------------------
-        self.status.value = STATUS_EXITING
+        self._set_status(STATUS_EXITING)
         self.close()
 
     def setup(self):
@@ -267,13 +414,31 @@ class NIOCTControlProcess(HardwareControlProcess):
         self.scansig = ScanSignals()
         self.oct = OCTConfig()
 
+        # IMAQ interface: the PyIMAQ module or a stand-in with the same surface
+        self._imaq = PyIMAQ
+
         # DAQmx interface handles
         self._scan_task = None
         self._scan_writer = None
         self._scan_timing = None
 
-    def _init_hardware_interface(self):
-        # Initialize DAQmx interface
+    def _open_backend(self):
+        """
+        Selects the IMAQ interface and scan task implementation according to niconfig.backend
+        """
+        if self.niconfig.backend == BACKEND_SIMULATED:
+            self._imaq = SimulatedIMAQ(line_rate=self.niconfig.line_rate)
+        elif self.niconfig.backend == BACKEND_REPLAY:
+            self._imaq = ReplayIMAQ(self.niconfig.replay_path, line_rate=self.niconfig.line_rate)
+        else:
+            self._imaq = PyIMAQ
+        print(type(self).__name__ + ": using", self.niconfig.backend, "backend")
+
+    def _init_scan_task(self):
+        if self._imaq is not PyIMAQ:
+            self._scan_task = SimulatedScanTask()
+            self._scan_writer = self._scan_task.writer
+            return
 
         self._scan_task = nidaqmx.Task()
         self._scan_timing = nidaqmx.task.Timing(self._scan_task)
@@ -294,17 +459,29 @@ class NIOCTControlProcess(HardwareControlProcess):
         self._scan_task.regen_mode = nidaqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION  # TODO test
         self._scan_writer = AnalogMultiChannelWriter(self._scan_task.out_stream)
 
+    def _init_hardware_interface(self):
+        """
+        :return: False if the IMAQ interface could not allocate its buffers
+        """
+        # Initialize DAQmx interface
+        self._open_backend()
+        self._init_scan_task()
+
         print("NIOCTController: initialized DAQmx interface...")
         # Initialize IMAQ interface
-        PyIMAQ.imgOpen(self.niconfig.cam_device)
-        PyIMAQ.imgConfigTrigBufferWithTTL1(timeout=1000)
-        PyIMAQ.imgSetAttributeROI(0, 0, self.oct.alines_per_buffer, self.oct.aline_size)
-        PyIMAQ.imgInitBuffer(self.niconfig.number_of_imaq_buffers)
+        self._imaq.imgOpen(self.niconfig.cam_device)
+        self._imaq.imgConfigTrigBufferWithTTL1(timeout=1000)
+        self._imaq.imgSetAttributeROI(0, 0, self.oct.alines_per_buffer, self.oct.aline_size)
+        if self._imaq.imgInitBuffer(self.niconfig.number_of_imaq_buffers) == -1:
+            return False
         print("NIOCTController: initialized IMAQ interface...")
+        return True
 
     def _close_hardware_interface(self):
-        PyIMAQ.imgStopAcq()
-        PyIMAQ.imgClose()
+        if self._imaq is None:  # Never opened
+            return
+        self._imaq.imgStopAcq()
+        self._imaq.imgClose()
         try:
             self._scan_task.stop()
             self._scan_task.close()
@@ -314,12 +491,66 @@ class NIOCTControlProcess(HardwareControlProcess):
 
 
 class OCTAControlProcess(NIOCTControlProcess):
-    def __init__(self, exit_event, frame_buffer_max=32, poll_time_sec=float(1 / 2)):
 
-        super(NIOCTControlProcess, self).__init__(exit_event, frame_buffer_max, poll_time_sec)
+    MESSAGE_TYPES = (OCTAMessage,)  # Messages handled by recv_msg
+    FRAME_TYPE = OCTAFrame  # Frames acquired and grabbed
 
-        # Shared buffer
-        self.frame_buffer = None  # SharedCircularBuffer
+    def __init__(self, exit_event, aline_size, alines_per_bline, number_of_blines, frame_buffer_max=4,
+                 writer_pool_bytes=2**30, processing_workers=0, poll_time_sec=float(1 / 2), pipelined=False,
+                 angiography=False, max_slabs=MAX_SLABS):
+        """
+        :param aline_size: Size of the raw spectral A-line. With alines_per_bline and number_of_blines, sets the size of
+        the shared frame buffer slots, so the controller must be restarted if these change
+        :param frame_buffer_max: Number of volumes held by the shared frame buffer. Unlike the frame queue of
+        HardwareControlProcess, each is a full-size volume preallocated in shared memory, so the default is kept small
+        :param writer_pool_bytes: Cap on the memory holding volumes waiting to be written to disk, for each channel
+        saved. If the writers fall this far behind, volumes are counted in unsaved_frames rather than waited for. A
+        channel's writers and their memory are only started by the first recording which saves it
+        :param processing_workers: If > 0 and the backend provides raw buffers, volumes are processed in Python by this
+        many worker processes, each taking a range of B-lines, instead of by the IMAQ interface
+        :param pipelined: If True, volumes processed by the IMAQ interface are copied from it by a grabber thread into
+        two alternating buffers, cropped into the shared buffers by the controller's thread and published to the
+        display and the writer by a publisher thread, so that the three stages overlap. Takes a frame_buffer_max of at
+        least 3
+        :param angiography: If True, angio_buffer has room for angiograms. Otherwise it holds none and angiography
+        configured by a message is refused, so that the memory is only taken by controllers which will compute them
+        :param max_slabs: Most slabs projected en face, which projection_buffer has room for
+        """
+        super(OCTAControlProcess, self).__init__(exit_event, frame_buffer_max, poll_time_sec)
+
+        # Shared buffers, filled in place by the controller and examined in place by the GUI
+        self.frame_buffer = SharedCircularBuffer(frame_buffer_max,
+                                                 [int(aline_size / 2 + 1), alines_per_bline, number_of_blines],
+                                                 np.complex64)
+        self.spectrum_buffer = SharedCircularBuffer(frame_buffer_max, [2, aline_size], np.float32)  # DC and spectrum
+        # Angiogram of each frame, committed in step with frame_buffer. Angiograms have at most half the B-lines
+        self._angio_volume_shape = [int(aline_size / 2 + 1), alines_per_bline, max(1, number_of_blines // 2)]
+        self._angio_allocated = angiography
+        self.angio_buffer = SharedCircularBuffer(frame_buffer_max, self._angio_volume_shape if angiography else [0],
+                                                 np.float32)
+        # En face projections of each frame, (slabs, [max, mean], A-lines, B-lines), committed in step with frame_buffer
+        self._max_slabs = max_slabs
+        self.projection_buffer = SharedCircularBuffer(frame_buffer_max,
+                                                      [max_slabs, 2, alines_per_bline, number_of_blines], np.float32)
+        # uint8 preview of the view selected with set_preview of each frame, and the [orientation, slice] it shows
+        self.preview_buffer = SharedCircularBuffer(frame_buffer_max, [max(int(aline_size / 2 + 1) * alines_per_bline,
+                                                                          alines_per_bline * number_of_blines)],
+                                                   np.uint8)
+        self.preview_view_buffer = SharedCircularBuffer(frame_buffer_max, [2], np.int32)
+        self.preview_enface = mp.Value('i', 0)  # If 1, previews are en face slices, else B-scans
+        self.preview_slice = mp.Value('i', 0)  # Index of the slice previewed, or Display.PREVIEW_MIP
+        self.preview_db = mp.Value('i', 1)  # If 1, previews are in dB
+        self.preview_pixels = mp.Value('i', 0)  # Most pixels along each axis of a preview. 0 if there are no previews
+        self.projecting = mp.Value('i', 0)  # If 1, the configured slabs are projected en face
+        # Each B-scan of frame_buffer_mode as soon as it is acquired, numbered by B-line, and its [frame, B-line]
+        self.bline_buffer = SharedCircularBuffer(BLINE_BUFFER_MAX, [int(aline_size / 2 + 1), alines_per_bline],
+                                                 np.complex64)
+        self.bline_info_buffer = SharedCircularBuffer(BLINE_BUFFER_MAX, [2], np.int64)
+        self.bline_streaming = mp.Value('i', 0)  # If 1, B-scans are published to bline_buffer
+        self.bline_supported = mp.Value('i', 1)  # If 1, B-scans can be published as they are acquired
+        self._last_bline = -1  # Number of the last B-line grabbed by this process
+        self.unsaved_frames = mp.Value('i', 0)  # Volumes acquired while saving which the writer had no room for
+        self._last_grabbed = -1  # Number of the last frame grabbed by this process
 
         # Properties
         self.writer = WriterConfig()
@@ -329,26 +560,107 @@ class OCTAControlProcess(NIOCTControlProcess):
         self._tmp_buffer = None  # Buffer for frame prior to cropping and reshaping
         self.frame_buffer_mode = False  # If True, multiple buffers are used to acquire frame
 
-        self._writer_exit = None
-        self._writer_process = None  # Process which saves each grab to disk if the saving flag is True.
+        self._writer_volume_shape = [1, int(aline_size / 2 + 1), alines_per_bline, number_of_blines]
+        self._raw_volume_shape = [1, number_of_blines, alines_per_bline, aline_size]
+        self._writer_pool_bytes = writer_pool_bytes
+        self._writer = None  # Processes which save each grab to disk if the saving flag is True.
+        self._writer_raw = False  # If True, the writer's pool holds raw spectra rather than processed volumes
+
+        # Raw recording
+        self.raw_mode = False  # If True, raw spectra are saved; only every RAW_DISPLAY_DECIMATION volume is processed
+        self._raw_buffer = None  # Raw volume, (B-lines, A-lines, aline_size), if there is no processing pool
+        self._raw_volumes = 0  # Raw volumes acquired since raw_mode was entered
+        self._display_processor = None  # OCTProcessor for display of raw volumes if there is no processing pool
+
+        self._processing_workers = processing_workers
+        self._processing_pool = None  # ProcessingPool used in place of octCopyBuffer if not None
+        self._pool_filled = None  # Raw buffer of the pool holding the next volume to process, or None
+
+        # Angiography
+        self._angio_writer = None  # Writer of the angiography channel, started by the first recording which saves one
+        self._angio_saving = False  # If True, angiograms are saved alongside the volumes
+
+        self._assembler = None  # VolumeAssembler the B-lines of each volume are added to as they arrive
+        self._assembler_key = None  # Crop and slabs the assembler was made for
+
+        self._preview_renderer = None  # SliceRenderer of the previews, made on first use
+
+        # Frames handed out by acquire_frame in turn. Their arrays are views of the shared buffers' slots, so acquiring a
+        # frame allocates nothing. A frame is reused frame_buffer_max frames later, once its slots have been overwritten
+        self._frame_pool = [self.FRAME_TYPE() for _ in range(frame_buffer_max)]
+        self._frame_fields = [name for cls in self.FRAME_TYPE.__mro__ for name in getattr(cls, '__slots__', [])]
+        self._frames_acquired = 0
+        self._spectra_out = True  # If True, the IMAQ interface copies spectra into arrays passed to it
+
+        # Pipeline. The threads and their queues are made in the controller's process, by setup and _start_grabber
+        self._pipelined = pipelined
+        self._grabber = None  # Thread copying volumes from the IMAQ interface into _tmp_buffers
+        self._grabber_stop = None  # threading.Event which stops the grabber
+        self._free_buffers = None  # Indices of the tmp buffers the grabber may fill
+        self._ready_buffers = None  # (index, success) of the tmp buffers filled, in order
+        self._tmp_buffers = None  # The two buffers the grabber fills in turn. The first is _tmp_buffer
+        self._tmp_spectra = None  # DC and A-line spectrum of each, (2, 2, aline_size)
+        self._publisher = None  # Thread committing the frames cropped to the shared buffers and saving them
+        self._publish_queue = None  # Frames waiting for the publisher
 
     def setup(self):
-        self._writer_exit = mp.Event()
-        self._writer_process = NpyWriterProcess(self._writer_exit)
-        self._writer_process.start()
+        pass  # The writers are started by the first recording
 
     def close(self):
+        self._stop_grabber()
+        self._stop_publisher()
         self._close_hardware_interface()
-        self._writer_exit.set()
-        self._writer_process.join(timeout=0)
-        if self._writer_process.is_alive():  # If it's stuck, terminate it
-            self._writer_process.terminate()
-            print(type(self).__name__ + ': writer terminated!')
+        self._close_processing_pool()
+        if self._writer is not None:
+            self._close_writer()
+        if self._angio_writer is not None:
+            self._angio_writer.close(timeout=WRITER_CLOSE_TIMEOUT_SEC)
+
+    def _open_processing_pool(self):
+        self._close_processing_pool()
+        if self._processing_workers < 1:
+            return
+        if not self._raw_supported():
+            self._report_error('Backend does not provide raw buffers per B-line; processing with IMAQ instead of ' +
+                               str(self._processing_workers) + ' workers')
+            return
+        self._processing_pool = ProcessingPool(self._processing_workers, self.oct.aline_size,
+                                               self.oct.alines_per_bline, self.oct.number_of_blines,
+                                               self.frame_buffer, self.angio_buffer, self.projection_buffer,
+                                               lambda_data=self.oct.lambda_data, apod_window=self.oct.apod_window,
+                                               method=self.oct.resampling, max_slabs=self._max_slabs)
+        self._processing_pool.start()
+        self._pool_filled = None
+        print(type(self).__name__ + ': processing with', self._processing_pool.get_workers(), 'workers')
+
+    def _close_processing_pool(self):
+        if self._processing_pool is not None:
+            self._processing_pool.close()
+            self._processing_pool = None
+
+    def _report_utilization(self):
+        if self._processing_pool is not None:
+            utilization = ', '.join('%.0f%%' % (100 * u) for u in self._processing_pool.get_utilization())
+            print(type(self).__name__ + ': processing worker utilization', utilization)
+
+    def _start_writer(self, stripes, raw=False):
+        if raw:
+            self._writer = StripedNpyWriter(stripes, self._raw_volume_shape, np.uint16, self._writer_pool_bytes)
         else:
+            self._writer = StripedNpyWriter(stripes, self._writer_volume_shape, np.complex64, self._writer_pool_bytes)
+        self._writer_raw = raw
+        self._writer.start()
+
+    def _close_writer(self):
+        if self._writer.close(timeout=WRITER_CLOSE_TIMEOUT_SEC):
             print(type(self).__name__ + ': writer closed safely.')
+        else:
+            print(type(self).__name__ + ': writer terminated!')
 
     def recv_msg(self, message):
-        if isinstance(message, OCTAMessage):
+        if isinstance(message, self.MESSAGE_TYPES):
+            # Messages change the parameters, the IMAQ interface and the writers the pipeline uses
+            self._pause_pipeline()
             if message.instruction is INSTR_OPEN:
                 print("OCTAControlProcess: recv INSTR_OPEN")
                 self._copy_params_from_msg(message)
@@ -361,28 +673,32 @@ class OCTAControlProcess(NIOCTControlProcess):
                     frame_size = self.oct.aline_size * self.oct.alines_per_bline * self.oct.number_of_blines
 
                 print("OCTAControlProcess: opening hardware interface with buflist trigger mode", self.frame_buffer_mode)
-                self._init_hardware_interface()
-                if PyIMAQ.imgGetFrameSize() == frame_size:
+                if not self._init_hardware_interface():
+                    # The replay backend refuses recordings whose A-lines do not match aline_size
+                    self._report_error('IMAQ interface failed to allocate its buffers; not ready to scan')
+                    self._set_status(STATUS_NOT_READY)
+                elif self._imaq.imgGetFrameSize() == frame_size:
                     # Initialize FAST OCT interface
                     if self.oct.apod_window is not None:
                         if self.oct.lambda_data is not None:
                             print("OCTAControlProcess: planning Fast SD-OCT processing with interp and apod")
-                            PyIMAQ.octPlan(lam=self.oct.lambda_data, apod=self.oct.apod_window)
+                            self._imaq.octPlan(lam=self.oct.lambda_data, apod=self.oct.apod_window)
                         else:
                             print("OCTAControlProcess: planning Fast SD-OCT processing with apod")
-                            PyIMAQ.octPlan(apod=self.oct.apod_window)
+                            self._imaq.octPlan(apod=self.oct.apod_window)
                     else:
                         print("OCTAControlProcess: planning Fast SD-OCT processing, FFT only")
-                        PyIMAQ.octPlan()
+                        self._imaq.octPlan()
+                    self._open_processing_pool()
                     # Change status to ready
-                    self.status.value = STATUS_READY
+                    self._set_status(STATUS_READY)
                 else:
                     print(
                         "OCTAControlProcess: failed to open IMAQ interface... the requested buffer size is too large, or the hardware may be in use")
 
             elif message.instruction is INSTR_CLOSE:
                 print("OCTAControlProcess: recv INSTR_CLOSE")
-                self.status.value = STATUS_NOT_READY
+                self._set_status(STATUS_NOT_READY)
                 self._exit_event.set()
             elif message.instruction is INSTR_START_ACQ:
                 print("OCTAControlProcess: recv INSTR_START_ACQ")
@@ -390,20 +706,24 @@ class OCTAControlProcess(NIOCTControlProcess):
                     self._buffer_scan_samples()  # Send new scan signals to the hardware
                     self._time_started = time.time()
                     self._grabbed = 0
-                    PyIMAQ.imgStartAcq()
+                    self._imaq.imgStartAcq()
+                    self._pool_filled = None
+                    if self._processing_pool is not None:
+                        self._processing_pool.reset_utilization()
                     print("OCTAControlProcess: img start acq")
                     self._scan_task.start()
                     print("OCTAControlProcess: scan task started")
-                    self.status.value = STATUS_ACQUIRING
+                    self._set_status(STATUS_ACQUIRING)
                 else:
                     print("OCTAControlProcess: Can't start... not ready")
                     return
             elif message.instruction is INSTR_STOP_ACQ:
                 print("OCTAControlProcess: recv INSTR_STOP_ACQ")
                 if self.status.value is STATUS_ACQUIRING:
-                    PyIMAQ.imgStopAcq()
+                    self._imaq.imgStopAcq()
                     self._scan_task.stop()
-                    self.status.value = STATUS_READY
+                    self._report_utilization()
+                    self._set_status(STATUS_READY)
             elif message.instruction is INSTR_UPDATE_ACQ:
                 print("OCTAControlProcess: recv INSTR_UPDATE_ACQ")
                 if self.status.value is STATUS_ACQUIRING:
@@ -414,72 +734,613 @@ class OCTAControlProcess(NIOCTControlProcess):
                     self._buffer_scan_samples()
                 else:
                     self._copy_params_from_msg(message)
+                    if self._processing_pool is not None:  # Replanned with the new calibration
+                        self._open_processing_pool()
                 # TODO allow for other parameters to be updated during acquisition?
             elif message.instruction is INSTR_BEGIN_SAVE:
                 print("OCTAControlProcess: recv INSTR_BEGIN_SAVE")
-                self.saving.value = 1
+                raw = message.writer.encoding == ENCODING_RAW_UINT16
+                if raw and not self._raw_supported():
+                    self._report_error('Backend does not provide raw buffers per B-line; cannot save ' +
+                                       ENCODING_RAW_UINT16 + ' spectra')
+                    return
+                self._set_saving(1)
                 self.writer = message.writer
                 print("Writer config", self.writer.fpath, self.writer.max_bytes)
-                self._writer_process.config(self.writer.fpath, self.writer.max_bytes)
+                if isinstance(self.writer.fpath, (list, tuple)):
+                    fpaths = self.writer.fpath
+                else:
+                    fpaths = [self.writer.fpath]
+                if self._writer is None:
+                    self._start_writer(len(fpaths), raw)
+                elif len(fpaths) != self._writer.get_stripes() or raw != self._writer_raw:
+                    self._close_writer()
+                    self._start_writer(len(fpaths), raw)
+                params = {  # Embedded in containers so that recordings describe themselves
+                    "oct": self.oct.to_dict(),
+                    "niconfig": self.niconfig.to_dict()
+                }
+                self._writer.config(fpaths, self.writer.max_bytes, self.writer.preallocate, self.writer.encoding,
+                                    self.writer.type, params)
+                self.raw_mode = raw
+                self._raw_volumes = 0
+                # Angiograms are saved as a channel of their own unless the raw spectra are, which can be reprocessed
+                self._angio_saving = not raw and self._angiography_enabled()
+                if self._angio_saving:
+                    if self._angio_writer is None:
+                        self._angio_writer = StripedNpyWriter(1, self._angio_volume_shape, np.float32,
+                                                              self._writer_pool_bytes)
+                        self._angio_writer.start()
+                    self._angio_writer.config([fpaths[0] + ANGIOGRAPHY_SUFFIX], self.writer.max_bytes,
+                                              self.writer.preallocate, ENCODING_FLOAT32, self.writer.type, params)
             elif message.instruction is INSTR_END_SAVE:
                 print("OCTAControlProcess: recv INSTR_END_SAVE")
-                self.saving.value = 0
+                if self.saving.value == 1:
+                    self._writer.finish()
+                    if self._angio_saving:
+                        self._angio_writer.finish()
+                self._set_saving(0)
+                self.raw_mode = False
+                self._angio_saving = False
             else:
                 return
         else:
             return
 
+    def grab_frame(self, timeout=None, latest=False):
+        """
+        Waits for a frame newer than the last one grabbed and examines it in shared memory. The oldest unseen frame is
+        returned unless it has been overwritten. Call release_frame when done with it; the controller does not wait for
+        the GUI, so release_frame returns False if the frame was overwritten while it was in use.
+        :param timeout: Seconds to wait for a new frame. Waits indefinitely if None, returns at once if 0
+        :param latest: If True, the most recent frame is returned instead of the oldest unseen. Frames passed over are
+        counted in skipped_frames
+        :return: OCTAFrame of read-only views into the shared frame buffers, or None
+        """
+        if not self.frame_buffer.wait(self._last_grabbed + 1, timeout):
+            return None
+        f = self.FRAME_TYPE()
+        f.rr, header = self.frame_buffer.examine(None if latest else self._last_grabbed + 1)
+        if f.rr is None:  # Overwritten; skip to the most recent
+            f.rr, header = self.frame_buffer.examine()
+            if f.rr is None:
+                return None
+        if header.index - self._last_grabbed > 1:
+            with self.skipped_frames.get_lock():
+                self.skipped_frames.value += header.index - self._last_grabbed - 1
+        f.index = header.index
+        f.timestamp = header.timestamp
+        self._last_grabbed = f.index
+        f.angio, _ = self.angio_buffer.examine(f.index)
+        if f.angio is not None and f.angio.size == 0:  # No angiogram was computed for this frame
+            f.angio = None
+        f.proj, _ = self.projection_buffer.examine(f.index)
+        if f.proj is not None and f.proj.size == 0:  # Nothing was projected for this frame
+            f.proj = None
+        f.preview, _ = self.preview_buffer.examine(f.index)
+        f.preview_view, _ = self.preview_view_buffer.examine(f.index)
+        if f.preview is None or f.preview.size == 0 or f.preview_view is None:  # No preview of this frame
+            f.preview = None
+            f.preview_view = None
+        spectra, _ = self.spectrum_buffer.examine()
+        if spectra is not None:
+            f.dc = spectra[0]
+            f.spec = spectra[1]
+        else:
+            f.dc = None
+            f.spec = None
+        return f
+
+    def release_frame(self):
+        """
+        :return: True if the grabbed frame was not overwritten while it was in use
+        """
+        self.spectrum_buffer.release()
+        self.angio_buffer.release()
+        self.projection_buffer.release()
+        self.preview_buffer.release()
+        self.preview_view_buffer.release()
+        return self.frame_buffer.release()
+
+    def grab_bline(self, timeout=None):
+        """
+        Examines the most recent B-scan published while bline_streaming is set, if it is newer than the last one grabbed.
+        Call release_bline when done with it
+        :param timeout: Seconds to wait for a new B-scan. Waits indefinitely if None, returns at once if 0
+        :return: BLineFrame of read-only views into the shared B-line buffers, or None
+        """
+        if not self.bline_buffer.wait(self._last_bline + 1, timeout):
+            return None
+        b = BLineFrame()
+        b.rr, header = self.bline_buffer.examine()
+        if b.rr is None:
+            return None
+        info, _ = self.bline_info_buffer.examine(header.index)
+        if info is None:
+            self.bline_buffer.release()
+            return None
+        b.frame, b.bline = int(info[0]), int(info[1])
+        b.index = header.index
+        b.timestamp = header.timestamp
+        self._last_bline = b.index
+        return b
+
+    def release_bline(self):
+        """
+        :return: True if the grabbed B-scan was not overwritten while it was in use
+        """
+        self.bline_info_buffer.release()
+        return self.bline_buffer.release()
+
+    def _publish_bline(self, bline, j, frame=None):
+        """
+        Crops a B-line as soon as it is acquired into the next slot of bline_buffer
+        :param bline: Spatial A-lines of the B-line, (A-lines * halfwidth)
+        :param j: Index of the B-line in the volume
+        :param frame: Number the volume will be committed as. The next number of frame_buffer if None
+        """
+        lines = bline.reshape(self.oct.alines_per_bline, self.halfwidth)[:, self.oct.ztop:self.oct.zbottom]
+        np.copyto(self.bline_buffer.claim([self.oct.zbottom - self.oct.ztop, self.oct.alines_per_bline]), lines.T)
+        info = self.bline_info_buffer.claim([2])
+        info[:] = [self.frame_buffer.count() if frame is None else frame, j]
+        self.bline_info_buffer.commit()  # Before the B-scan, so that it is there when the B-scan is grabbed
+        self.bline_buffer.commit()
+
+    def publish_frame(self, f):
+        # Claimed in the order the frames are acquired, which keeps the angiograms numbered the same as the frames
+        if f.angio is None:
+            self.angio_buffer.claim([0, 0, 0])
+        if f.proj is None:
+            self.projection_buffer.claim([0, 0, 0, 0])
+        if self._publisher is not None and self._pipeline_enabled():
+            self._publish_queue.put(f)  # Waits while the publisher is behind by a frame
+        else:
+            self._publish(f)
+        return True
+
+    def _publish(self, f):
+        """
+        Publish stage. Renders the preview of a frame, commits it and the rest of its slots for the display, then hands
+        the volume, and its angiogram if saved, to the writers
+        """
+        self._compute_preview(f)
+        if f.preview is None:
+            self.preview_buffer.claim([0, 0])
+            self.preview_view_buffer.claim([0])
+        self.spectrum_buffer.commit()  # Filled in place by _copy_spectra
+        self.angio_buffer.commit()
+        self.projection_buffer.commit()
+        self.preview_buffer.commit()
+        self.preview_view_buffer.commit()
+        f.index = self.frame_buffer.commit()
+        if self.saving.value == 1 and f.raw is None:  # Raw volumes are saved as they are acquired
+            self._save(f.rr)
+            if self._angio_saving and f.angio is not None:
+                self._save(f.angio, self._angio_writer)
+
     def acquire_frame(self):
-        # Allocate frame memory
-        f = OCTAFrame()
-        f.rr = np.empty([self.oct.zbottom - self.oct.ztop, self.oct.alines_per_bline, self.oct.number_of_blines],
-                        dtype=np.complex64)
-        f.dc = None  # Allocated by IMAQ wrapper
-        f.spec = None
-        if self.frame_buffer_mode:  # One buffer per B-scan
-            for j in range(self.oct.number_of_blines):
-                rval = PyIMAQ.octCopyBuffer(j, self._tmp_buffer)
-                if rval is not -1:
-                    self._grabbed += 1
-                    # Reshape and crop frame
-                    seek = 0
-                    for i in range(self.oct.alines_per_bline):
-                        np.copyto(f.rr[:, i, j], self._tmp_buffer[
-                                        self.halfwidth * seek:self.halfwidth * seek + self.halfwidth][
-                                        self.oct.ztop:self.oct.zbottom])
-                        seek += 1
-                else:
-                    return None
-            f.dc = PyIMAQ.octCopyDCSpectrum()
-            f.spec = PyIMAQ.octCopySpectrum(0)
-            if self.saving.value == 1:
-                if len(np.shape(f.rr)) is 3:
-                    self._writer_process.enqueue(np.reshape(f.rr, [1, self.oct.zbottom - self.oct.ztop,
-                                                                   self.oct.alines_per_bline,
-                                                                   self.oct.number_of_blines]))
-            return f
-        else:  # One buffer per volume
+        if not self._pipeline_enabled():
+            self._stop_grabber()
+        # B-lines are published as they are copied from the IMAQ interface, not by the processing pool or in raw mode
+        supported = int(self.frame_buffer_mode and not self.raw_mode and self._processing_pool is None)
+        if self.bline_supported.value != supported:
+            self.bline_supported.value = supported
+        if self.raw_mode:
+            return self._acquire_raw_frame()
+        if self._pipeline_enabled():
+            f = self._acquire_pipelined_frame()
+            if f is None:
+                return None
+        elif self._processing_pool is not None:  # Raw B-lines processed by the worker pool
+            f = self._acquire_pooled_frame()
+            if f is None:
+                return None
+        else:
+            # Assembled directly in the next slots of the shared buffers
+            f = self._next_frame()
+            assembler = self._get_assembler()
+            volume = self._claim_assembled(f, assembler)
+            if not self._copy_volume(self._tmp_buffer, assembler, volume, f):
+                self._abort_assembled()
+                return None
+            self._copy_spectra(f)
+            f.rr = volume
+        return f
+
+    def _copy_volume(self, buffer, assembler=None, volume=None, f=None, frame=None, stop=None):
+        """
+        Copies the next volume from the IMAQ interface into buffer. In frame_buffer_mode, each B-line is assembled and,
+        if bline_streaming is set, published as soon as it arrives
+        :param buffer: Buffer of the spatial A-lines of the volume, like _tmp_buffer
+        :param assembler: VolumeAssembler the B-lines are added to, into volume and the angiogram and projections of
+        f, or None
+        :param frame: Number the volume will be committed as, for the B-lines published. The next number of
+        frame_buffer if None
+        :param stop: threading.Event which abandons the volume between B-lines once set, or None
+        :return: False if the volume was not acquired
+        """
+        if not self.frame_buffer_mode:  # One buffer per volume
             # Poll the fast OCT interface
-            rval = PyIMAQ.octCopyBuffer(self._grabbed, self._tmp_buffer)
-            if rval is not -1:
-                # Reshape and crop frame
-                seek = 0
-                for j in range(self.oct.number_of_blines):
-                    for i in range(self.oct.alines_per_bline):
-                        f.rr[:, i, j] = self._tmp_buffer[self.halfwidth * seek:self.halfwidth * seek + self.halfwidth][
-                                        self.oct.ztop:self.oct.zbottom]
-                        seek += 1
-                f.dc = PyIMAQ.octCopyDCSpectrum()
-                f.spec = PyIMAQ.octCopySpectrum(0)
-                self._grabbed += 1
-                if self.saving.value == 1:
-                    if len(np.shape(f.rr)) is 3:
-                        self._writer_process.enqueue(np.reshape(f.rr, [1, self.oct.zbottom - self.oct.ztop,
-                                                                       self.oct.alines_per_bline,
-                                                                       self.oct.number_of_blines]))
-                return f
-            else:
+            if self._imaq.octCopyBuffer(self._grabbed, buffer) == -1:
+                return False
+            self._grabbed += 1
+            if assembler is not None:
+                assembler.add_blines(self._crop_blines(buffer), 0, volume, f.angio, f.proj)
+            return True
+        bline_size = self.halfwidth * self.oct.alines_per_bline
+        for j in range(self.oct.number_of_blines):  # One buffer per B-scan
+            if stop is not None and stop.is_set():
+                return False
+            # Each B-line is copied to its own contiguous region of the volume's buffer
+            bline = buffer[j * bline_size:(j + 1) * bline_size]
+            if self._imaq.octCopyBuffer(j, bline) == -1:
+                return False
+            self._grabbed += 1
+            if assembler is not None:
+                assembler.add_blines(self._crop_blines(bline), j, volume, f.angio, f.proj)
+            if self.bline_streaming.value == 1:
+                self._publish_bline(bline, j, frame)
+        return True
+
+    def _copy_raw_volume(self, raw):
+        """
+        Copies the raw spectra of the next volume from the IMAQ interface
+        :param raw: Buffer of the volume, (B-lines, A-lines, aline_size)
+        :return: False if the volume was not acquired
+        """
+        for j in range(self.oct.number_of_blines):
+            if self._imaq.imgCopyBuffer(j, raw[j]) == -1:
+                return False
+            self._grabbed += 1
+        return True
+
+    def _acquire_pooled_frame(self):
+        """
+        Has the processing pool assemble the raw volume copied by the last call while the next one is copied into its
+        other raw buffer, so that acquisition and processing overlap
+        :return: OCTAFrame of the processed volume, or None
+        """
+        pool = self._processing_pool
+        if self._pool_filled is None:  # Nothing copied ahead
+            if not self._copy_raw_volume(pool.get_raw(0)):
                 return None
+            self._pool_filled = 0
+        k = self._pool_filled
+        self._pool_filled = None
+        f = self._next_frame()
+        volume = self._submit_to_pool(f, k)
+        if volume is None:
+            return None
+        if self._copy_raw_volume(pool.get_raw(1 - k)):
+            self._pool_filled = 1 - k
+        if not pool.wait():
+            self._restart_processing_pool()
+            return None
+        self._copy_spectra(f)
+        f.rr = volume
+        return f
+
+    def _submit_to_pool(self, f, k):
+        """
+        Claims the slots of f and starts the processing pool assembling raw buffer k into them
+        :return: The volume's slot of the frame buffer, or None if the pool failed to start
+        """
+        volume = self._claim_assembled(f, self._get_assembler())
+        if not self._processing_pool.submit(k, self.oct.ztop, self.oct.zbottom, self.oct.a_repeat, self.oct.b_repeat,
+                                            self.oct.averaging, self._get_angiography(), self._get_slabs()):
+            self._restart_processing_pool()
+            return None
+        return volume
+
+    def _restart_processing_pool(self):
+        """
+        Gives up the volume the processing pool failed to process and starts new workers in place of its own
+        """
+        self._report_error('Processing workers did not finish a volume in time; restarting them')
+        self._abort_assembled()
+        self._open_processing_pool()
+
+    def _crop_blines(self, buffer):
+        """
+        :param buffer: Spatial A-lines of consecutive B-lines, like _tmp_buffer or a B-line of it
+        :return: View of the B-lines cropped to [ztop, zbottom), (B-lines, A-lines, z)
+        """
+        blines = len(buffer) // (self.halfwidth * self.oct.alines_per_bline)
+        lines = buffer[:blines * self.halfwidth * self.oct.alines_per_bline]
+        return lines.reshape(blines, self.oct.alines_per_bline, self.halfwidth)[:, :, self.oct.ztop:self.oct.zbottom]
+
+    def _get_assembler(self):
+        """
+        :return: VolumeAssembler of the volumes acquired with the current parameters and crop
+        """
+        slabs = self._get_slabs()
+        key = [self.oct.ztop, self.oct.zbottom, slabs]
+        if self._assembler is None or key != self._assembler_key:
+            self._assembler = VolumeAssembler(self.oct.zbottom - self.oct.ztop, self.oct.alines_per_bline,
+                                              self.oct.number_of_blines, self.oct.a_repeat, self.oct.b_repeat,
+                                              self.oct.averaging, self._get_angiography(), slabs)
+            self._assembler_key = key
+        return self._assembler
+
+    def _claim_assembled(self, f, assembler):
+        """
+        Claims the next slots of the angiogram and projections of f, as f.angio and f.proj, and of the volume assembled
+        :return: The next slot of the frame buffer, to assemble the volume in
+        """
+        if assembler.angio_shape is not None:
+            f.angio = self.angio_buffer.claim(assembler.angio_shape)
+        if assembler.projection_shape is not None:
+            f.proj = self.projection_buffer.claim(assembler.projection_shape)
+        return self.frame_buffer.claim(assembler.shape)
+
+    def _abort_assembled(self):
+        self.frame_buffer.abort()
+        self.angio_buffer.abort()
+        self.projection_buffer.abort()
+
+    def _pipeline_enabled(self):
+        return self._pipelined and not self.raw_mode and self._processing_pool is None
+
+    def _acquire_pipelined_frame(self):
+        """
+        Crop stage. Crops the next volume filled by the grabber thread into the shared buffers. The grabber goes on to
+        fill the other tmp buffer, and the publisher to publish the last frame, meanwhile
+        :return: OCTAFrame, or None if no volume was acquired within the poll time
+        """
+        if self._grabber is None or not self._grabber.is_alive():
+            self._start_grabber()
+        if self._publisher is None and self._frame_buffer_max >= 3:
+            self._start_publisher()
+        try:
+            k, ok = self._ready_buffers.get(timeout=self._poll_time_sec)
+        except Empty:
+            return None
+        if not ok:
+            self._free_buffers.put(k)
+            return None
+        f = self._next_frame()
+        assembler = self._get_assembler()
+        volume = self._claim_assembled(f, assembler)
+        assembler.add_blines(self._crop_blines(self._tmp_buffers[k]), 0, volume, f.angio, f.proj)
+        spectra = self.spectrum_buffer.claim([2, self.oct.aline_size])
+        np.copyto(spectra, self._tmp_spectra[k])
+        f.dc = spectra[0]
+        f.spec = spectra[1]
+        self._free_buffers.put(k)
+        f.rr = volume
+        return f
+
+    def _start_grabber(self):
+        self._stop_grabber()
+        if self._tmp_buffers is None or self._tmp_buffers[0] is not self._tmp_buffer:  # Parameters changed
+            self._tmp_buffers = [self._tmp_buffer, np.empty_like(self._tmp_buffer)]
+            self._tmp_spectra = np.empty([2, 2, self.oct.aline_size], dtype=np.float32)
+        self._free_buffers = Queue()
+        self._free_buffers.put(0)
+        self._free_buffers.put(1)
+        self._ready_buffers = Queue()
+        self._grabber_stop = threading.Event()
+        # Shared buffers are only claimed by this thread; the grabber writes to the tmp buffers and bline_buffer
+        self._grabber = threading.Thread(target=self._grab_volumes, args=(self.frame_buffer.count(),),
+                                         name='grabber', daemon=True)
+        self._grabber.start()
+
+    def _stop_grabber(self):
+        """
+        Stops the grabber thread, abandoning the volume it is copying and those waiting to be cropped
+        """
+        if self._grabber is None:
+            return
+        self._grabber_stop.set()
+        self._grabber.join()
+        self._grabber = None
+
+    def _grab_volumes(self, frame):
+        """
+        Grabber thread. Copies volumes from the IMAQ interface into whichever tmp buffer is free, then reads the spectra
+        of the volume and hands the buffer to _acquire_pipelined_frame
+        :param frame: Number the first volume will be committed as
+        """
+        while not self._grabber_stop.is_set():
+            try:
+                k = self._free_buffers.get(timeout=self._poll_time_sec)
+            except Empty:
+                continue
+            ok = self._copy_volume(self._tmp_buffers[k], frame=frame, stop=self._grabber_stop)
+            if ok:
+                self._read_spectra(self._tmp_spectra[k, 0], self._tmp_spectra[k, 1])
+                frame += 1
+            self._ready_buffers.put((k, ok))
+
+    def _start_publisher(self):
+        # The publisher may be saving a frame while the next waits in the queue and the one after is cropped, so the
+        # frame buffer needs a slot for each
+        self._publish_queue = Queue(maxsize=1)
+        self._publisher = threading.Thread(target=self._publish_frames, name='publisher', daemon=True)
+        self._publisher.start()
+
+    def _stop_publisher(self):
+        if self._publisher is None:
+            return
+        self._publish_queue.put(None)
+        self._publisher.join()
+        self._publisher = None
+
+    def _publish_frames(self):
+        """
+        Publisher thread. Publishes each frame put in _publish_queue, in order
+        """
+        while True:
+            f = self._publish_queue.get()
+            if f is None:
+                self._publish_queue.task_done()
+                return
+            self._publish(f)
+            self._publish_queue.task_done()
+
+    def _pause_pipeline(self):
+        """
+        Stops the grabber and waits for the publisher to publish the frames it has been given
+        """
+        self._stop_grabber()
+        if self._publisher is not None:
+            self._publish_queue.join()
+
+    def _acquire_raw_frame(self):
+        """
+        Copies the raw spectra of a volume straight to the writer. Every RAW_DISPLAY_DECIMATION volume is also
+        processed for display
+        :return: OCTAFrame of the processed volume and its raw spectra, or None if the volume is not displayed
+        """
+        if self._processing_pool is not None:
+            raw = self._processing_pool.get_raw(0)
+            self._pool_filled = None
+        else:
+            shape = [self.oct.number_of_blines, self.oct.alines_per_bline, self.oct.aline_size]
+            if self._raw_buffer is None or list(self._raw_buffer.shape) != shape:
+                self._raw_buffer = np.empty(shape, dtype=np.uint16)
+            raw = self._raw_buffer
+        if not self._copy_raw_volume(raw):
+            return None
+        self._save(raw)
+        self._raw_volumes += 1
+        if (self._raw_volumes - 1) % RAW_DISPLAY_DECIMATION != 0:
+            return None
+        f = self._next_frame()
+        f.raw = raw
+        if self._processing_pool is not None:
+            volume = self._submit_to_pool(f, 0)
+            if volume is None:
+                return None
+            if not self._processing_pool.wait():
+                self._restart_processing_pool()
+                return None
+        else:
+            assembler = self._get_assembler()
+            volume = self._claim_assembled(f, assembler)
+            if self._display_processor is None:
+                self._display_processor = OCTProcessor.from_config(self.oct)
+            self._display_processor.process(raw, out=self._tmp_buffer)
+            assembler.add_blines(self._crop_blines(self._tmp_buffer), 0, volume, f.angio, f.proj)
+        self._copy_spectra(f)
+        f.rr = volume
+        return f
+
+    def _next_frame(self):
+        """
+        :return: The next frame of the pool, with every field None
+        """
+        f = self._frame_pool[self._frames_acquired % len(self._frame_pool)]
+        self._frames_acquired += 1
+        for name in self._frame_fields:
+            setattr(f, name, None)
+        return f
+
+    def _copy_spectra(self, f):
+        """
+        Copies the DC spectrum and the spectrum of the first A-line of the last buffer acquired straight into the next
+        slot of spectrum_buffer, as f.dc and f.spec
+        """
+        spectra = self.spectrum_buffer.claim([2, self.oct.aline_size])
+        f.dc = spectra[0]
+        f.spec = spectra[1]
+        self._read_spectra(f.dc, f.spec)
+
+    def _read_spectra(self, dc, spec):
+        """
+        Copies the DC spectrum and the spectrum of the first A-line of the last buffer acquired into dc and spec
+        """
+        if self._spectra_out:
+            try:
+                self._imaq.octCopyDCSpectrum(out=dc)
+                self._imaq.octCopySpectrum(0, out=spec)
+                return
+            except TypeError:  # The IMAQ interface allocates the spectra it returns
+                self._spectra_out = False
+        dc[:] = self._imaq.octCopyDCSpectrum()
+        spec[:] = self._imaq.octCopySpectrum(0)
+
+    def _raw_supported(self):
+        return self.frame_buffer_mode and hasattr(self._imaq, 'imgCopyBuffer')
+
+    def _angiography_enabled(self):
+        return self._angio_allocated and self.oct.angiography is not None and (self.oct.b_repeat or 1) > 1
+
+    def _get_angiography(self):
+        """
+        :return: Metric of the angiograms computed, or None if there are none
+        """
+        return self.oct.angiography if self._angiography_enabled() else None
+
+    def _get_slabs(self):
+        """
+        :return: The first max_slabs configured slabs which overlap the crop, in depths relative to it, or None if
+        projection is off
+        """
+        if not self.oct.slabs or self.projecting.value == 0:
+            return None
+        slabs = []
+        for start, stop in self.oct.slabs:
+            start, stop = max(start, self.oct.ztop) - self.oct.ztop, min(stop, self.oct.zbottom) - self.oct.ztop
+            if start < stop:
+                slabs.append([start, stop])
+        return slabs[:self._max_slabs] or None
+
+    def set_preview(self, enface, index, db, pixels):
+        """
+        Selects the view previewed with each frame from then on. Called by the GUI, which then only has to display the
+        preview rather than read the volume
+        :param enface: If True, en face slices are previewed, else B-scans
+        :param index: Index of the slice previewed, or Display.PREVIEW_MIP
+        :param db: If True, previews are in dB
+        :param pixels: Most pixels along each axis of a preview. 0 for no previews
+        """
+        self.preview_enface.value = int(enface)
+        self.preview_slice.value = int(index)
+        self.preview_db.value = int(db)
+        self.preview_pixels.value = int(pixels)
+
+    def set_projection(self, enabled):
+        """
+        Turns the en face projection of the configured slabs on or off from the next frame. Called by the GUI, which
+        only needs the projections while their view is displayed
+        :param enabled: If True, each frame is projected into the projection buffer
+        """
+        self.projecting.value = int(enabled)
+
+    def _compute_preview(self, f):
+        """
+        Renders the view selected with set_preview into the next slots of preview_buffer and preview_view_buffer. The
+        angiogram of the frame is previewed if there is one, else its volume
+        """
+        f.preview = None
+        f.preview_view = None
+        pixels = self.preview_pixels.value
+        if pixels <= 0:
+            return
+        enface = self.preview_enface.value
+        volume = f.angio if f.angio is not None else f.rr
+        projection = f.proj[0, PROJECTION_MAX] if f.angio is None and f.proj is not None else None
+        index = min(self.preview_slice.value, np.shape(volume)[0 if enface else 2] - 1)  # The crop may have changed
+        if self._preview_renderer is None:
+            self._preview_renderer = SliceRenderer()
+        image = self._preview_renderer.preview(volume, enface, index, pixels, self.preview_db.value, projection)
+        f.preview = self.preview_buffer.claim(np.shape(image))
+        np.copyto(f.preview, image)
+        f.preview_view = self.preview_view_buffer.claim([2])
+        f.preview_view[:] = [enface, index]
+
+    def _save(self, volume, writer=None):
+        """
+        Hands a volume to the writer, counting it as unsaved if the writer has no room for it
+        :param writer: StripedNpyWriter of the channel the volume belongs to. The volume writer if None
+        """
+        if writer is None:
+            writer = self._writer
+        if not writer.enqueue(volume[np.newaxis], timeout=WRITER_TIMEOUT_SEC):
+            print(type(self).__name__ + ': writer is behind! Volume was not saved...')
+            with self.unsaved_frames.get_lock():
+                self.unsaved_frames.value += 1
 
     def _copy_params_from_msg(self, message):
         self.niconfig = message.niconfig
@@ -487,8 +1348,21 @@ class OCTAControlProcess(NIOCTControlProcess):
         self.oct = message.oct
         self.writer = message.writer
         self.halfwidth = int(self.oct.aline_size / 2 + 1)
+        if self.oct.resampling is None:
+            self.oct.lambda_data = None  # Spectra are processed as linear in k, natively and in Python
+        elif self.oct.lambda_range is not None:
+            # The table is built here the first time a calibration is used, then loaded by the other processes
+            table = get_default_cache().get_for_range(self.oct.lambda_range, self.oct.aline_size, self.oct.resampling)
+            self.oct.lambda_data = table.lambda_data
         self._tmp_buffer = np.empty(self.halfwidth * self.oct.alines_per_bline * self.oct.number_of_blines,
                                     dtype=np.complex64)
+        self._display_processor = None  # Replanned with the new parameters when next needed
+        self._assembler = None
+        if self.oct.slabs and len(self.oct.slabs) > self._max_slabs:
+            print(type(self).__name__ + ': only the first', self._max_slabs, 'slabs are projected')
+        if self.oct.angiography is not None and not self._angio_allocated:
+            self._report_error('Controller was started without room for angiograms; ' + str(self.oct.angiography) +
+                               ' is not computed')
         print("OCTAControlProcess: all params updated...")
 
     def _buffer_scan_samples(self):
@@ -503,29 +1377,15 @@ class OCTAControlProcess(NIOCTControlProcess):
             return
 
     def _init_hardware_interface(self):
+        """
+        :return: False if the IMAQ interface could not allocate its buffers
+        """
         # Initialize DAQmx interface
-
-        self._scan_task = nidaqmx.Task()
-        self._scan_timing = nidaqmx.task.Timing(self._scan_task)
-        dac_name = self.niconfig.dac_device
-        dac_ao_channel_ids = [
-            dac_name + '/' + self.niconfig.line_trig_ch,
-            dac_name + '/' + self.niconfig.frame_trig_ch,
-            dac_name + '/' + self.niconfig.x_ch,
-            dac_name + '/' + self.niconfig.y_ch
-        ]
-        for ch_name in dac_ao_channel_ids:
-            self._scan_task.ao_channels.add_ao_voltage_chan(ch_name)
-
-        self._scan_task.timing.cfg_samp_clk_timing(self.niconfig.dac_rate,  # TODO move?
-                                                   source="",
-                                                   active_edge=Edge.RISING,
-                                                   sample_mode=AcquisitionType.CONTINUOUS)
-        self._scan_task.regen_mode = nidaqmx.constants.RegenerationMode.DONT_ALLOW_REGENERATION  # TODO test
-        self._scan_writer = AnalogMultiChannelWriter(self._scan_task.out_stream)
+        self._open_backend()
+        self._init_scan_task()
 
         # Initialize IMAQ interface
-        PyIMAQ.imgOpen(self.niconfig.cam_device)
+        self._imaq.imgOpen(self.niconfig.cam_device)
         if self.frame_buffer_mode:
             if self.oct.number_of_blines > 512:
                 self.niconfig.number_of_imaq_buffers = 1
@@ -533,10 +1393,176 @@ class OCTAControlProcess(NIOCTControlProcess):
                 self.niconfig.number_of_imaq_buffers = 1
             elif self.oct.number_of_blines > 128:
                 self.niconfig.number_of_imaq_buffers = 1
-            PyIMAQ.imgSetAttributeROI(0, 0, self.oct.alines_per_bline, self.oct.aline_size)
-            PyIMAQ.imgConfigTrigBufferListWithTTL1(timeout=1000)
-            PyIMAQ.imgInitBuffer(self.oct.number_of_blines * self.niconfig.number_of_imaq_buffers)
+            self._imaq.imgSetAttributeROI(0, 0, self.oct.alines_per_bline, self.oct.aline_size)
+            self._imaq.imgConfigTrigBufferListWithTTL1(timeout=1000)
+            rval = self._imaq.imgInitBuffer(self.oct.number_of_blines * self.niconfig.number_of_imaq_buffers)
         else:
-            PyIMAQ.imgSetAttributeROI(0, 0, self.oct.alines_per_buffer, self.oct.aline_size)
-            PyIMAQ.imgConfigTrigBufferWithTTL1(timeout=1000)
-            PyIMAQ.imgInitBuffer(self.niconfig.number_of_imaq_buffers)
+            self._imaq.imgSetAttributeROI(0, 0, self.oct.alines_per_buffer, self.oct.aline_size)
+            self._imaq.imgConfigTrigBufferWithTTL1(timeout=1000)
+            rval = self._imaq.imgInitBuffer(self.niconfig.number_of_imaq_buffers)
+        return rval != -1
+
+
+class MotionOCTControlProcess(OCTAControlProcess):
+    """
+    OCTAControlProcess which also estimates the motion between the B-scans of each volume by phase correlation, as
+    configured by MotionOCTMessage. The estimates of each frame are published with it as MotionOCTFrame.mot
+    """
+
+    MESSAGE_TYPES = (OCTAMessage, MotionOCTMessage)
+    FRAME_TYPE = MotionOCTFrame
+
+    def __init__(self, exit_event, aline_size, alines_per_bline, number_of_blines, frame_buffer_max=4, **kwargs):
+        """
+        :param kwargs: As OCTAControlProcess
+        """
+        super(MotionOCTControlProcess, self).__init__(exit_event, aline_size, alines_per_bline, number_of_blines,
+                                                      frame_buffer_max=frame_buffer_max, **kwargs)
+        self.name = "Motion OCT Control Process"
+
+        # Displacements of each frame, committed in step with frame_buffer. Fewer lags and estimates than B-lines
+        self.motion_buffer = SharedCircularBuffer(frame_buffer_max, [number_of_blines, number_of_blines, 2], np.float32)
+        self.motion_latency = mp.Value('d', 0.0)  # Seconds taken to estimate the motion of the last volume
+
+        self.phase_corr_apod_filter_2d = None
+        self.zstart = None
+        self.npeak = DEFAULT_NPEAK
+        self.nrepeat = 1
+        self.time_lags = [1]
+        self._correlator = None  # PhaseCorrelator for the current parameters, or None if they do not fit the volume
+        self._correlator_key = None  # Volume shape and region the correlator was made for
+
+    def recv_msg(self, message):
+        if isinstance(message, MotionOCTMessage) and message.instruction in [INSTR_OPEN, INSTR_UPDATE_ACQ]:
+            self._copy_motion_params_from_msg(message)
+        super(MotionOCTControlProcess, self).recv_msg(message)
+
+    def grab_frame(self, timeout=None, latest=False):
+        f = super(MotionOCTControlProcess, self).grab_frame(timeout, latest)
+        if f is not None:
+            f.mot, _ = self.motion_buffer.examine(f.index)
+            if f.mot is not None and f.mot.size == 0:  # No estimate for this frame
+                f.mot = None
+        return f
+
+    def release_frame(self):
+        self.motion_buffer.release()
+        return super(MotionOCTControlProcess, self).release_frame()
+
+    def publish_frame(self, f):
+        if f.mot is None:
+            self.motion_buffer.claim([0, 0, 0])  # Keeps the estimates numbered the same as the frames
+        self.motion_buffer.commit()  # Before the frame, so that the estimates are there when the frame is grabbed
+        return super(MotionOCTControlProcess, self).publish_frame(f)
+
+    def acquire_frame(self):
+        f = super(MotionOCTControlProcess, self).acquire_frame()
+        if f is not None:
+            t0 = time.perf_counter()
+            f.mot = self._estimate_motion(f.rr)
+            self.motion_latency.value = time.perf_counter() - t0
+        return f
+
+    def _estimate_motion(self, volume):
+        """
+        Estimates the displacements between the B-scans of a volume into the next slot of motion_buffer
+        :param volume: Cropped volume, (z, A-lines, B-lines)
+        :return: The displacements, (time lags, estimates, [z, x]) in pixels, or None if they cannot be estimated
+        """
+        ztop = self.oct.ztop
+        z0 = 0 if self.zstart is None else max(0, self.zstart - ztop)
+        if self.phase_corr_apod_filter_2d is not None:
+            z = np.shape(self.phase_corr_apod_filter_2d)[0]
+        else:
+            z = np.shape(volume)[0] - z0
+        key = (tuple(np.shape(volume)), z0, z)
+        if key != self._correlator_key:
+            self._correlator_key = key
+            self._correlator = None
+            if z < 1 or z0 + z > np.shape(volume)[0]:
+                print(type(self).__name__ + ': motion region', [ztop + z0, ztop + z0 + z], 'is outside of the volume')
+                return None
+            try:
+                self._correlator = PhaseCorrelator(np.shape(volume)[2], z, np.shape(volume)[1], self.time_lags,
+                                                   apod_filter=self.phase_corr_apod_filter_2d, npeak=self.npeak,
+                                                   nrepeat=self.nrepeat)
+            except ValueError as e:
+                print(type(self).__name__ + ': cannot estimate motion:', e)
+                return None
+        if self._correlator is None:
+            return None
+        bscans = volume[z0:z0 + z].transpose(2, 0, 1)
+        return self._correlator.estimate(bscans, out=self.motion_buffer.claim(self._correlator.shape))
+
+    def _copy_motion_params_from_msg(self, message):
+        self.phase_corr_apod_filter_2d = message.phase_corr_apod_filter_2d
+        self.zstart = message.zstart
+        self.npeak = message.npeak if message.npeak is not None else DEFAULT_NPEAK
+        self.nrepeat = message.nrepeat if message.nrepeat is not None else 1
+        self.time_lags = message.time_lags if message.time_lags is not None else [1]
+        self._correlator = None
+        self._correlator_key = None  # Replanned with the new parameters when next needed
+
+
+if __name__ == "__main__":
+
+    # Benchmark of the crop and reshape done by acquire_frame: the original per A-line loop vs. crop_alines
+    ALINE_SIZE = 2048
+    HALFWIDTH = int(ALINE_SIZE / 2 + 1)
+    ZTOP, ZBOTTOM = 20, 420
+    REPEATS = 3
+
+    for alines, blines in [[64, 64], [128, 128], [256, 256], [512, 256]]:
+        tmp = (np.random.random(HALFWIDTH * alines * blines) + 1j).astype(np.complex64)
+        out = np.empty([ZBOTTOM - ZTOP, alines, blines], dtype=np.complex64)
+
+        t = time.perf_counter()
+        for _ in range(REPEATS):
+            seek = 0
+            for j in range(blines):
+                for i in range(alines):
+                    out[:, i, j] = tmp[HALFWIDTH * seek:HALFWIDTH * seek + HALFWIDTH][ZTOP:ZBOTTOM]
+                    seek += 1
+        t_loop = (time.perf_counter() - t) / REPEATS
+        expected = out.copy()
+
+        t = time.perf_counter()
+        for _ in range(REPEATS):
+            crop_alines(tmp, out, HALFWIDTH, ZTOP, ZBOTTOM)
+        t_vec = (time.perf_counter() - t) / REPEATS
+
+        assert np.array_equal(out, expected)
+        print('{}x{}: loop {:.2f} ms/volume, strided {:.2f} ms/volume, {:.1f}x'.format(
+            alines, blines, t_loop * 1000, t_vec * 1000, t_loop / t_vec))
+
+    # Volumes published per second by a controller process on the unthrottled simulated backend, counted as the GUI
+    # sees them, with the grab, crop and publish stages in turn and pipelined. Each volume is previewed, as for the GUI
+    DURATION = 10
+    msg = OCTAMessage(INSTR_OPEN)
+    msg.niconfig.backend = BACKEND_SIMULATED
+    msg.niconfig.line_rate = None
+    msg.niconfig.number_of_imaq_buffers = 1
+    msg.oct.aline_size = ALINE_SIZE
+    msg.oct.alines_per_bline = 256
+    msg.oct.number_of_blines = 256
+    msg.oct.alines_per_buffer = 256 * 256
+    msg.oct.ztop, msg.oct.zbottom = ZTOP, ZBOTTOM
+    msg.oct.apod_window = np.hanning(ALINE_SIZE).astype(np.float32)
+    for pipelined in [False, True]:
+        exit_event = mp.Event()
+        controller = OCTAControlProcess(exit_event, ALINE_SIZE, 256, 256, pipelined=pipelined)
+        controller.start()
+        controller.set_preview(False, 128, True, 512)
+        controller.send_msg(msg)
+        controller.send_msg(OCTAMessage(INSTR_START_ACQ))
+        controller.grab_frame(timeout=30)  # Once the interface is open and scanning
+        controller.release_frame()
+        first = controller.frame_buffer.count()
+        time.sleep(DURATION)
+        published = controller.frame_buffer.count() - first
+        controller.send_msg(OCTAMessage(INSTR_CLOSE))
+        exit_event.set()
+        controller.join()
+        del controller  # Frees the shared buffers before the next controller allocates its own
+        print('256x256 volumes, {}: {:.2f} ms/volume'.format('pipelined' if pipelined else 'sequential',
+                                                            DURATION / published * 1000))
@@ -0,0 +1,170 @@
+import time
+import numpy as np
+
+from Projection import PROJECTION_CHUNK
+
+DB_DYNAMIC_RANGE = 60  # dB below the brightest pixel of an image which are displayed, the rest is black
+LUT_MANTISSA_BITS = 7  # float32 mantissa bits indexing the dB lookup table: steps of 20 * log10(1 + 2**-7) = 0.07 dB
+LUT_SHIFT = 23 - LUT_MANTISSA_BITS  # Right shift of the bits of a non-negative float32 to its index in the table
+PREVIEW_MIP = -1  # Slice index of a preview which is the maximum intensity projection of the orientation
+
+
+def decimation(shape, max_pixels):
+    """
+    :return: Smallest integer factor along each axis of an image of shape which leaves at most max_pixels
+    """
+    return [max(1, -(-int(n) // int(max_pixels))) for n in shape]
+
+
+def db_table(mantissa_bits=LUT_MANTISSA_BITS):
+    """
+    :return: 20 * log10(x) at the center of each bin of non-negative float32 x, indexed by the bits of x shifted right
+    by 23 - mantissa_bits
+    """
+    shift = 23 - mantissa_bits
+    bits = (np.arange(2 ** (8 + mantissa_bits), dtype=np.uint64) << shift) | (1 << (shift - 1))
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        return 20 * np.log10(bits.astype(np.uint32).view(np.float32).astype(np.float64))
+
+
+class SliceRenderer:
+    """
+    Converts the 2-D slice or projection of a volume which is displayed to uint8, without touching the rest of the
+    volume. Magnitudes are mapped to dB through a lookup table indexed by the bits of each float32, so no logarithms
+    are taken per pixel. The output and scratch buffers are reused from frame to frame.
+    """
+
+    def __init__(self, db_range=DB_DYNAMIC_RANGE):
+        """
+        :param db_range: dB below the brightest pixel of each image which are displayed
+        """
+        self.db_range = db_range
+        self._db = db_table()  # dB of each bin
+        self._lut = np.zeros(len(self._db), dtype=np.uint8)  # Display value of each bin for the levels in use
+        self._lut_top = None  # Top of the dB levels the LUT was built for
+        self._magnitude = None
+        self._index = None
+        self._out = None
+        self._projection = None
+        self._chunk = None
+        self._block = None  # |Re| of the part of an image which is decimated
+        self._decimated = None
+
+    def project(self, volume, axis):
+        """
+        :param volume: Complex or real volume, (z, A-lines, B-lines)
+        :param axis: Axis projected, 0 or 2
+        :return: Maximum of |volume| along axis, as SlabProjector projects on the controller. Valid until the next call
+        """
+        shape = list(np.shape(volume))
+        del shape[axis]
+        if self._projection is None or list(self._projection.shape) != shape:
+            self._projection = np.empty(shape, dtype=np.float32)
+        # |volume| of a few depths at a time in a small buffer, rather than of the whole volume at once
+        depths = max(1, PROJECTION_CHUNK // (volume.shape[1] * volume.shape[2]))
+        if self._chunk is None or list(self._chunk.shape[1:]) != list(volume.shape[1:]) or len(self._chunk) != depths:
+            self._chunk = np.empty([depths] + list(volume.shape[1:]), dtype=np.float32)
+        if axis == 0:
+            self._projection[:] = 0
+        for z in range(0, volume.shape[0], depths):
+            chunk = self._chunk[:min(depths, len(volume) - z)]
+            np.abs(volume[z:z + len(chunk)], out=chunk)
+            if axis == 0:
+                np.maximum(self._projection, np.max(chunk, axis=0), out=self._projection)
+            else:
+                np.max(chunk, axis=axis, out=self._projection[z:z + len(chunk)])
+        return self._projection
+
+    def preview(self, volume, enface, index, max_pixels, db=True, projection=None):
+        """
+        Renders a slice or MIP of a volume decimated to the size it is displayed at. Each displayed pixel is the
+        maximum of the block of pixels it covers, so that sparse bright features are not lost
+        :param volume: Complex or real volume, (z, A-lines, B-lines)
+        :param enface: If True, the slice is en face (A-lines, B-lines), else a B-scan (z, A-lines)
+        :param index: Index of the slice, or PREVIEW_MIP
+        :param max_pixels: Most pixels of the preview along each axis
+        :param projection: Axial MIP of the volume, (A-lines, B-lines), used for en face MIPs if not None
+        :return: uint8 image, as render. Valid until the next call
+        """
+        if enface and index == PREVIEW_MIP:
+            image = projection if projection is not None else self.project(volume, 0)
+        elif enface:
+            image = volume[index, :, :]
+        elif index == PREVIEW_MIP:
+            image = self.project(volume, 2)
+        else:
+            image = volume[:, :, index]
+        fy, fx = decimation(np.shape(image), max_pixels)
+        if fy > 1 or fx > 1:
+            ny, nx = np.shape(image)[0] // fy, np.shape(image)[1] // fx
+            if self._decimated is None or self._decimated.shape != (ny, nx) or self._block.shape != (ny * fy, nx * fx):
+                self._block = np.empty([ny * fy, nx * fx], dtype=np.float32)
+                self._decimated = np.empty([ny, nx], dtype=np.float32)
+            np.abs(np.real(image[:ny * fy, :nx * fx]), out=self._block)
+            image = np.max(self._block.reshape(ny, fy, nx, fx), axis=(1, 3), out=self._decimated)
+        return self.render(image, db)
+
+    def render(self, image, db=True):
+        """
+        :param image: 2-D complex or real array, such as a slice of a volume or a projection. May be a strided view
+        :param db: If True, |Re(image)| is displayed in dB, else linearly
+        :return: uint8 image, 0 to 255 from the bottom to the top of the levels. Valid until the next call
+        """
+        shape = np.shape(image)
+        if self._out is None or self._out.shape != shape:
+            self._magnitude = np.empty(shape, dtype=np.float32)
+            self._index = np.empty(shape, dtype=np.uint32)
+            self._out = np.empty(shape, dtype=np.uint8)
+        np.abs(np.real(image), out=self._magnitude)
+        top = float(np.max(self._magnitude))
+        if not top > 0:
+            self._out[:] = 0
+            return self._out
+        if db:
+            top = np.ceil(20 * np.log10(top))
+            if top != self._lut_top:  # Levels have changed by at least 1 dB
+                levels = (self._db - (top - self.db_range)) * (255 / self.db_range)
+                np.copyto(self._lut, np.clip(np.nan_to_num(levels, neginf=0, posinf=255), 0, 255), casting='unsafe')
+                self._lut_top = top
+            np.right_shift(self._magnitude.view(np.uint32), LUT_SHIFT, out=self._index)
+            np.take(self._lut, self._index, out=self._out)
+        else:
+            self._magnitude *= 255 / top
+            np.copyto(self._out, self._magnitude, casting='unsafe')
+        return self._out
+
+
+if __name__ == "__main__":
+
+    # Time displaying one B-scan and one MIP of a volume, as BScanView3D used to (convert the whole volume, then slice)
+    # and slice first
+
+    Z, ALINES, BLINES = 400, 256, 256
+    REPEATS = 5
+
+    rng = np.random.default_rng(0)
+    volume = (rng.standard_normal((Z, ALINES, BLINES)) * 1000 + 1j).astype(np.complex64)
+    renderer = SliceRenderer()
+
+    t0 = time.perf_counter()
+    for i in range(REPEATS):
+        frame = 20 * np.log10(np.abs(np.real(volume)))
+        old_slice = frame[:, :, BLINES // 2]
+        old_mip = np.max(frame, axis=2)
+    t_old = (time.perf_counter() - t0) / REPEATS
+
+    t0 = time.perf_counter()
+    for i in range(REPEATS):
+        new_slice = renderer.render(volume[:, :, BLINES // 2]).copy()
+    t_slice = (time.perf_counter() - t0) / REPEATS
+    t0 = time.perf_counter()
+    for i in range(REPEATS):
+        new_mip = renderer.render(renderer.project(volume, 2)).copy()
+    t_mip = (time.perf_counter() - t0) / REPEATS
+
+    # The LUT is within one display level of converting each pixel exactly
+    top = np.ceil(np.max(old_slice))
+    exact = np.clip((old_slice - (top - DB_DYNAMIC_RANGE)) * 255 / DB_DYNAMIC_RANGE, 0, 255).astype(np.uint8)
+    print('Whole volume then slice and MIP: %.1f ms' % (t_old * 1000))
+    print('Slice first: %.2f ms, MIP: %.1f ms' % (t_slice * 1000, t_mip * 1000))
+    print('Largest difference from exact dB conversion:', int(np.max(np.abs(exact.astype(int) - new_slice))), 'levels')
@@ -0,0 +1,221 @@
+import time
+import os
+import pickle
+import numpy as np
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".pyimageoct")  # Where plans and tables persist between sessions
+WISDOM_PATH = os.path.join(CONFIG_DIR, "fftw_wisdom.pickle")
+
+BACKEND_NUMPY = "numpy"
+BACKEND_PYFFTW = "pyfftw"
+DEFAULT_BACKEND = BACKEND_PYFFTW if pyfftw is not None else BACKEND_NUMPY
+FFTW_FLAGS = ("FFTW_MEASURE",)
+
+try:
+    np.fft.rfft(np.zeros(2, dtype=np.float32), out=np.zeros(2, dtype=np.complex64))
+    RFFT_OUT = True  # NumPy >= 2.0 transforms float32 in single precision, directly into out
+except TypeError:
+    RFFT_OUT = False
+
+
+class NumpyRFFT:
+    """
+    Real FFT, or its inverse, of arrays of one shape along one or more axes with numpy.fft
+    """
+
+    def __init__(self, shape, dtype, axes, inverse=False):
+        """
+        :param shape: Shape of the real array
+        :param dtype: dtype of the real array
+        :param axes: Axes transformed. The last is halved by the real transform
+        :param inverse: If True, the plan transforms complex arrays back to real arrays of shape
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.axes = tuple(axes)
+        self.inverse = inverse
+        self._s = [self.shape[axis] for axis in self.axes]
+
+    def __call__(self, a, out):
+        """
+        :param a: Real array of the plan's shape, or the complex half spectrum if inverse
+        :param out: Array to write the transform to
+        :return: out
+        """
+        if self.inverse:
+            if RFFT_OUT:
+                np.fft.irfftn(a, s=self._s, axes=self.axes, out=out)
+            else:
+                out[:] = np.fft.irfftn(a, s=self._s, axes=self.axes)
+        elif RFFT_OUT:
+            np.fft.rfftn(a, axes=self.axes, out=out)
+        else:
+            out[:] = np.fft.rfftn(a, axes=self.axes)
+        return out
+
+
+class PyfftwRFFT:
+    """
+    Real FFT, or its inverse, of arrays of one shape along one or more axes with a multithreaded FFTW plan
+    """
+
+    def __init__(self, shape, dtype, axes, threads, inverse=False):
+        """
+        :param shape: Shape of the real array
+        :param dtype: dtype of the real array
+        :param axes: Axes transformed. The last is halved by the real transform
+        :param threads: Threads used by the plan
+        :param inverse: If True, the plan transforms complex arrays back to real arrays of shape
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.axes = tuple(axes)
+        self.inverse = inverse
+        complex_dtype = np.result_type(self.dtype, np.complex64)
+        half_shape = list(self.shape)
+        half_shape[self.axes[-1]] = half_shape[self.axes[-1]] // 2 + 1
+        if inverse:
+            self._in = pyfftw.empty_aligned(half_shape, dtype=complex_dtype)
+            self._out = pyfftw.empty_aligned(self.shape, dtype=self.dtype)
+            direction = "FFTW_BACKWARD"
+        else:
+            self._in = pyfftw.empty_aligned(self.shape, dtype=self.dtype)
+            self._out = pyfftw.empty_aligned(half_shape, dtype=complex_dtype)
+            direction = "FFTW_FORWARD"
+        self._plan = pyfftw.FFTW(self._in, self._out, axes=self.axes, direction=direction, flags=FFTW_FLAGS,
+                                 threads=threads)
+
+    def __call__(self, a, out):
+        # FFTW copies a into its own array if it is not suitably aligned, but must write to an aligned output
+        if out.ctypes.data % self._plan.output_alignment == 0 and out.strides == self._out.strides:
+            self._plan(input_array=a, output_array=out)
+        else:
+            np.copyto(out, self._plan(input_array=a))
+        return out
+
+
+class FFTPlanCache:
+    """
+    Real FFT plans by (shape, dtype, axes, direction). With pyFFTW, plans are made with FFTW_MEASURE and the wisdom
+    gathered is saved to WISDOM_PATH, so the measuring is only done once per machine.
+    """
+
+    def __init__(self, backend=DEFAULT_BACKEND, threads=None, wisdom_path=WISDOM_PATH):
+        """
+        :param backend: BACKEND_PYFFTW or BACKEND_NUMPY. Falls back to BACKEND_NUMPY if pyFFTW is not installed
+        :param threads: Threads used by each FFTW plan. The number of cores if None
+        :param wisdom_path: Where FFTW wisdom is loaded from and saved to. Not persisted if None
+        """
+        if backend == BACKEND_PYFFTW and pyfftw is None:
+            print('FFTPlanCache: pyFFTW is not installed, using NumPy')
+            backend = BACKEND_NUMPY
+        self.backend = backend
+        self._threads = threads if threads is not None else os.cpu_count()
+        self._wisdom_path = wisdom_path
+        self._plans = {}
+        if self.backend == BACKEND_PYFFTW:
+            self._load_wisdom()
+
+    def rfft(self, shape, dtype=np.float32, axis=-1):
+        """
+        :return: Plan, called as plan(a, out), for the real FFT of arrays of shape and dtype along axis
+        """
+        return self._plan(shape, dtype, [axis], False)
+
+    def rfftn(self, shape, dtype=np.float32, axes=(-2, -1)):
+        """
+        :return: Plan, called as plan(a, out), for the real FFT of arrays of shape and dtype over axes
+        """
+        return self._plan(shape, dtype, axes, False)
+
+    def irfftn(self, shape, dtype=np.float32, axes=(-2, -1)):
+        """
+        :param shape: Shape of the real output
+        :return: Plan, called as plan(a, out), for the inverse of rfftn(shape, dtype, axes)
+        """
+        return self._plan(shape, dtype, axes, True)
+
+    def _plan(self, shape, dtype, axes, inverse):
+        axes = tuple(axis % len(shape) for axis in axes)
+        key = (tuple(shape), np.dtype(dtype).str, axes, inverse)
+        if key not in self._plans:
+            if self.backend == BACKEND_PYFFTW:
+                self._plans[key] = PyfftwRFFT(shape, dtype, axes, self._threads, inverse)
+                self._save_wisdom()
+            else:
+                self._plans[key] = NumpyRFFT(shape, dtype, axes, inverse)
+        return self._plans[key]
+
+    def _load_wisdom(self):
+        if self._wisdom_path is None or not os.path.exists(self._wisdom_path):
+            return
+        try:
+            with open(self._wisdom_path, 'rb') as fp:
+                pyfftw.import_wisdom(pickle.load(fp))
+        except (OSError, pickle.UnpicklingError, ValueError, EOFError) as e:
+            print('FFTPlanCache: failed to load wisdom from', self._wisdom_path, e)
+
+    def _save_wisdom(self):
+        if self._wisdom_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._wisdom_path), exist_ok=True)
+            tmp = self._wisdom_path + '.' + str(os.getpid()) + '.tmp'  # Workers may be saving at the same time
+            with open(tmp, 'wb') as fp:
+                pickle.dump(pyfftw.export_wisdom(), fp)
+            os.replace(tmp, self._wisdom_path)
+        except OSError as e:
+            print('FFTPlanCache: failed to save wisdom to', self._wisdom_path, e)
+
+
+_default_caches = {}
+
+
+def get_plan_cache(threads=None):
+    """
+    :param threads: Threads used by each FFTW plan. The number of cores if None
+    :return: The process's FFTPlanCache for the default backend and the number of threads
+    """
+    if threads not in _default_caches:
+        _default_caches[threads] = FFTPlanCache(threads=threads)
+    return _default_caches[threads]
+
+
+if __name__ == "__main__":
+
+    # Compare the backends on batches of 2048-point real FFTs
+
+    ALINE_SIZE = 2048
+    REPEATS = 20
+
+    backends = [BACKEND_NUMPY]
+    if pyfftw is not None:
+        backends.append(BACKEND_PYFFTW)
+    else:
+        print('pyFFTW is not installed; benchmarking NumPy only')
+
+    rng = np.random.default_rng(0)
+    for batch in [64, 256, 1024, 8192]:
+        a = rng.standard_normal((batch, ALINE_SIZE)).astype(np.float32)
+        out = np.empty([batch, ALINE_SIZE // 2 + 1], dtype=np.complex64)
+        reference = None
+        for backend in backends:
+            cache = FFTPlanCache(backend=backend, wisdom_path=None)
+            t0 = time.perf_counter()
+            plan = cache.rfft(a.shape)
+            planned = time.perf_counter() - t0
+            plan(a, out)
+            t0 = time.perf_counter()
+            for i in range(REPEATS):
+                plan(a, out)
+            elapsed = (time.perf_counter() - t0) / REPEATS
+            if reference is None:
+                reference = out.copy()
+            error = np.max(np.abs(out - reference)) / np.max(np.abs(reference))
+            print('Batch of', batch, backend + ':', int(batch / elapsed), 'A-lines/s, planned in',
+                  '%.1f' % (planned * 1000), 'ms, relative difference from numpy', '%.1e' % error)
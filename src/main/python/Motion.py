@@ -0,0 +1,176 @@
+import time
+import numpy as np
+
+from FFT import get_plan_cache
+
+DEFAULT_NPEAK = 3
+EPSILON = 1e-12  # Keeps the normalization of the cross-power spectrum finite where there is no signal
+PEAK_FLOOR = 1e-6  # Samples of the correlation peak are clipped to this fraction of its height before the log
+
+
+def hann_2d(z, alines):
+    """
+    :return: Separable 2-D Hann window, (z, alines), for apodizing B-scans before phase correlation
+    """
+    return np.outer(np.hanning(z), np.hanning(alines)).astype(np.float32)
+
+
+def gaussian_filter_2d(z, alines, width):
+    """
+    :param width: Standard deviation in pixels of the correlation peak the filter shapes
+    :return: Gaussian low-pass, (z, alines // 2 + 1), which apodizes a cross-power spectrum of B-scans (z, alines)
+    """
+    sigma = 1 / (2 * np.pi * width)  # In cycles per pixel
+    fz = np.fft.fftfreq(z)[:, np.newaxis]
+    fx = np.fft.rfftfreq(alines)[np.newaxis, :]
+    return np.exp(-0.5 * (fz ** 2 + fx ** 2) / sigma ** 2).astype(np.float32)
+
+
+def parabola_fit(npeak):
+    """
+    :param npeak: Odd number of samples centered on a peak
+    :return: Sample offsets and the (3, npeak) least squares fit of a parabola a * x**2 + b * x + c to them
+    """
+    offsets = np.arange(npeak) - npeak // 2
+    vandermonde = np.stack([offsets ** 2, offsets, np.ones(npeak)], axis=1).astype(np.float64)
+    return offsets, np.linalg.pinv(vandermonde).astype(np.float32)
+
+
+class PhaseCorrelator:
+    """
+    Displacement between the B-scans of a sequence by 2-D phase correlation. All B-scans are transformed together in
+    one batched FFT. The normalized cross-power spectra of the pairs at every time lag are apodized, averaged over
+    nrepeat consecutive pairs and transformed back together in a second batched FFT. The peak of each correlation
+    surface is then located to a fraction of a pixel by fitting a Gaussian to npeak samples along each axis; the default
+    apodization makes the peak Gaussian and about npeak wide. Buffers and FFT plans are made once, so estimating the
+    motion of a sequence allocates almost nothing.
+    """
+
+    def __init__(self, n, z, alines, time_lags, apod_filter=None, npeak=DEFAULT_NPEAK, nrepeat=1, fft_threads=None):
+        """
+        :param n: Number of B-scans in each sequence
+        :param z: Depth of the region of each B-scan correlated
+        :param alines: A-lines of each B-scan
+        :param time_lags: Lags, in B-scans, between the B-scans of each pair correlated
+        :param apod_filter: Weights, (z, alines // 2 + 1), applied to the cross-power spectra. A Gaussian low-pass
+        matched to npeak if None
+        :param npeak: Width in pixels of the neighborhood of the correlation peak which is fit. Odd, at least 3
+        :param nrepeat: Number of consecutive pairs whose cross-power spectra are averaged for each estimate
+        :param fft_threads: As get_plan_cache
+        """
+        self.n = int(n)
+        self.z = int(z)
+        self.alines = int(alines)
+        self.time_lags = [int(lag) for lag in time_lags]
+        self.npeak = max(3, int(npeak) | 1)  # Odd, so that the fit is centered on the peak
+        self.nrepeat = max(1, int(nrepeat))
+        self.window = hann_2d(self.z, self.alines)
+        if apod_filter is None:
+            apod_filter = gaussian_filter_2d(self.z, self.alines, self.npeak / 3)
+        self.apod_filter = np.asarray(apod_filter, dtype=np.float32)
+        if self.apod_filter.shape != (self.z, self.alines // 2 + 1):
+            raise ValueError('Phase correlation filter of shape ' + str(self.apod_filter.shape) + ' does not match ' +
+                             'B-scans of ' + str(self.z) + ' x ' + str(self.alines))
+        if len(self.time_lags) == 0 or min(self.time_lags) < 1:
+            raise ValueError('Time lags must be at least 1 B-scan, got ' + str(self.time_lags))
+        # Every lag gets the same number of estimates, from the pairs which start in the first n - max lag B-scans
+        self.estimates = (self.n - max(self.time_lags)) // self.nrepeat
+        if self.estimates < 1:
+            raise ValueError('Sequences of ' + str(self.n) + ' B-scans are too short for time lags ' +
+                             str(self.time_lags) + ' averaged over ' + str(self.nrepeat) + ' pairs')
+        self.shape = [len(self.time_lags), self.estimates, 2]  # Shape of the displacements returned by estimate
+
+        half = self.alines // 2 + 1
+        pairs = self.estimates * self.nrepeat
+        surfaces = len(self.time_lags) * self.estimates
+        self._images = np.empty([self.n, self.z, self.alines], dtype=np.float32)
+        self._spectra = np.empty([self.n, self.z, half], dtype=np.complex64)
+        self._magnitude = np.empty([self.n, self.z, half], dtype=np.float32)
+        self._conjugate = np.empty([pairs, self.z, half], dtype=np.complex64)  # Of the earlier B-scan of each pair
+        self._pairs = np.empty([pairs, self.z, half], dtype=np.complex64)  # Cross-power spectra of one lag
+        self._cross = np.empty([surfaces, self.z, half], dtype=np.complex64)  # Averaged, for every lag
+        self._surfaces = np.empty([surfaces, self.z, self.alines], dtype=np.float32)
+        self._rows = np.arange(surfaces)[:, np.newaxis]
+        self._offsets, self._fit = parabola_fit(self.npeak)
+
+        plans = get_plan_cache(fft_threads)
+        self._forward = plans.rfftn(self._images.shape, np.float32, axes=(1, 2))
+        self._inverse = plans.irfftn(self._surfaces.shape, np.float32, axes=(1, 2))
+
+    def estimate(self, bscans, out=None):
+        """
+        :param bscans: Sequence of n B-scans, (n, z, A-lines), complex or magnitude. May be a strided view
+        :param out: float32 array of shape to write to. Allocated if None
+        :return: Displacement of the later B-scan of each pair from the earlier in pixels, (lags, estimates, [z, x])
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+        np.abs(bscans, out=self._images)
+        self._images -= np.mean(self._images, axis=(1, 2), keepdims=True)  # The mean would dominate the correlation
+        self._images *= self.window
+        self._forward(self._images, self._spectra)
+
+        # |F1 F2| = |F1| |F2|, so each spectrum is normalized once rather than each pair
+        np.abs(self._spectra, out=self._magnitude)
+        self._magnitude += EPSILON
+        self._spectra /= self._magnitude
+        pairs = self.estimates * self.nrepeat
+        np.conjugate(self._spectra[:pairs], out=self._conjugate)
+        for k, lag in enumerate(self.time_lags):
+            np.multiply(self._conjugate, self._spectra[lag:lag + pairs], out=self._pairs)
+            np.sum(self._pairs.reshape(self.estimates, self.nrepeat, self.z, -1), axis=1,
+                   out=self._cross[k * self.estimates:(k + 1) * self.estimates])
+        self._cross *= self.apod_filter  # Linear, so filtering after averaging is the same as filtering each pair
+        self._inverse(self._cross, self._surfaces)
+
+        # Integer peak, then a Gaussian (a parabola through the log) of npeak samples along each axis, wrapping around
+        peak = np.argmax(self._surfaces.reshape(len(self._surfaces), -1), axis=1)
+        pz, px = np.divmod(peak, self.alines)
+        height = self._surfaces[self._rows[:, 0], pz, px][:, np.newaxis]
+        z_samples = self._surfaces[self._rows, (pz[:, np.newaxis] + self._offsets) % self.z, px[:, np.newaxis]]
+        x_samples = self._surfaces[self._rows, pz[:, np.newaxis], (px[:, np.newaxis] + self._offsets) % self.alines]
+        displacement = out.reshape(-1, 2)
+        for axis, (samples, integer, size) in enumerate([[z_samples, pz, self.z], [x_samples, px, self.alines]]):
+            samples = np.log(np.maximum(samples, height * PEAK_FLOOR))
+            a, b, _ = self._fit @ samples.T
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fraction = np.where(a < 0, -b / (2 * a), 0)  # No maximum if the parabola opens upward
+            np.clip(fraction, -(self.npeak // 2), self.npeak // 2, out=fraction)
+            shift = integer + fraction
+            displacement[:, axis] = np.where(shift > size / 2, shift - size, shift)
+        return out
+
+
+if __name__ == "__main__":
+
+    # Recover known sub-pixel shifts of a speckle pattern, then time sequences of increasing length
+
+    Z, ALINES = 128, 128
+    LAGS = [1, 2, 3, 4]
+
+    rng = np.random.default_rng(0)
+    speckle = np.abs(rng.standard_normal((2 * Z, 2 * ALINES)) + 1j * rng.standard_normal((2 * Z, 2 * ALINES)))
+    kz = np.fft.fftfreq(2 * Z)[:, np.newaxis]
+    kx = np.fft.fftfreq(2 * ALINES)[np.newaxis, :]
+
+    def shifted(dz, dx):
+        return np.real(np.fft.ifft2(np.fft.fft2(speckle) * np.exp(-2j * np.pi * (kz * dz + kx * dx))))[:Z, :ALINES]
+
+    velocity = [0.3, -0.45]  # Pixels per B-scan
+    sequence = np.stack([shifted(velocity[0] * t, velocity[1] * t) for t in range(16)])
+    correlator = PhaseCorrelator(len(sequence), Z, ALINES, LAGS, npeak=3, nrepeat=2)
+    estimated = correlator.estimate(sequence)
+    for k, lag in enumerate(LAGS):
+        print('Lag', lag, 'expected', [round(v * lag, 3) for v in velocity], 'estimated',
+              np.round(np.mean(estimated[k], axis=0), 3).tolist())
+
+    for n in [16, 64, 256]:
+        bscans = (rng.standard_normal((n, Z, ALINES)) + 1j).astype(np.complex64)
+        correlator = PhaseCorrelator(n, Z, ALINES, LAGS)
+        out = np.empty(correlator.shape, dtype=np.float32)
+        correlator.estimate(bscans, out=out)
+        t0 = time.perf_counter()
+        for i in range(10):
+            correlator.estimate(bscans, out=out)
+        elapsed = (time.perf_counter() - t0) / 10
+        print(n, 'B-scans of', Z, 'x', ALINES, 'at', len(LAGS), 'lags:', '%.1f' % (elapsed * 1000), 'ms')
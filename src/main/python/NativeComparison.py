@@ -0,0 +1,112 @@
+"""
+Compares OCTProcessor against the processing done by the native IMAQ interface, PyIMAQ's octCopyBuffer, on the same
+buffer of spectra. On the rig, record a buffer with
+
+    python NativeComparison.py record native.npz [lambda_min lambda_max]
+
+which saves the raw spectra of one buffer, the spatial A-lines the native interface made of them and the calibration
+they were processed with. Then, on any machine,
+
+    python NativeComparison.py compare native.npz
+
+processes the same spectra with OCTProcessor and reports how many samples are bit-identical and how far the rest are
+from the native output, for each resampling method.
+"""
+import sys
+import numpy as np
+try:
+    from PyIMAQ import PyIMAQ
+except ImportError:
+    PyIMAQ = None
+
+from Processing import OCTProcessor, ResamplingTableCache, METHODS
+
+ALINE_SIZE = 2048
+ALINES = 1024  # A-lines in the buffer recorded
+CAM_DEVICE = 'img1'
+
+
+def record_native(imaq, path, aline_size=ALINE_SIZE, alines=ALINES, lambda_data=None, apod_window=None,
+                  cam_device=CAM_DEVICE):
+    """
+    Acquires one buffer with an IMAQ interface and saves its raw spectra and native output to path
+    :param imaq: PyIMAQ, or a stand-in with the same surface
+    :param lambda_data: Wavelength of each pixel the interface resamples with. None for FFT only
+    :param apod_window: Window the interface applies. None for no apodization
+    :return: Raw spectra, (A-lines, aline_size), and spatial A-lines, (A-lines, aline_size // 2 + 1)
+    """
+    imaq.imgOpen(cam_device)
+    imaq.imgSetAttributeROI(0, 0, alines, aline_size)
+    imaq.imgConfigTrigBufferWithTTL1(timeout=1000)
+    if imaq.imgInitBuffer(1) == -1:
+        raise RuntimeError('IMAQ interface failed to allocate its buffer')
+    kwargs = {}
+    if lambda_data is not None:
+        kwargs['lam'] = lambda_data
+    if apod_window is not None:
+        kwargs['apod'] = apod_window
+    imaq.octPlan(**kwargs)
+    native = np.empty([alines, aline_size // 2 + 1], dtype=np.complex64)
+    imaq.imgStartAcq()
+    try:
+        if imaq.octCopyBuffer(0, native.reshape(-1)) == -1:
+            raise RuntimeError('IMAQ interface failed to copy a buffer')
+    finally:
+        imaq.imgStopAcq()  # So that the spectra read back are of the buffer processed
+    # The native interface gives its spectra DC-subtracted; adding the DC back recovers the integer camera samples
+    dc = np.asarray(imaq.octCopyDCSpectrum(), dtype=np.float32)
+    raw = np.empty([alines, aline_size], dtype=np.uint16)
+    for i in range(alines):
+        raw[i] = np.rint(np.asarray(imaq.octCopySpectrum(i), dtype=np.float32) + dc)
+    imaq.imgClose()
+    np.savez(path, raw=raw, native=native,
+             lambda_data=np.empty(0) if lambda_data is None else np.asarray(lambda_data, dtype=np.float64),
+             apod_window=np.empty(0) if apod_window is None else np.asarray(apod_window, dtype=np.float32))
+    return raw, native
+
+
+def compare_native(raw, native, lambda_data=None, apod_window=None, method=METHODS[0]):
+    """
+    Processes raw spectra with OCTProcessor and compares the result with the native output
+    :return: dict of the fraction of samples bit-identical to native, the largest difference relative to the peak of
+    native and the largest difference in dB where native is within 60 dB of its peak
+    """
+    processor = OCTProcessor(np.shape(raw)[1], lambda_data=lambda_data, apod_window=apod_window, method=method,
+                             cache=ResamplingTableCache(directory=None))
+    ours = processor.process(raw)
+    native = np.asarray(native, dtype=np.complex64)
+    identical = np.mean(ours.view(np.uint32) == native.view(np.uint32))
+    peak = np.max(np.abs(native))
+    error = np.abs(ours - native)
+    signal = np.abs(native) > peak * 10 ** (-60 / 20)
+    db = np.abs(20 * np.log10(np.abs(ours[signal]) + 1e-30) - 20 * np.log10(np.abs(native[signal])))
+    return {
+        "identical": float(identical),
+        "max_relative_error": float(np.max(error) / peak),
+        "max_db_error": float(np.max(db)) if db.size > 0 else 0.0
+    }
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) >= 3 and sys.argv[1] == 'record':
+        if PyIMAQ is None:
+            sys.exit('PyIMAQ is not installed; record on the rig')
+        lam = None
+        if len(sys.argv) >= 5:
+            lam = np.linspace(float(sys.argv[3]), float(sys.argv[4]), ALINE_SIZE)
+        record_native(PyIMAQ, sys.argv[2], lambda_data=lam, apod_window=np.hanning(ALINE_SIZE).astype(np.float32))
+        print('Recorded', sys.argv[2])
+
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'compare':
+        recorded = np.load(sys.argv[2])
+        lam = recorded['lambda_data'] if recorded['lambda_data'].size > 0 else None
+        apod = recorded['apod_window'] if recorded['apod_window'].size > 0 else None
+        for method in (METHODS if lam is not None else METHODS[:1]):
+            result = compare_native(recorded['raw'], recorded['native'], lam, apod, method)
+            print('{}: {:.4%} of samples bit-identical, max error {:.3g} of peak, {:.3f} dB within 60 dB of peak'.format(
+                method if lam is not None else 'no resampling', result["identical"], result["max_relative_error"],
+                result["max_db_error"]))
+
+    else:
+        print(__doc__)
@@ -6,38 +6,295 @@ Created on Mon Oct 19 14:18:42 2020
 """
 import time
 import os
+import json
 import numpy as np
 import multiprocessing as mp
 from queue import Empty, Full
 from ctypes import c_wchar_p, c_char_p
 from pathlib import Path
 from npy_append_array import NpyAppendArray
+from SharedCircularBuffer import SharedSlotPool
+from Container import ContainerWriter, CONTAINER_TYPE
 
 ZPAD = 3  # Number of zeros to use for file names. 3 means max of 999 files
+EXIT_POLL_SEC = 0.1  # Once exiting, the writer stops when nothing more is handed to it within this time
+
+# Sample formats of saved volumes
+ENCODING_COMPLEX64 = "complex64"  # As acquired
+ENCODING_FLOAT32 = "float32"  # Magnitude
+ENCODING_FLOAT16 = "float16"  # Magnitude * scale
+ENCODING_LOG_UINT16 = "log_uint16"  # (20 * log10(magnitude) - offset) * scale
+ENCODING_LOG_UINT8 = "log_uint8"
+ENCODING_RAW_UINT16 = "raw_uint16"  # Camera spectra, (B-lines, A-lines, aline_size), saved instead of processed volumes
+ENCODINGS = [ENCODING_COMPLEX64, ENCODING_FLOAT32, ENCODING_FLOAT16, ENCODING_LOG_UINT16, ENCODING_LOG_UINT8,
+             ENCODING_RAW_UINT16]
+
+FLOAT16_SCALE = 2**-8  # Keeps the magnitude of a 2048 sample, 12-bit A-line within the range of float16
+DB_RANGE = {  # Range in dB spanned by each log encoding
+    ENCODING_LOG_UINT16: [0, 160],
+    ENCODING_LOG_UINT8: [40, 120]
+}
+
+
+class SampleEncoder:
+    """
+    Converts complex64 volumes to a compact sample format for saving, reusing its buffers between volumes of the same
+    shape. The scale and offset needed to decode the samples are given by metadata.
+    """
+
+    def __init__(self, encoding=ENCODING_COMPLEX64, db_range=None):
+        """
+        :param encoding: One of ENCODINGS
+        :param db_range: [min, max] in dB spanned by the log encodings. DB_RANGE of the encoding if None
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError('Unknown sample format ' + str(encoding))
+        self.encoding = encoding
+        self.scale = 1.0
+        self.offset = 0.0
+        if encoding == ENCODING_COMPLEX64:
+            self.dtype = np.dtype(np.complex64)
+        elif encoding == ENCODING_RAW_UINT16:
+            self.dtype = np.dtype(np.uint16)
+        elif encoding == ENCODING_FLOAT32:
+            self.dtype = np.dtype(np.float32)
+        elif encoding == ENCODING_FLOAT16:
+            self.dtype = np.dtype(np.float16)
+            self.scale = FLOAT16_SCALE
+        else:
+            self.dtype = np.dtype(np.uint16 if encoding == ENCODING_LOG_UINT16 else np.uint8)
+            if db_range is None:
+                db_range = DB_RANGE[encoding]
+            self.offset = float(db_range[0])
+            self.scale = np.iinfo(self.dtype).max / float(db_range[1] - db_range[0])
+        self._magnitude = None  # float32 scratch
+        self._out = None
+
+    def encode(self, f):
+        """
+        :param f: complex64 array, or uint16 spectra if the encoding is raw
+        :return: f in the sample format. Valid until the next call
+        """
+        if self.encoding in [ENCODING_COMPLEX64, ENCODING_RAW_UINT16]:
+            return f
+        if self._magnitude is None or np.shape(self._magnitude) != np.shape(f):
+            self._magnitude = np.empty(np.shape(f), dtype=np.float32)
+            self._out = np.empty(np.shape(f), dtype=self.dtype)
+        magnitude = np.abs(f, out=self._magnitude)
+        if self.encoding == ENCODING_FLOAT32:
+            return magnitude
+        if self.encoding == ENCODING_FLOAT16:
+            magnitude *= self.scale
+        else:
+            with np.errstate(divide='ignore'):
+                np.log10(magnitude, out=magnitude)
+            magnitude *= 20
+            magnitude -= self.offset
+            magnitude *= self.scale
+            np.clip(magnitude, 0, np.iinfo(self.dtype).max, out=magnitude)
+            np.rint(magnitude, out=magnitude)
+        np.copyto(self._out, magnitude, casting='unsafe')
+        return self._out
+
+    def decode(self, samples):
+        """
+        :param samples: Array saved in this sample format
+        :return: complex64 and raw samples as they are, else the magnitude as float32
+        """
+        if self.encoding in [ENCODING_COMPLEX64, ENCODING_RAW_UINT16]:
+            return samples
+        magnitude = samples.astype(np.float32) / self.scale
+        if self.encoding in [ENCODING_LOG_UINT16, ENCODING_LOG_UINT8]:
+            magnitude = 10 ** ((magnitude + self.offset) / 20)
+        return magnitude
+
+    def metadata(self):
+        return {
+            "encoding": self.encoding,
+            "dtype": self.dtype.str,
+            "scale": self.scale,
+            "offset": self.offset
+        }
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        encoder = cls(metadata["encoding"])
+        encoder.scale = metadata["scale"]
+        encoder.offset = metadata["offset"]
+        return encoder
+
+
+class AppendFile:
+    """
+    .npy file grown by NpyAppendArray as volumes are appended
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self._max_bytes = max_bytes
+        self._written = 0  # Bytes written to the file
+        self._file = NpyAppendArray(path)
+
+    def full(self, f):
+        """
+        :return: True if f should go to the next file
+        """
+        return self._written > self._max_bytes
+
+    def write(self, f):
+        self._file.append(f)
+        self._written += f.nbytes
+
+    def close(self):
+        del self._file
+
+
+class PreallocatedFile:
+    """
+    .npy file allocated at its full size when it is opened and written through a memory map. Volumes are copied to
+    their index in the mapped region; the header is only rewritten once, if the file is closed before it is full.
+    """
+
+    def __init__(self, path, max_bytes, f):
+        """
+        :param f: First volume that will be written. The file holds as many volumes of this shape as fit in max_bytes
+        """
+        self.path = path
+        self._shape = np.shape(f)[1:]
+        capacity = max(1, int(max_bytes // (np.prod(self._shape) * f.dtype.itemsize)))
+        self._map = np.lib.format.open_memmap(path, mode='w+', dtype=f.dtype, shape=(capacity, *self._shape))
+        self._count = 0  # Volumes written to the file
+
+    def full(self, f):
+        return self._count + len(f) > len(self._map) or np.shape(f)[1:] != self._shape or f.dtype != self._map.dtype
+
+    def write(self, f):
+        self._map[self._count:self._count + len(f)] = f
+        self._count += len(f)
+
+    def close(self):
+        self._map.flush()
+        capacity = len(self._map)
+        offset = self._map.offset
+        dtype = self._map.dtype
+        del self._map
+        if self._count < capacity:
+            finalize_npy(self.path, offset, (self._count, *self._shape), dtype)
+
+
+def finalize_npy(path, offset, shape, dtype):
+    """
+    Rewrites the shape in the header of a preallocated .npy file and truncates the data to that shape. The header keeps
+    its length so that the data does not move.
+    :param offset: Offset of the data in bytes, the length of the existing header
+    """
+    with open(path, 'r+b') as fp:
+        version = np.lib.format.read_magic(fp)
+        prefix = fp.tell() + (2 if version == (1, 0) else 4)  # Magic, version and header length field
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': tuple(shape)})
+        fp.seek(prefix)
+        fp.write((header.ljust(offset - prefix - 1) + '\n').encode('latin1'))
+        fp.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+
+
+class NpyRecording:
+    """
+    Recording saved as a series of .npy files fpath_000.npy, fpath_001.npy... each holding up to max_bytes of volumes
+    """
+
+    def __init__(self, path, max_bytes, preallocate=False):
+        self.path = path
+        self._max_bytes = max_bytes
+        self._preallocate = preallocate
+        self._file = None  # Open file
+        self._number = 0
+
+    def write(self, f, timestamp):
+        if self._file is not None and self._file.full(f):
+            # Start new file if max size is reached
+            self._file.close()
+            self._file = None
+            self._number += 1
+        if self._file is None:
+            path = self.path + '_' + str(self._number).zfill(ZPAD) + ".npy"
+            print("NpyWriterProcess: saving", path)
+            if os.path.exists(path):
+                os.remove(path)  # Delete the file if it exists
+            if self._preallocate:
+                self._file = PreallocatedFile(path, self._max_bytes, f)
+            else:
+                self._file = AppendFile(path, self._max_bytes)
+        self._file.write(f)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            print("NpyWriterProcess: closed", self._file.path)
+            self._file = None
+
 
 class NpyWriterProcess(mp.Process):
     
-    def __init__(self, exit_event):
+    def __init__(self, exit_event, pool):
+        """
+        :param exit_event: Set to stop the writer
+        :param pool: SharedSlotPool through which volumes are handed to the writer. Each slot is recycled once its
+        volume has been copied into the file, which the OS may write to disk later, so the pool's size caps the memory
+        the controller shares with a writer that falls behind. Volumes still in the pool when exit_event is set are
+        written before the writer exits
+        """
         super(NpyWriterProcess, self).__init__()
 
         self.name = "NumPy Writer Process"
 
         self._fpath = None
         self._max_bytes = 0
+        self._preallocate = False
+        self._encoding = ENCODING_COMPLEX64
+        self._type = None
+        self._params = None
         self._cfg_queue = mp.Queue(maxsize=8)  # Buffer of new params
 
-        self._buffer = mp.Queue()  # Buffer of stuff to write
+        self._pool = pool  # Buffer of stuff to write
 
         self._exit_event = exit_event
 
     def get_buffer(self):
-        return self._buffer
+        return self._pool
 
-    def enqueue(self, f):
-        self._buffer.put(f)
+    def enqueue(self, f, timeout=None):
+        """
+        Copies f into a free slot of the pool and hands it to the writer. Waits for a free slot if the writer is behind
+        :param f: Array to append to the open file
+        :param timeout: Seconds to wait for a free slot. Waits indefinitely if None
+        :return: True if f was enqueued, False on timeout
+        """
+        slot = self._pool.claim(np.shape(f), timeout=timeout)
+        if slot is None:
+            return False
+        np.copyto(slot, f)
+        self._pool.submit()
+        return True
+
+    def config(self, fpath, maxsize, preallocate=False, encoding=ENCODING_COMPLEX64, type=None, params=None):
+        """
+        Starts a new recording
+        :param fpath: Path of the recording. Files are named fpath_000.npy, fpath_001.npy...
+        :param maxsize: Size in bytes at which a new file is started
+        :param preallocate: If True, each file is allocated at maxsize up front and written through a memory map
+        :param encoding: Sample format the volumes are converted to by the writer. If not complex64, the scale and
+        offset needed to decode the files are saved to fpath_encoding.json
+        :param type: CONTAINER_TYPE to save a chunked, indexed container instead of .npy files. preallocate is ignored
+        by the container, which is always written sequentially
+        :param params: JSON-serializable acquisition parameters embedded in the container's header
+        """
+        self._cfg_queue.put([str(fpath), int(maxsize), bool(preallocate), str(encoding), type, params], timeout=False)
 
-    def config(self, fpath, maxsize):
-        self._cfg_queue.put([str(fpath), int(maxsize)], timeout=False)
+    def finish(self):
+        """
+        Ends the recording once everything enqueued so far has been written, closing the open file
+        """
+        self._cfg_queue.put([None, self._pool.get_submitted(), False, None, None, None], timeout=False)
 
     def run(self):
         """
@@ -45,44 +302,172 @@ class NpyWriterProcess(mp.Process):
         """
         print('NpyWriterProcess: running PID', os.getpid())
 
-        open_file = None  # Current open file
-        open_path = None  # Current open file path
-        open_index = 0
-        written = 0  # Bytes written to the current file
-
-        while not self._exit_event.is_set() and os.getppid() is not 1:
-            if written > self._max_bytes:
-                # Start new file if max size is reached
-                written = 0
-                open_index += 1
-                open_path = open_path[0:-ZPAD] + str(open_index).zfill(ZPAD)
-                print("NpyWriterProcess: saving", open_path)
-                if os.path.exists(open_path):
-                    os.remove(open_path)  # Delete the file if it exists
-                open_file = NpyAppendArray(open_path + ".npy")
-            try:
-                # Poll config buffer
-                cfg = self._cfg_queue.get(timeout=False)
-                open_index = 0
-                self._fpath = cfg[0] + '_' + str(open_index).zfill(ZPAD)
-                self._max_bytes = cfg[1]
-                written = 0
-
-                # Open new file
-                open_path = self._fpath
-                print("NpyWriterProcess: saving", open_path)
-                if os.path.exists(open_path):
-                    os.remove(open_path)  # Delete the file if it exists
-                open_file = NpyAppendArray(open_path + ".npy")
-
-            except Empty:
-                pass
-            if open_file is not None:
+        recording = None  # NpyRecording or ContainerWriter being saved to
+        encoder = SampleEncoder(self._encoding)
+        last_written = -1  # Number of the last volume taken from the pool
+        finish_after = None  # Close the recording once this many volumes have been written
+        pending_cfg = None  # Next recording, configured before the last one was finished
+
+        while True:
+            # On exit, what was handed to the writer before is written first
+            exiting = self._exit_event.is_set() or os.getppid() == 1
+            cfg = None
+            if pending_cfg is None:
                 try:
-                    f = self._buffer.get(timeout=1)
-                    written += f.nbytes
-                    open_file.append(f)
+                    # Poll config buffer
+                    cfg = self._cfg_queue.get(timeout=False)
+                    if cfg[0] is None:
+                        finish_after = cfg[1]
+                    else:
+                        pending_cfg = cfg
                 except Empty:
                     pass
-        del open_file  # Close the last file
+            if finish_after is not None and last_written + 1 >= finish_after:
+                if recording is not None:
+                    recording.close()
+                    recording = None
+                finish_after = None
+                self._fpath = None  # Wait for the next recording to be configured
+            # Volumes of the last recording still in the pool are written to it, in its encoding, before the next starts
+            if pending_cfg is not None and finish_after is None:
+                if recording is not None:
+                    recording.close()
+                    recording = None
+                self._fpath = pending_cfg[0]
+                self._max_bytes = pending_cfg[1]
+                self._preallocate = pending_cfg[2]
+                self._encoding = pending_cfg[3]
+                self._type = pending_cfg[4]
+                self._params = pending_cfg[5]
+                pending_cfg = None
+                encoder = SampleEncoder(self._encoding)
+                if self._type != CONTAINER_TYPE and self._encoding != ENCODING_COMPLEX64:
+                    with open(self._fpath + '_encoding.json', 'w') as fp:
+                        json.dump(encoder.metadata(), fp)
+            f = None
+            if self._fpath is not None:
+                f, header = self._pool.get(timeout=EXIT_POLL_SEC if exiting else 1)
+                if f is not None:
+                    f = encoder.encode(f)  # Convert to the sample format in the writer, not the acquisition loop
+                    if recording is None:
+                        if self._type == CONTAINER_TYPE:
+                            # Raw spectra are already in the container's B-line major order, as acquired
+                            recording = ContainerWriter(self._fpath, self._max_bytes, encoder.dtype,
+                                                        metadata=encoder.metadata(), params=self._params,
+                                                        bline_major=self._encoding == ENCODING_RAW_UINT16)
+                        else:
+                            recording = NpyRecording(self._fpath, self._max_bytes, self._preallocate)
+                    recording.write(f, header.timestamp)
+                    last_written = header.index
+                    self._pool.recycle(header)  # Bytes are in the file, if not yet on disk; the slot can be reused
+            if exiting and cfg is None and f is None:
+                break
+        if recording is not None:
+            recording.close()  # Close the last file
         print("NpyWriteProcess: exiting...")
+
+
+class StripedNpyWriter:
+    """
+    Stripes consecutive volumes round-robin across one NpyWriterProcess per target, so that recordings spread over
+    several disks are saved at the sum of their rates. Each stripe rolls its files over independently. When there is
+    more than one stripe, a manifest next to the first stripe's files records which stripe each volume went to. It is a
+    JSON object per line: the stripes' paths, then one line appended per volume as it is dispatched, so that the order
+    survives a recording that is never finished.
+    """
+
+    def __init__(self, stripes, shape, dtype, pool_bytes):
+        """
+        :param stripes: Number of targets, each with its own writer process
+        :param shape: Capacity shape of a volume
+        :param dtype: NumPy dtype of the volumes
+        :param pool_bytes: Cap on the memory holding volumes waiting to be written, shared evenly between the stripes
+        """
+        self._exit_event = mp.Event()
+        slot_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        slots = max(1, int(pool_bytes // stripes // slot_bytes))
+        self._writers = []
+        for i in range(stripes):
+            self._writers.append(NpyWriterProcess(self._exit_event, SharedSlotPool(slots, shape, dtype)))
+        self._fpaths = []
+        self._max_bytes = 0
+        self._manifest = None  # Open manifest file of the recording, or None
+        self._volumes = 0  # Volumes of the recording dispatched, including those skipped
+        self._next = 0  # Stripe the next volume goes to
+
+    def start(self):
+        for writer in self._writers:
+            writer.start()
+
+    def get_stripes(self):
+        return len(self._writers)
+
+    def config(self, fpaths, max_bytes, preallocate=False, encoding=ENCODING_COMPLEX64, type=None, params=None):
+        """
+        Starts a new recording
+        :param fpaths: Path of the recording for each stripe, i.e. the same trial name in each target directory
+        :param max_bytes: Size in bytes at which each stripe starts a new file
+        :param preallocate: If True, files are allocated at max_bytes up front and written through a memory map
+        :param encoding: Sample format the writers convert the volumes to
+        :param type: CONTAINER_TYPE to save each stripe as a container instead of .npy files
+        :param params: Acquisition parameters embedded in each container
+        """
+        self._fpaths = [str(fpath) for fpath in fpaths]
+        self._max_bytes = int(max_bytes)
+        for writer, fpath in zip(self._writers, self._fpaths):
+            writer.config(fpath, max_bytes, preallocate, encoding, type, params)
+        self._volumes = 0
+        self._next = 0
+        self._close_manifest()
+        if len(self._writers) > 1:
+            self._manifest = open(self._fpaths[0] + '_manifest.jsonl', 'w')
+            # Files of stripe i are stripes[i] + '_000.npy', '_001.npy'... or its container
+            self._write_manifest({"stripes": self._fpaths, "max_bytes": self._max_bytes})
+
+    def enqueue(self, f, timeout=None):
+        """
+        Hands f to the next stripe's writer. Volumes the writer has no room for are recorded in the manifest with a
+        stripe of null, and the stripe takes the volume after
+        :return: True if f was enqueued, False if that writer had no free slot within timeout
+        """
+        enqueued = self._writers[self._next].enqueue(f, timeout=timeout)
+        # Volume k of the recording is the next unread volume of its stripe
+        self._write_manifest({"volume": self._volumes, "stripe": self._next if enqueued else None})
+        self._volumes += 1
+        if enqueued:
+            self._next = (self._next + 1) % len(self._writers)
+        return enqueued
+
+    def finish(self):
+        """
+        Ends the recording once everything enqueued so far has been written
+        """
+        for writer in self._writers:
+            writer.finish()
+        self._close_manifest()
+
+    def close(self, timeout=2):
+        """
+        Stops the writers, giving them timeout seconds to write the volumes enqueued so far and close their files
+        :return: True if all writers closed safely, False if any had to be terminated
+        """
+        self._close_manifest()
+        self._exit_event.set()
+        safe = True
+        for writer in self._writers:
+            writer.join(timeout=timeout)
+            if writer.is_alive():  # If it's stuck, terminate it
+                writer.terminate()
+                safe = False
+        return safe
+
+    def _write_manifest(self, entry):
+        if self._manifest is None:
+            return
+        self._manifest.write(json.dumps(entry) + '\n')
+        self._manifest.flush()  # Each line is in the file as soon as the volume is dispatched
+
+    def _close_manifest(self):
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
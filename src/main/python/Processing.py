@@ -0,0 +1,318 @@
+import time
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+from FFT import CONFIG_DIR, get_plan_cache
+
+
+# lambda to k resampling methods
+METHOD_LINEAR = "linear"
+METHOD_CUBIC = "cubic"  # Keys cubic convolution, a = -0.5
+METHOD_SINC = "sinc"  # Lanczos windowed sinc
+METHODS = [METHOD_LINEAR, METHOD_CUBIC, METHOD_SINC]
+LANCZOS_A = 4  # Half-width of the windowed sinc in samples
+
+RESAMPLING_CACHE_DIR = os.path.join(CONFIG_DIR, "resampling")
+MAX_CACHED_TABLES = 16  # Tables kept in memory and on disk; the least recently used are evicted
+
+
+def k_linear_positions(lambda_data):
+    """
+    :param lambda_data: Wavelength of each spectrometer pixel
+    :return: Fractional pixel position of each sample of a grid linear in k spanning the same band
+    """
+    k = 2 * np.pi / np.asarray(lambda_data, dtype=np.float64)
+    k_linear = np.linspace(k[0], k[-1], len(k))
+    pixels = np.arange(len(k), dtype=np.float64)
+    if k[0] > k[-1]:  # k decreases with lambda, so interpolate on the reversed grid
+        return np.interp(k_linear, k[::-1], pixels[::-1])
+    return np.interp(k_linear, k, pixels)
+
+
+class ResamplingTable:
+    """
+    Banded resampling matrix from a spectrometer's lambda grid to a grid linear in k. Output sample j is the sum over
+    taps t of weight[t, j] * spectrum[index[t, j]].
+    """
+
+    def __init__(self, lambda_data, method=METHOD_LINEAR, index=None, weight=None):
+        """
+        :param lambda_data: Wavelength of each spectrometer pixel
+        :param method: One of METHODS
+        :param index: (taps, aline_size) source pixels. Built from lambda_data if None
+        :param weight: (taps, aline_size) weights
+        """
+        if method not in METHODS:
+            raise ValueError('Unknown resampling method ' + str(method))
+        self.lambda_data = np.asarray(lambda_data, dtype=np.float64)
+        self.method = method
+        if index is None:
+            index, weight = self._build()
+        self.index = np.asarray(index, dtype=np.intp)
+        self.weight = np.asarray(weight, dtype=np.float32)
+
+    def get_taps(self):
+        return len(self.index)
+
+    def apply(self, spectra, out, scratch):
+        """
+        :param spectra: (A-lines, aline_size) spectra on the lambda grid
+        :param out: Array like spectra to write the resampled spectra to
+        :param scratch: Array like spectra used to accumulate the taps
+        :return: out
+        """
+        # Indices are in range, so 'clip' lets take write to out without buffering
+        np.take(spectra, self.index[0], axis=1, out=out, mode='clip')
+        out *= self.weight[0]
+        for tap in range(1, len(self.index)):
+            np.take(spectra, self.index[tap], axis=1, out=scratch, mode='clip')
+            scratch *= self.weight[tap]
+            out += scratch
+        return out
+
+    def _build(self):
+        n = len(self.lambda_data)
+        x = k_linear_positions(self.lambda_data)
+        if self.method == METHOD_LINEAR:
+            left = np.clip(np.floor(x).astype(np.intp), 0, n - 2)
+            t = x - left
+            return np.stack([left, left + 1]), np.stack([1 - t, t])
+        left = np.floor(x).astype(np.intp)
+        t = x - left
+        if self.method == METHOD_CUBIC:
+            offsets = np.arange(-1, 3)
+            weight = np.stack([
+                ((-0.5 * t + 1.0) * t - 0.5) * t,
+                (1.5 * t - 2.5) * t * t + 1,
+                ((-1.5 * t + 2.0) * t + 0.5) * t,
+                (0.5 * t - 0.5) * t * t
+            ])
+        else:
+            offsets = np.arange(-LANCZOS_A + 1, LANCZOS_A + 1)
+            d = t[None, :] - offsets[:, None]
+            weight = np.sinc(d) * np.sinc(d / LANCZOS_A)
+            weight /= np.sum(weight, axis=0)
+        index = np.clip(left[None, :] + offsets[:, None], 0, n - 1)
+        return index, weight
+
+
+def table_key(lambda_data, method):
+    """
+    :return: Name of the resampling table of a calibration, unique to lambda_data and method
+    """
+    lambda_data = np.ascontiguousarray(lambda_data, dtype=np.float64)
+    digest = hashlib.sha1(lambda_data.tobytes()).hexdigest()[:16]
+    return '_'.join([method, str(len(lambda_data)), '%.3f' % lambda_data[0], '%.3f' % lambda_data[-1], digest])
+
+
+class ResamplingTableCache:
+    """
+    Resampling tables by spectrometer calibration and method. Tables are kept in memory and saved to directory so that
+    they are only built once per calibration, across sessions. The least recently used tables beyond max_tables are
+    evicted from both.
+    """
+
+    def __init__(self, directory=RESAMPLING_CACHE_DIR, max_tables=MAX_CACHED_TABLES):
+        """
+        :param directory: Where tables are saved. If None, tables are only kept in memory
+        :param max_tables: Number of tables to keep
+        """
+        self._directory = directory
+        self._max_tables = max_tables
+        self._tables = OrderedDict()  # Least recently used first
+        if directory is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                print('ResamplingTableCache: cannot save tables to', directory, e)
+                self._directory = None
+
+    def get(self, lambda_data, method=METHOD_LINEAR):
+        """
+        :param lambda_data: Wavelength of each spectrometer pixel
+        :param method: One of METHODS
+        :return: ResamplingTable
+        """
+        key = table_key(lambda_data, method)
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            return self._tables[key]
+        table = self._load(key)
+        if table is None:
+            table = ResamplingTable(lambda_data, method)
+            self._save(key, table)
+        self._tables[key] = table
+        while len(self._tables) > self._max_tables:
+            self._tables.popitem(last=False)
+        return table
+
+    def get_for_range(self, lambda_range, aline_size, method=METHOD_LINEAR):
+        """
+        :param lambda_range: [min, max] wavelength of a spectrometer with linearly spaced pixels
+        :param aline_size: Number of spectrometer pixels
+        """
+        return self.get(np.linspace(lambda_range[0], lambda_range[1], aline_size), method)
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + '.npz')
+
+    def _load(self, key):
+        if self._directory is None or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with np.load(self._path(key)) as saved:
+                table = ResamplingTable(saved['lambda_data'], str(saved['method']), saved['index'], saved['weight'])
+            os.utime(self._path(key))  # Mark as recently used
+            return table
+        except (OSError, KeyError, ValueError) as e:
+            print('ResamplingTableCache: failed to load', self._path(key), e)
+            return None
+
+    def _save(self, key, table):
+        if self._directory is None:
+            return
+        try:
+            # Written in full before it replaces the table, so readers never see part. Named by process, as workers may
+            # be saving the same table at the same time
+            tmp = self._path(key) + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp, 'wb') as fp:
+                np.savez(fp, lambda_data=table.lambda_data, method=table.method,
+                         index=table.index.astype(np.int32), weight=table.weight)
+            os.replace(tmp, self._path(key))
+            saved = sorted((os.path.getmtime(os.path.join(self._directory, name)), name)
+                           for name in os.listdir(self._directory) if name.endswith('.npz'))
+            for mtime, name in saved[:max(0, len(saved) - self._max_tables)]:
+                os.remove(os.path.join(self._directory, name))
+        except OSError as e:
+            print('ResamplingTableCache: failed to save', self._path(key), e)
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """
+    :return: The process's ResamplingTableCache, saving to RESAMPLING_CACHE_DIR
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResamplingTableCache()
+    return _default_cache
+
+
+class OCTProcessor:
+    """
+    SD-OCT processing of batches of raw spectra with NumPy: DC subtraction, lambda to k interpolation, apodization and
+    real FFT. Takes the same inputs as OCTConfig and processes a whole buffer, B-scan or volume of A-lines at a time.
+    The buffers are kept between calls, so nothing is allocated while the batch size stays the same.
+    """
+
+    def __init__(self, aline_size, lambda_data=None, apod_window=None, method=METHOD_LINEAR, cache=None,
+                 fft_threads=None):
+        """
+        :param aline_size: Number of spectrometer pixels
+        :param lambda_data: Wavelength of each pixel. If None, the spectra are assumed to be linear in k
+        :param apod_window: Window multiplied with each spectrum before the FFT. If None, no apodization is done
+        :param method: Resampling method, one of METHODS
+        :param cache: ResamplingTableCache the resampling table is taken from. The process's default cache if None
+        :param fft_threads: Threads used by each FFT if pyFFTW is installed. The number of cores if None
+        """
+        self.aline_size = int(aline_size)
+        self.halfwidth = self.aline_size // 2 + 1
+        self._table = None  # ResamplingTable
+        if lambda_data is not None:
+            if cache is None:
+                cache = get_default_cache()
+            self._table = cache.get(lambda_data, method)
+        self._apod = None
+        if apod_window is not None:
+            self._apod = np.asarray(apod_window, dtype=np.float32)
+        self.dc = np.zeros(self.aline_size, dtype=np.float32)  # Mean spectrum of the last batch
+        self._fft_plans = get_plan_cache(fft_threads)
+
+        # Batch buffers, (A-lines, aline_size)
+        self._spectra = None
+        self._interp = None
+        self._scratch = None
+
+    @classmethod
+    def from_config(cls, oct):
+        """
+        :param oct: OCTConfig
+        """
+        return cls(oct.aline_size, lambda_data=oct.lambda_data, apod_window=oct.apod_window, method=oct.resampling)
+
+    def process(self, raw, out=None):
+        """
+        :param raw: Raw spectra, (..., aline_size)
+        :param out: complex64 array to write the spatial A-lines to, (..., aline_size // 2 + 1). Allocated if None
+        :return: out
+        """
+        raw = np.reshape(raw, (-1, self.aline_size))
+        n = len(raw)
+        if out is None:
+            out = np.empty([n, self.halfwidth], dtype=np.complex64)
+        dst = np.reshape(out, (n, self.halfwidth))  # A view as long as out is contiguous
+        self._allocate(n)
+        spectra = self._spectra[:n]
+        np.copyto(spectra, raw, casting='unsafe')
+        np.mean(spectra, axis=0, out=self.dc)
+        spectra -= self.dc
+        if self._table is not None:
+            spectra = self._table.apply(spectra, self._interp[:n], self._scratch[:n])
+        if self._apod is not None:
+            spectra *= self._apod
+        self._fft_plans.rfft(spectra.shape, spectra.dtype, axis=1)(spectra, dst)
+        return out
+
+    def _allocate(self, n):
+        if self._spectra is None or len(self._spectra) < n:
+            self._spectra = np.empty([n, self.aline_size], dtype=np.float32)
+            if self._table is not None:
+                self._interp = np.empty([n, self.aline_size], dtype=np.float32)
+                self._scratch = np.empty([n, self.aline_size], dtype=np.float32)
+
+
+if __name__ == "__main__":
+
+    # Benchmark processing of B-scans and volumes of 12-bit spectra
+
+    ALINE_SIZE = 2048
+    REPEATS = 10
+
+    lam = np.linspace(1250, 1370, ALINE_SIZE)
+    configurations = [
+        ["FFT only", None, None, METHOD_LINEAR],
+        ["apodization", None, np.hanning(ALINE_SIZE), METHOD_LINEAR],
+        ["linear interpolation and apodization", lam, np.hanning(ALINE_SIZE), METHOD_LINEAR],
+        ["cubic interpolation and apodization", lam, np.hanning(ALINE_SIZE), METHOD_CUBIC],
+        ["sinc interpolation and apodization", lam, np.hanning(ALINE_SIZE), METHOD_SINC]
+    ]
+
+    cache = ResamplingTableCache(directory=None)
+    for method in METHODS:
+        t0 = time.perf_counter()
+        ResamplingTable(lam, method)
+        built = time.perf_counter() - t0
+        cache.get(lam, method)
+        t0 = time.perf_counter()
+        cache.get(lam, method)
+        cached = time.perf_counter() - t0
+        print(method, 'resampling table: built in', '%.2f' % (built * 1000), 'ms, cached in',
+              '%.3f' % (cached * 1000), 'ms')
+
+    rng = np.random.default_rng(0)
+    for batch in [64, 256, 1024, 8192]:
+        raw = rng.integers(0, 4096, size=(batch, ALINE_SIZE), dtype=np.uint16)
+        out = np.empty([batch, ALINE_SIZE // 2 + 1], dtype=np.complex64)
+        for name, lambda_data, apod_window, method in configurations:
+            processor = OCTProcessor(ALINE_SIZE, lambda_data=lambda_data, apod_window=apod_window, method=method,
+                                     cache=cache)
+            processor.process(raw, out)  # Allocate the buffers
+            t0 = time.perf_counter()
+            for i in range(REPEATS):
+                processor.process(raw, out)
+            elapsed = (time.perf_counter() - t0) / REPEATS
+            print('Batch of', batch, 'A-lines,', name + ':', str(int(batch / elapsed)), 'A-lines/s')
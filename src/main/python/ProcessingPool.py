@@ -0,0 +1,285 @@
+import time
+import os
+import ctypes
+import threading
+import numpy as np
+import multiprocessing as mp
+import multiprocessing.sharedctypes
+
+from Angiography import METRICS
+from Assembly import VolumeAssembler
+from Averaging import AVERAGING_MODES
+from Processing import OCTProcessor, METHOD_LINEAR
+
+POOL_TIMEOUT_SEC = 5  # Longest the controller waits for the workers to start or finish a volume
+
+# Job layout, in ints
+JOB_RAW = 0  # Raw buffer to process, 0 or 1
+JOB_ZTOP = 1
+JOB_ZBOTTOM = 2
+JOB_A_REPEAT = 3
+JOB_B_REPEAT = 4
+JOB_AVERAGING = 5  # Index into Averaging.AVERAGING_MODES, or -1 if the repeats are not averaged
+JOB_ANGIOGRAPHY = 6  # Index into Angiography.METRICS, or -1 if there is no angiogram
+JOB_VOLUME_SLOT = 7  # Slot of the frame buffer claimed for the volume
+JOB_ANGIO_SLOT = 8  # Slot of the angio buffer claimed for the angiogram, or -1
+JOB_PROJECTION_SLOT = 9  # Slot of the projection buffer claimed for the projections, or -1
+JOB_SLABS = 10  # Number of slabs, followed by the [start, stop] of each
+JOB_LEN = JOB_SLABS + 1
+
+
+class ProcessingWorker(mp.Process):
+    """
+    Processes one range of B-line locations of each volume handed to a ProcessingPool, assembling them straight into the
+    slots the controller claimed
+    """
+
+    def __init__(self, pool, index):
+        """
+        :param pool: ProcessingPool the worker belongs to
+        :param index: Number of the worker in the pool
+        """
+        super(ProcessingWorker, self).__init__()
+        self.name = "OCT Processing Worker"
+        self._pool = pool
+        self._index = index
+        self.busy = mp.Value(ctypes.c_double, 0.0, lock=False)  # Seconds spent processing
+
+    def run(self):
+        pool = self._pool
+        # The workers already occupy the cores, so each FFT is single-threaded
+        processor = OCTProcessor(pool.aline_size, lambda_data=pool.lambda_data, apod_window=pool.apod_window,
+                                 method=pool.method, fft_threads=1)
+        processed = np.empty([1, pool.alines_per_bline, processor.halfwidth], dtype=np.complex64)
+        job = pool.get_job()
+        assembler = None
+        assembler_key = None
+        while True:
+            try:
+                pool.start_barrier.wait()
+            except threading.BrokenBarrierError:
+                break
+            if pool.exit_event.is_set():
+                break
+            t0 = time.perf_counter()
+            key = list(job[:JOB_VOLUME_SLOT]) + list(job[JOB_SLABS:JOB_SLABS + 1 + 2 * job[JOB_SLABS]])
+            key[JOB_RAW] = 0  # Either raw buffer is assembled alike
+            if key != assembler_key:
+                slabs = job[JOB_SLABS + 1:JOB_SLABS + 1 + 2 * job[JOB_SLABS]].reshape(-1, 2).tolist()
+                averaging, angiography = job[JOB_AVERAGING], job[JOB_ANGIOGRAPHY]
+                assembler = VolumeAssembler(job[JOB_ZBOTTOM] - job[JOB_ZTOP], pool.alines_per_bline,
+                                            pool.number_of_blines, job[JOB_A_REPEAT], job[JOB_B_REPEAT],
+                                            AVERAGING_MODES[averaging] if averaging >= 0 else None,
+                                            METRICS[angiography] if angiography >= 0 else None, slabs)
+                assembler_key = key
+            volume = pool.frame_buffer.get_slot(job[JOB_VOLUME_SLOT], assembler.shape)
+            angio = None
+            if assembler.angio_shape is not None:
+                angio = pool.angio_buffer.get_slot(job[JOB_ANGIO_SLOT], assembler.angio_shape)
+            projection = None
+            if assembler.projection_shape is not None:
+                projection = pool.projection_buffer.get_slot(job[JOB_PROJECTION_SLOT], assembler.projection_shape)
+            raw = pool.get_raw(job[JOB_RAW])
+            ztop, zbottom = job[JOB_ZTOP], job[JOB_ZBOTTOM]
+            # Whole groups of B-line repeats, so that each location is averaged and angiographed by one worker
+            groups = pool.number_of_blines // assembler.b_repeat
+            first = assembler.b_repeat * (groups * self._index // pool.workers)
+            last = assembler.b_repeat * (groups * (self._index + 1) // pool.workers)
+            if self._index == pool.workers - 1:
+                last = pool.number_of_blines
+            for j in range(first, last):
+                processor.process(raw[j], out=processed[0])
+                assembler.add_blines(processed[:, :, ztop:zbottom], j, volume, angio, projection)
+            self.busy.value += time.perf_counter() - t0
+            try:
+                pool.done_barrier.wait()
+            except threading.BrokenBarrierError:
+                break
+
+
+class ProcessingPool:
+    """
+    Processes raw volumes on several cores. Each worker process takes a contiguous range of B-line locations of every
+    volume, reading the raw spectra from shared memory and assembling the cropped volume, and its angiogram and
+    projections, straight into the slots of the controller's shared circular buffers. There are two raw buffers, so
+    that the next volume can be copied into one while the workers process the other. Volumes are processed one at a
+    time, each ending at a barrier, so they come out in the order they went in.
+    """
+
+    def __init__(self, workers, aline_size, alines_per_bline, number_of_blines, frame_buffer, angio_buffer,
+                 projection_buffer, lambda_data=None, apod_window=None, method=METHOD_LINEAR, max_slabs=4):
+        """
+        :param workers: Number of worker processes. No more than one per B-line are started
+        :param frame_buffer: SharedCircularBuffer the volumes are assembled in
+        :param angio_buffer: SharedCircularBuffer the angiograms are computed in
+        :param projection_buffer: SharedCircularBuffer the projections are computed in
+        :param lambda_data: As OCTProcessor
+        :param apod_window: As OCTProcessor
+        :param method: As OCTProcessor
+        :param max_slabs: Most slabs a volume can be projected over
+        """
+        self.aline_size = int(aline_size)
+        self.alines_per_bline = int(alines_per_bline)
+        self.number_of_blines = int(number_of_blines)
+        self.frame_buffer = frame_buffer
+        self.angio_buffer = angio_buffer
+        self.projection_buffer = projection_buffer
+        self.lambda_data = lambda_data
+        self.apod_window = apod_window
+        self.method = method
+        self.max_slabs = int(max_slabs)
+        self.halfwidth = self.aline_size // 2 + 1
+
+        self._raw = [mp.sharedctypes.RawArray(ctypes.c_uint16, self.number_of_blines * self.alines_per_bline *
+                                              self.aline_size) for _ in range(2)]
+        self._job = mp.sharedctypes.RawArray(ctypes.c_int, JOB_LEN + 2 * self.max_slabs)  # Volume being processed
+
+        self.workers = max(1, min(workers, self.number_of_blines))
+        self.exit_event = mp.Event()
+        self.start_barrier = mp.Barrier(self.workers + 1)
+        self.done_barrier = mp.Barrier(self.workers + 1)
+        self._workers = [ProcessingWorker(self, i) for i in range(self.workers)]
+
+        self._t_reset = None  # Time utilization is counted from
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_workers'] = None  # Workers are given the pool, not each other
+        return state
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        self.reset_utilization()
+
+    def get_workers(self):
+        return self.workers
+
+    def get_raw(self, k):
+        """
+        :param k: Raw buffer, 0 or 1
+        :return: Writable view of the raw volume, (B-lines, A-lines, aline_size), to be filled before submit. Not to be
+        written while the workers process it
+        """
+        return np.frombuffer(self._raw[k], dtype=np.uint16).reshape(self.number_of_blines, self.alines_per_bline,
+                                                                    self.aline_size)
+
+    def get_job(self):
+        return np.frombuffer(self._job, dtype=np.intc)
+
+    def submit(self, k, ztop, zbottom, a_repeat=1, b_repeat=1, averaging=None, angiography=None, slabs=None,
+               timeout=POOL_TIMEOUT_SEC):
+        """
+        Starts the workers on raw buffer k, which they assemble into the slots claimed of frame_buffer and, if there are
+        an angiogram and projections, of angio_buffer and projection_buffer. Returns once they have started; call wait
+        before committing the slots or submitting again
+        :param ztop: Top of the crop of each A-line
+        :param zbottom: Bottom of the crop of each A-line
+        :param averaging: As VolumeAssembler
+        :param angiography: As VolumeAssembler
+        :param slabs: As VolumeAssembler. Only the first max_slabs are projected
+        :return: False if the workers did not start in time
+        """
+        slabs = list(slabs or [])[:self.max_slabs]
+        job = self.get_job()
+        job[JOB_RAW] = k
+        job[JOB_ZTOP] = ztop
+        job[JOB_ZBOTTOM] = zbottom
+        job[JOB_A_REPEAT] = a_repeat or 1
+        job[JOB_B_REPEAT] = b_repeat or 1
+        job[JOB_AVERAGING] = AVERAGING_MODES.index(averaging) if averaging is not None else -1
+        job[JOB_ANGIOGRAPHY] = METRICS.index(angiography) if angiography is not None else -1
+        job[JOB_VOLUME_SLOT] = self.frame_buffer.get_claimed()
+        job[JOB_ANGIO_SLOT] = self.angio_buffer.get_claimed()
+        job[JOB_PROJECTION_SLOT] = self.projection_buffer.get_claimed()
+        job[JOB_SLABS] = len(slabs)
+        for i, (start, stop) in enumerate(slabs):
+            job[JOB_SLABS + 1 + 2 * i:JOB_SLABS + 3 + 2 * i] = [start, stop]
+        try:
+            self.start_barrier.wait(timeout=timeout)
+        except threading.BrokenBarrierError:
+            print('ProcessingPool: workers did not start the volume in time')
+            return False
+        return True
+
+    def wait(self, timeout=POOL_TIMEOUT_SEC):
+        """
+        Waits for the workers to finish the volume submitted
+        :return: False if they did not finish in time
+        """
+        try:
+            self.done_barrier.wait(timeout=timeout)
+        except threading.BrokenBarrierError:
+            print('ProcessingPool: workers did not finish the volume in time')
+            return False
+        return True
+
+    def get_utilization(self):
+        """
+        :return: Fraction of the time since the last reset that each worker spent processing
+        """
+        elapsed = time.perf_counter() - self._t_reset
+        return [worker.busy.value / elapsed for worker in self._workers]
+
+    def reset_utilization(self):
+        for worker in self._workers:
+            worker.busy.value = 0.0
+        self._t_reset = time.perf_counter()
+
+    def close(self, timeout=2):
+        """
+        Stops the workers
+        :return: True if all workers exited, False if any had to be terminated
+        """
+        self.exit_event.set()
+        self.start_barrier.abort()
+        self.done_barrier.abort()
+        safe = True
+        for worker in self._workers:
+            worker.join(timeout=timeout)
+            if worker.is_alive():
+                worker.terminate()
+                safe = False
+        return safe
+
+
+if __name__ == "__main__":
+
+    # Benchmark throughput and utilization with increasing numbers of workers, copying the next raw volume into the other
+    # buffer while the workers process one, as the controller does
+
+    from SharedCircularBuffer import SharedCircularBuffer
+
+    ALINE_SIZE = 2048
+    ALINES = 128
+    BLINES = 64
+    ZTOP = 0
+    ZBOTTOM = 400
+    VOLUMES = 8
+
+    lam = np.linspace(1250, 1370, ALINE_SIZE)
+    raw = np.random.default_rng(0).integers(0, 4096, size=(BLINES, ALINES, ALINE_SIZE), dtype=np.uint16)
+    processor = OCTProcessor(ALINE_SIZE, lambda_data=lam, apod_window=np.hanning(ALINE_SIZE))
+    expected = np.stack([processor.process(bline) for bline in raw])  # The DC is subtracted per B-line, as by workers
+    expected = expected[:, :, ZTOP:ZBOTTOM].transpose(2, 1, 0)
+    frames = SharedCircularBuffer(2, [ZBOTTOM - ZTOP, ALINES, BLINES], np.complex64)
+    angiograms = SharedCircularBuffer(2, [1], np.float32)
+    projections = SharedCircularBuffer(2, [1], np.float32)
+    for workers in range(1, os.cpu_count() + 1):
+        pool = ProcessingPool(workers, ALINE_SIZE, ALINES, BLINES, frames, angiograms, projections, lambda_data=lam,
+                              apod_window=np.hanning(ALINE_SIZE))
+        pool.start()
+        np.copyto(pool.get_raw(0), raw)
+        pool.reset_utilization()
+        t0 = time.perf_counter()
+        for i in range(VOLUMES):
+            volume = frames.claim([ZBOTTOM - ZTOP, ALINES, BLINES])
+            pool.submit(i % 2, ZTOP, ZBOTTOM)
+            np.copyto(pool.get_raw(1 - i % 2), raw)  # The next volume
+            pool.wait()
+            frames.commit()
+        elapsed = time.perf_counter() - t0
+        utilization = ', '.join('%.0f%%' % (100 * u) for u in pool.get_utilization())
+        print(workers, 'workers:', int(VOLUMES * ALINES * BLINES / elapsed), 'A-lines/s, utilization', utilization,
+              'matches OCTProcessor:', np.allclose(volume, expected, rtol=1e-4, atol=1e-2))
+        pool.close()
@@ -0,0 +1,123 @@
+import time
+import numpy as np
+
+PROJECTION_MAX = 0  # Index of the maximum intensity projection of each slab
+PROJECTION_MEAN = 1  # Index of the mean intensity projection of each slab
+PROJECTION_CHUNK = 2 ** 20  # Voxels whose magnitude is taken at a time
+
+
+class SlabProjector:
+    """
+    En-face maximum and mean intensity projections of depth slabs of a volume. B-lines can be added one at a time as
+    they are acquired or a whole volume at once; either way the magnitude is taken a chunk at a time in a small
+    preallocated buffer and reduced straight into the 2-D projections, so nothing the size of the volume is allocated.
+    """
+
+    def __init__(self, slabs, alines, blines):
+        """
+        :param slabs: [start, stop] depth of each slab, in pixels from the top of the volume
+        :param alines: A-lines per B-line of the volume
+        :param blines: B-lines of the volume
+        """
+        self.slabs = [[int(start), int(stop)] for start, stop in slabs]
+        for start, stop in self.slabs:
+            if not 0 <= start < stop:
+                raise ValueError('Invalid slab ' + str([start, stop]))
+        self.alines = int(alines)
+        self.blines = int(blines)
+        self.shape = [len(self.slabs), 2, self.alines, self.blines]  # [slab, PROJECTION_MAX or MEAN, A-line, B-line]
+        # Room for the magnitude of a chunk of a volume, or of the thickest slab of a B-line
+        self._chunk = np.empty(max(PROJECTION_CHUNK, self.alines * max(stop - start for start, stop in self.slabs)),
+                               dtype=np.float32)
+        self._reduced = np.empty(self.alines * self.blines, dtype=np.float32)
+
+    def project_blines(self, lines, out, first=0):
+        """
+        Projects consecutive B-lines, as acquired, into their columns of the projections
+        :param lines: Complex B-lines, (n, A-lines, z), each A-line contiguous. May be a view of an acquisition buffer
+        :param out: float32 array of shape the projections are written to
+        :param first: Index of the first B-line in the volume
+        """
+        n, alines, _ = np.shape(lines)
+        # As many B-lines at a time as the magnitude of their thickest slab fits in the chunk
+        step = max(1, len(self._chunk) // (alines * max(stop - start for start, stop in self.slabs)))
+        for i in range(0, n, step):
+            m = min(step, n - i)
+            for k, (start, stop) in enumerate(self.slabs):
+                slab = lines[i:i + m, :, start:stop]
+                if slab.shape[2] == 0:
+                    raise ValueError('Slab ' + str([start, stop]) + ' is outside of the volume')
+                magnitude = np.abs(slab, out=self._chunk[:slab.size].reshape(slab.shape))
+                # Columns of the projections, transposed to the B-line major order of the lines
+                np.max(magnitude, axis=2, out=out[k, PROJECTION_MAX, :, first + i:first + i + m].T)
+                np.mean(magnitude, axis=2, out=out[k, PROJECTION_MEAN, :, first + i:first + i + m].T)
+
+    def project(self, volume, out=None):
+        """
+        :param volume: Complex volume, (z, A-lines, B-lines)
+        :param out: float32 array of shape to write to. Allocated if None
+        :return: The projections, (slabs, [max, mean], A-lines, B-lines)
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+        for k, (start, stop) in enumerate(self.slabs):
+            self._reduce(volume[start:stop], out[k, PROJECTION_MAX], out[k, PROJECTION_MEAN])
+        return out
+
+    def _reduce(self, slab, maximum, mean):
+        """
+        Reduces |slab|, (depth, A-lines, B-lines), over depth into maximum and mean, a few depths at a time
+        """
+        depth, alines, blines = np.shape(slab)
+        if depth == 0:
+            raise ValueError('Slab is outside of the volume')
+        plane = alines * blines
+        depths = max(1, len(self._chunk) // plane)
+        reduced = self._reduced[:plane].reshape(alines, blines)
+        for z in range(0, depth, depths):
+            chunk = self._chunk[:min(depths, depth - z) * plane].reshape(-1, alines, blines)
+            np.abs(slab[z:z + len(chunk)], out=chunk)
+            if z == 0:
+                np.max(chunk, axis=0, out=maximum)
+                np.sum(chunk, axis=0, out=mean)
+            else:
+                np.maximum(maximum, np.max(chunk, axis=0, out=reduced), out=maximum)
+                mean += np.sum(chunk, axis=0, out=reduced)
+        mean *= 1 / depth
+
+
+if __name__ == "__main__":
+
+    # Compare with projecting the magnitude of the whole volume, then time B-line by B-line and whole volume projection
+
+    Z, ALINES, BLINES = 400, 256, 256
+    SLABS = [[0, 400], [50, 150], [150, 300]]
+
+    rng = np.random.default_rng(0)
+    volume = (rng.standard_normal((Z, ALINES, BLINES)) + 1j * rng.standard_normal((Z, ALINES, BLINES))).astype(
+        np.complex64)
+    projector = SlabProjector(SLABS, ALINES, BLINES)
+    out = np.empty(projector.shape, dtype=np.float32)
+
+    t0 = time.perf_counter()
+    magnitude = np.abs(volume)
+    expected = np.stack([[np.max(magnitude[a:b], axis=0), np.mean(magnitude[a:b], axis=0)] for a, b in SLABS])
+    t_direct = time.perf_counter() - t0
+
+    lines = np.ascontiguousarray(volume.transpose(2, 1, 0))  # B-lines as acquired, each A-line contiguous
+    t0 = time.perf_counter()
+    for j in range(BLINES):
+        projector.project_blines(lines[j:j + 1], out, j)
+    t_blines = time.perf_counter() - t0
+    error_blines = np.max(np.abs(out - expected)) / np.max(expected)
+
+    t0 = time.perf_counter()
+    projector.project(volume, out=out)
+    t_volume = time.perf_counter() - t0
+    error_volume = np.max(np.abs(out - expected)) / np.max(expected)
+
+    print('Magnitude of the volume, then projection: %.1f ms' % (t_direct * 1000))
+    print('B-line by B-line: %.1f ms in total, %.3f ms per B-line, relative error %.1e' %
+          (t_blines * 1000, t_blines * 1000 / BLINES, error_blines))
+    print('Whole volume: %.1f ms, relative error %.1e' % (t_volume * 1000, error_volume))
+    print('Projections are', out.nbytes // 1024, 'kB; the volume is', volume.nbytes // 1024, 'kB')
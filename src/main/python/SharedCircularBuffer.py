@@ -1,94 +1,472 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import multiprocessing as mp
+import multiprocessing.sharedctypes
 import ctypes
 import time
 import os
+import threading
+from collections import deque
+from queue import Empty
+
+# Slot header layout, in int64
+HEADER_SEQ = 0  # Sequence number of the slot. Odd while the producer is writing to the slot
+HEADER_INDEX = 1  # Number of the frame in the slot, counted from 0 by the producer. -1 if invalid
+HEADER_TIMESTAMP = 2  # Time the frame was committed in ns since the epoch
+HEADER_NDIM = 3  # Number of dimensions of the frame in the slot
+HEADER_SHAPE = 4  # First of MAX_NDIM dimensions of the frame in the slot
+MAX_NDIM = 4
+HEADER_LEN = HEADER_SHAPE + MAX_NDIM
+
+WAIT_POLL_SEC = 0.001  # Interval at which a waiting reader checks the count, so the producer never notifies anyone
+
+
+class SlotHeader:
+    """
+    Copy of the header of an examined slot
+    """
+    __slots__ = ["index", "timestamp", "shape", "seq", "slot"]
+
+    def __init__(self, index, timestamp, shape, seq, slot=None):
+        self.index = index  # Frame number
+        self.timestamp = timestamp  # Commit time in seconds since the epoch
+        self.shape = shape
+        self.seq = seq
+        self.slot = slot
 
 
 class SharedCircularBuffer:
+    """
+    Ring of preallocated shared memory slots with one producer and any number of readers. The producer fills the next
+    slot in place with claim and commit and never waits for readers. It may claim the slot after next before committing
+    the last, so that one thread can fill a frame while another publishes the one before; frames are committed in the
+    order they were claimed. Readers examine any slot as a read-only NumPy
+    view without locking; each slot has a sequence number (a seqlock) which release checks to tell a reader whether
+    the producer overwrote the slot while it was being read. Nothing is pickled or copied between processes.
+    """
 
     def __init__(self, N, shape, dtype):
-        print("SharedCircularBuffer created!")
+        """
+        :param N: The number of slots in the ring
+        :param shape: Capacity of each slot. Frames of any shape with no more elements than this can be put
+        :param dtype: NumPy dtype of the frames
+        """
         self._n = N  # The number of buffers in the ring
-        self._dim = np.array(shape)  # The shape of each buffer
-        self._dtype = dtype  # The type of the buffer or int bytes
-        self._index = mp.Value('i', 0)  # The index of the next buffer to be put
-        self._acquired = mp.Value('i', -1)  # The index of the currently acquired buffer
-        self._locks = []  # The locks for each buffer in the ring
+        self._dim = np.array(shape)  # The capacity shape of each buffer
+        self._dtype = np.dtype(dtype)  # The type of the buffer
+        self._size = int(np.prod(self._dim))  # Capacity of each buffer in elements
+        # Element 0 is the number of frames committed; the next frame goes to slot count % N. Then a header per slot
+        self._headers = mp.sharedctypes.RawArray(ctypes.c_int64, 1 + N * HEADER_LEN)
         self._ring = []  # Handles for the shared memory for each buffer
         for i in range(N):
-            arr = mp.sharedctypes.RawArray(dtype, 2 * int(np.prod(self._dim)))
-            rlock = mp.RLock()
-            self._ring.append(arr)
-            self._locks.append(rlock)
+            self._ring.append(mp.sharedctypes.RawArray(ctypes.c_byte, self._size * self._dtype.itemsize))
+        for slot in range(N):
+            self._header(slot)[HEADER_INDEX] = -1
+
+        # Process-local state
+        self._views = None  # NumPy views of the shared memory, created on first use in each process
+        self._claimed = deque()  # Slots claimed by this producer and not yet committed, oldest first
+        self._claim_lock = threading.Lock()  # Held by the producer's threads while claiming or committing
+        self._examined = {}  # Slot: sequence number at examine, for each slot examined by this reader
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None  # Views are rebuilt from the shared memory in the receiving process
+        state['_claimed'] = None
+        state['_claim_lock'] = None
+        state['_examined'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._claimed = deque()
+        self._claim_lock = threading.Lock()
+
+    def _slot(self, slot):
+        if self._views is None:
+            self._views = [np.frombuffer(arr, dtype=self._dtype, count=self._size) for arr in self._ring]
+        return self._views[slot]
+
+    def _header(self, slot):
+        return np.frombuffer(self._headers, dtype=np.int64)[1 + slot * HEADER_LEN:1 + (slot + 1) * HEADER_LEN]
+
+    def _count(self):
+        return np.frombuffer(self._headers, dtype=np.int64, count=1)
+
+    def get_capacity(self):
+        return self._dim
+
+    def get_dtype(self):
+        return self._dtype
+
+    def count(self):
+        """
+        :return: The number of frames committed since the buffer was created
+        """
+        return int(self._count()[0])
+
+    # -- Producer ----------------------------------------------------------------------------------------------------
+
+    def claim(self, shape):
+        """
+        Takes the next slot for writing, after any claimed and not yet committed, invalidating the oldest frame. Never
+        blocks
+        :param shape: Shape of the frame that will be written
+        :return: Writable view of the slot with the given shape
+        """
+        size = int(np.prod(shape))
+        if size > self._size or len(shape) > MAX_NDIM:
+            raise ValueError('Frame of shape ' + str(list(shape)) + ' does not fit in slots of ' + str(list(self._dim)))
+        with self._claim_lock:
+            slot = (self.count() + len(self._claimed)) % self._n
+            header = self._header(slot)
+            header[HEADER_SEQ] += 1  # Odd: readers of the old frame will fail to validate
+            header[HEADER_INDEX] = -1
+            header[HEADER_NDIM] = len(shape)
+            header[HEADER_SHAPE:HEADER_SHAPE + len(shape)] = shape
+            self._claimed.append(slot)
+        return self._slot(slot)[:size].reshape(shape)
+
+    def commit(self):
+        """
+        Publishes the oldest claimed slot to readers
+        :return: The number of the committed frame
+        """
+        with self._claim_lock:
+            header = self._header(self._claimed[0])
+            index = self.count()
+            header[HEADER_INDEX] = index
+            header[HEADER_TIMESTAMP] = time.time_ns()
+            header[HEADER_SEQ] += 1  # Even: stable
+            self._count()[0] = index + 1
+            self._claimed.popleft()
+        return index
+
+    def abort(self):
+        """
+        Gives up the most recently claimed slot without publishing it. The slot holds no valid frame afterwards
+        """
+        with self._claim_lock:
+            if len(self._claimed) > 0:
+                self._header(self._claimed.pop())[HEADER_SEQ] += 1
+
+    def get_claimed(self):
+        """
+        :return: Slot most recently claimed by this producer and not yet committed, or -1 if there is none
+        """
+        with self._claim_lock:
+            return self._claimed[-1] if len(self._claimed) > 0 else -1
+
+    def get_slot(self, slot, shape):
+        """
+        Writable view of a slot claimed by the producer, for helper processes which fill it on the producer's behalf.
+        Only the producer commits it
+        :param slot: Slot returned by get_claimed in the producer
+        :param shape: Shape the slot was claimed with
+        """
+        return self._slot(slot)[:int(np.prod(shape))].reshape(shape)
 
     def put(self, array):
-        if self._locks[self._index.value % self._n].acquire(timeout=False):
-            print('Process', os.getpid(), 'wrote to buffer', self._index.value % self._n, flush=True)
-            np.frombuffer(self._ring[self._index.value % self._n])[:] = array
-            self._locks[self._index.value % self._n].release()
-        else:
-            print('Dropped frame! Process', os.getpid(), 'tried to write to buffer', self._index.value % self._n, 'but could not acquire the lock', flush=True)
-            self._acquired.value = -1
-            return -1
-        with self._index.get_lock():
-            self._index.value += 1
-        return self._index.value
+        """
+        Copies array into the next slot
+        :return: The number of the committed frame
+        """
+        np.copyto(self.claim(np.shape(array)), array)
+        return self.commit()
+
+    # -- Readers -----------------------------------------------------------------------------------------------------
+
+    def wait(self, count, timeout=None):
+        """
+        Sleeps until more than count frames have been committed, checking count every WAIT_POLL_SEC. Nothing is shared
+        with the producer but the count, so a reader stalled or killed while waiting cannot hold up acquisition
+        :param count: Number of frames committed already seen by the reader
+        :param timeout: Seconds to wait. Waits indefinitely if None, returns at once if 0
+        :return: True if more than count frames have been committed
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while self.count() <= count:
+            remaining = WAIT_POLL_SEC if deadline is None else min(WAIT_POLL_SEC, deadline - time.perf_counter())
+            if remaining <= 0:
+                return False
+            time.sleep(remaining)
+        return True
 
     def examine(self, index=None):
-        if self._acquired.value == -1:  # Only one buffer can be acquired at a time
-            if index is None:
-                index = (self._index.value - 1) % self._n
-            if self._locks[int(index % self._n)].acquire(timeout=False):
-                print('Process', os.getpid(), 'is examining', index % self._n, flush=True)
-                self._acquired.value = int(index % self._n)
-                return np.frombuffer(self._ring[index % self._n]).reshape(self._dim)
-            else:
-                print('Process', os.getpid(), 'tried to examine buffer', index % self._n, 'but could not acquire the lock', flush=True)
-                self._acquired.value = -1
+        """
+        Gets a frame in place. Does not block or lock: call release when done to find out if the view stayed valid
+        :param index: Number of the frame to examine. The most recent frame if None
+        :return: A read-only view of the frame and a SlotHeader, or None, None if the frame is not in the ring
+        """
+        if index is None:
+            index = self.count() - 1
+        if index < 0:
+            return None, None
+        slot = int(index % self._n)
+        header = self._header(slot)
+        seq = int(header[HEADER_SEQ])
+        if seq % 2 == 1 or header[HEADER_INDEX] != index:  # Being written, overwritten or not yet committed
+            return None, None
+        shape = tuple(int(d) for d in header[HEADER_SHAPE:HEADER_SHAPE + header[HEADER_NDIM]])
+        timestamp = header[HEADER_TIMESTAMP] / 1e9
+        if header[HEADER_SEQ] != seq:  # Header was torn by the producer
+            return None, None
+        self._examined[slot] = seq
+        view = self._slot(slot)[:int(np.prod(shape))].reshape(shape)
+        view.flags.writeable = False
+        return view, SlotHeader(index, timestamp, shape, seq, slot)
+
+    def validate(self, header):
+        """
+        :param header: SlotHeader returned by examine
+        :return: True if the frame has not been overwritten since it was examined
+        """
+        return self._header(int(header.index % self._n))[HEADER_SEQ] == header.seq
+
+    def release(self, header=None):
+        """
+        Finishes reading a frame returned by examine
+        :param header: SlotHeader of the frame. All frames examined by this process if None
+        :return: True if the frame(s) were not overwritten while being read
+        """
+        if header is not None:
+            self._examined.pop(int(header.index % self._n), None)
+            return self.validate(header)
+        valid = True
+        for slot, seq in self._examined.items():
+            valid = valid and self._header(slot)[HEADER_SEQ] == seq
+        self._examined = {}
+        return valid
+
+    def read(self, out, index=None, retries=3):
+        """
+        Copies a frame out of the ring, retrying if the producer overwrites it during the copy
+        :param out: Array with room for the frame
+        :param index: Number of the frame to read. The most recent frame if None
+        :return: SlotHeader of the frame, or None if it could not be read consistently
+        """
+        for _ in range(retries):
+            view, header = self.examine(index)
+            if view is None:
                 return None
-        else:
+            np.copyto(out.reshape(-1)[:view.size], view.ravel())
+            if self.release(header):
+                return header
+        return None
+
+
+class SharedSlotPool:
+    """
+    Fixed set of preallocated shared memory slots handed from one producer to one consumer by reference. A slot is only
+    reused after the consumer recycles it, so the number of slots is a hard cap on memory: once every slot is in use,
+    claim waits for the consumer instead of allocating.
+    """
+
+    def __init__(self, N, shape, dtype):
+        """
+        :param N: The number of slots in the pool
+        :param shape: Capacity of each slot. Frames of any shape with no more elements than this can be submitted
+        :param dtype: NumPy dtype of the frames
+        """
+        self._n = N
+        self._dim = np.array(shape)
+        self._dtype = np.dtype(dtype)
+        self._size = int(np.prod(self._dim))
+        self._headers = mp.sharedctypes.RawArray(ctypes.c_int64, N * HEADER_LEN)
+        self._slots = []
+        for i in range(N):
+            self._slots.append(mp.sharedctypes.RawArray(ctypes.c_byte, self._size * self._dtype.itemsize))
+        self._free = mp.Queue()  # Slots which may be claimed by the producer
+        self._ready = mp.Queue()  # Slots submitted by the producer, in order, waiting for the consumer
+        for slot in range(N):
+            self._free.put(slot)
+
+        # Process-local state
+        self._views = None
+        self._claimed = -1  # Slot claimed by the producer
+        self._submitted = 0  # Number of frames submitted by the producer
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None
+        state['_claimed'] = -1
+        return state
+
+    def _slot(self, slot):
+        if self._views is None:
+            self._views = [np.frombuffer(arr, dtype=self._dtype, count=self._size) for arr in self._slots]
+        return self._views[slot]
+
+    def _header(self, slot):
+        return np.frombuffer(self._headers, dtype=np.int64)[slot * HEADER_LEN:(slot + 1) * HEADER_LEN]
+
+    def get_capacity(self):
+        return self._dim
+
+    def get_dtype(self):
+        return self._dtype
+
+    def get_nbytes(self):
+        """
+        :return: Total size of the pool's slots in bytes
+        """
+        return self._n * self._size * self._dtype.itemsize
+
+    def get_submitted(self):
+        """
+        :return: The number of frames submitted by this producer
+        """
+        return self._submitted
+
+    # -- Producer ----------------------------------------------------------------------------------------------------
+
+    def claim(self, shape, timeout=None):
+        """
+        Takes a free slot for writing, waiting for the consumer to recycle one if none are free
+        :param shape: Shape of the frame that will be written
+        :param timeout: Seconds to wait for a free slot. Waits indefinitely if None
+        :return: Writable view of the slot with the given shape, or None on timeout
+        """
+        size = int(np.prod(shape))
+        if size > self._size or len(shape) > MAX_NDIM:
+            raise ValueError('Frame of shape ' + str(list(shape)) + ' does not fit in slots of ' + str(list(self._dim)))
+        try:
+            slot = self._free.get(timeout=timeout)
+        except Empty:
             return None
+        header = self._header(slot)
+        header[HEADER_NDIM] = len(shape)
+        header[HEADER_SHAPE:HEADER_SHAPE + len(shape)] = shape
+        self._claimed = slot
+        return self._slot(slot)[:size].reshape(shape)
+
+    def submit(self):
+        """
+        Hands the claimed slot to the consumer
+        :return: The number of the submitted frame
+        """
+        header = self._header(self._claimed)
+        index = self._submitted
+        header[HEADER_INDEX] = index
+        header[HEADER_TIMESTAMP] = time.time_ns()
+        self._ready.put(self._claimed)
+        self._claimed = -1
+        self._submitted += 1
+        return index
 
-    def release(self):
-        print('Process', os.getpid(), 'released buffer', self._acquired.value, flush=True)
-        if self._acquired.value is not -1:
-            self._locks[self._acquired.value].release()
-            self._acquired.value = -1
+    def abort(self):
+        """
+        Returns the claimed slot to the pool without submitting it
+        """
+        if self._claimed != -1:
+            self._free.put(self._claimed)
+            self._claimed = -1
+
+    # -- Consumer ----------------------------------------------------------------------------------------------------
+
+    def get(self, timeout=None):
+        """
+        Takes the oldest submitted frame. The slot stays out of the pool until it is recycled
+        :param timeout: Seconds to wait for a frame. Waits indefinitely if None
+        :return: A read-only view of the frame and its SlotHeader, or None, None on timeout
+        """
+        try:
+            slot = self._ready.get(timeout=timeout)
+        except Empty:
+            return None, None
+        header = self._header(slot)
+        shape = tuple(int(d) for d in header[HEADER_SHAPE:HEADER_SHAPE + header[HEADER_NDIM]])
+        view = self._slot(slot)[:int(np.prod(shape))].reshape(shape)
+        view.flags.writeable = False
+        return view, SlotHeader(int(header[HEADER_INDEX]), header[HEADER_TIMESTAMP] / 1e9, shape, 0, slot)
+
+    def recycle(self, header):
+        """
+        Returns a slot taken with get to the pool. Call only once the frame is no longer needed
+        :param header: SlotHeader returned by get
+        """
+        self._free.put(header.slot)
 
 
 class Producer(mp.Process):
 
-    def __init__(self, exit_event, buffer, timeout):
+    def __init__(self, exit_event, buffer, timeout, shape=(512, 1, 1)):
         super(Producer, self).__init__()
         self._exit_event = exit_event
         self._buffer = buffer
         self._timeout = timeout
+        self._shape = shape
+        self.produced = mp.Value('i', 0)
 
     def run(self):
         print("Producer process started PID", os.getpid())
+        i = 0
         while not self._exit_event.is_set():
-            a = np.arange(512 * 1 * 1).astype(np.float32)
-            self._buffer.put(a)
-            time.sleep(self._timeout)
+            self._buffer.claim(self._shape)[:] = i
+            self._buffer.commit()
+            i += 1
+            if self._timeout > 0:
+                time.sleep(self._timeout)
+        self.produced.value = i
+
+
+class Reader(mp.Process):
+
+    def __init__(self, exit_event, buffer):
+        super(Reader, self).__init__()
+        self._exit_event = exit_event
+        self._buffer = buffer
+        self.read = mp.Value('i', 0)
+        self.torn = mp.Value('i', 0)
+
+    def run(self):
+        last = -1
+        read = 0
+        torn = 0
+        while not self._exit_event.is_set():
+            frame, header = self._buffer.examine()
+            if frame is None or header.index == last:
+                continue
+            np.max(np.abs(frame[:, :, 0]))  # Touch one B-scan, as the display would
+            if self._buffer.release(header):
+                read += 1
+                last = header.index
+            else:
+                torn += 1
+        self.read.value = read
+        self.torn.value = torn
 
 
 if __name__ == "__main__":
 
-    buffer_type = ctypes.c_float
-    circular_buffer = SharedCircularBuffer(1, [512, 1, 1], buffer_type)
+    circular_buffer = SharedCircularBuffer(4, [512, 1, 1], np.complex64)
 
     producer_exit = mp.Event()
-    producer = Producer(producer_exit, circular_buffer, 0.8)
+    producer = Producer(producer_exit, circular_buffer, 0.1)
     producer.start()
 
-    time.sleep(3)  # Wait for the Producer to get going
+    time.sleep(1)  # Wait for the Producer to get going
 
     for i in range(3):
-        a = circular_buffer.examine(i)
-        print(a.astype(np.float32))
-        circular_buffer.release()
-        time.sleep(1)
+        a, h = circular_buffer.examine()
+        print('Examined frame', h.index, 'shape', h.shape, a[0:4].ravel(), 'valid', circular_buffer.release(h))
+        time.sleep(0.5)
 
     producer_exit.set()
+    producer.join()
+
+    # Throughput with 1 to 4 readers of the most recent frame and a producer which never waits
+    volume = (400, 128, 64)
+    duration = 3
+    for n_readers in range(1, 5):
+        buffer = SharedCircularBuffer(8, volume, np.complex64)
+        exit_event = mp.Event()
+        producer = Producer(exit_event, buffer, 0, shape=volume)
+        readers = [Reader(exit_event, buffer) for _ in range(n_readers)]
+        for process in readers + [producer]:
+            process.start()
+        time.sleep(duration)
+        exit_event.set()
+        for process in readers + [producer]:
+            process.join()
+        print('{} reader(s): producer {:.0f} volumes/s, readers'.format(n_readers, producer.produced.value / duration),
+              ', '.join('{:.0f}/s ({} torn)'.format(r.read.value / duration, r.torn.value) for r in readers))
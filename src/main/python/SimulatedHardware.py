@@ -0,0 +1,288 @@
+import time
+
+import numpy as np
+
+from Processing import OCTProcessor
+
+# Default spectrometer band used when no lambda_data is planned (nm)
+DEFAULT_LAMBDA_RANGE = [1250.0, 1370.0]
+N_TEMPLATES = 64  # Number of distinct synthetic A-lines cycled through by the simulated spectrometer
+N_NOISE = 256  # Number of precomputed noise lines
+
+
+class SimulatedScanWriter:
+    """
+    Stands in for nidaqmx.stream_writers.AnalogMultiChannelWriter
+    """
+
+    def __init__(self):
+        self.samples = None
+
+    def write_many_sample(self, data, timeout=10.0):
+        self.samples = np.array(data)
+        return np.shape(self.samples)[-1]
+
+
+class SimulatedScanTask:
+    """
+    Stands in for the nidaqmx.Task which drives the galvos and triggers
+    """
+
+    def __init__(self):
+        self.running = False
+        self.writer = SimulatedScanWriter()
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.running = False
+
+
+class SimulatedIMAQ:
+    """
+    Hardware-free stand-in for the PyIMAQ module. Implements the img* and oct* surface used by NIOCTControlProcess and
+    generates synthetic SD-OCT interferograms of a tilted layered sample at a fixed line rate.
+    """
+
+    def __init__(self, line_rate=76000, seed=0):
+        """
+        :param line_rate: A-line rate in Hz that buffers are released at. If None, buffers are released as fast as they
+        are copied
+        :param seed: Seed for the synthetic speckle and noise
+        """
+        self.line_rate = line_rate
+
+        self._rng = np.random.default_rng(seed)
+        self._open = False
+        self._acquiring = False
+        self._roi = [0, 0, 0, 0]  # x, y, width (A-lines per buffer), height (A-line size)
+        self._number_of_buffers = 0
+        self._t_start = None
+        self._buffers_copied = 0
+        self._lines_copied = 0
+
+        # Processing plan
+        self._lam = None
+        self._processor = None  # OCTProcessor standing in for the native processing
+
+        self._raw = None  # Most recently copied raw buffer, (A-lines per buffer, A-line size)
+        self._dc = None
+
+        self._templates = None  # Raw synthetic A-lines
+        self._processed_templates = None  # Synthetic A-lines after processing
+        self._noise = None  # Complex noise added to the processed A-lines
+        self._raw_noise = None  # Noise added to the raw A-lines
+
+    # -- img ---------------------------------------------------------------------------------------------------------
+
+    def imgOpen(self, device):
+        self._open = True
+        return 0
+
+    def imgClose(self):
+        self._acquiring = False
+        self._open = False
+        return 0
+
+    def imgConfigTrigBufferWithTTL1(self, timeout=1000):
+        return 0
+
+    def imgConfigTrigBufferListWithTTL1(self, timeout=1000):
+        return 0
+
+    def imgSetAttributeROI(self, x, y, width, height):
+        self._roi = [int(x), int(y), int(width), int(height)]
+        return 0
+
+    def imgInitBuffer(self, number_of_buffers):
+        self._number_of_buffers = int(number_of_buffers)
+        self._raw = np.zeros([self._roi[2], self._roi[3]], dtype=np.uint16)
+        self._dc = np.zeros(self._roi[3], dtype=np.float32)
+        return 0
+
+    def imgGetFrameSize(self):
+        return self._roi[2] * self._roi[3]
+
+    def imgStartAcq(self):
+        if not self._open:
+            return -1
+        if self._processed_templates is None:
+            self.octPlan()
+        self._t_start = time.perf_counter()
+        self._buffers_copied = 0
+        self._lines_copied = 0
+        self._acquiring = True
+        return 0
+
+    def imgStopAcq(self):
+        self._acquiring = False
+        return 0
+
+    def imgCopyBuffer(self, index, out):
+        """
+        Waits for the next buffer and copies the raw spectra into out
+        :param index: Index of the buffer to copy
+        :param out: uint16 array with room for (A-lines per buffer) * (A-line size) elements
+        :return: index on success, -1 on failure
+        """
+        if not self._acquiring:
+            return -1
+        self._wait_for_buffer()
+        width = self._roi[2]
+        dst = np.reshape(out, (-1,))[:width * self._roi[3]].reshape(width, self._roi[3])
+        lines = (self._lines_copied + np.arange(width)) % N_TEMPLATES
+        np.take(self._templates, lines, axis=0, out=dst)
+        noise = self._raw_noise[(self._rng.integers(N_NOISE) + np.arange(width)) % N_NOISE]
+        np.add(dst, noise, out=dst, casting='unsafe')
+        self._raw[:] = dst
+        self._dc[:] = np.mean(dst, axis=0)
+        self._buffers_copied += 1
+        self._lines_copied += width
+        return index
+
+    # -- oct ---------------------------------------------------------------------------------------------------------
+
+    def octPlan(self, lam=None, apod=None):
+        aline_size = self._roi[3]
+        self._processor = OCTProcessor(aline_size, lambda_data=lam, apod_window=apod)
+        if lam is not None:
+            self._lam = np.asarray(lam, dtype=np.float64)
+        else:
+            self._lam = np.linspace(DEFAULT_LAMBDA_RANGE[0], DEFAULT_LAMBDA_RANGE[1], aline_size)
+        self._generate_templates()
+        return 0
+
+    def octCopyBuffer(self, index, out):
+        """
+        Waits for the next buffer, processes it and copies the spatial A-lines into out
+        :param index: Index of the buffer to copy
+        :param out: Flat complex64 array with room for at least (A-lines per buffer) * (A-line size / 2 + 1) elements
+        :return: index on success, -1 on failure
+        """
+        if not self._acquiring:
+            return -1
+        self._wait_for_buffer()
+        width = self._roi[2]
+        halfwidth = self._roi[3] // 2 + 1
+        lines = (self._lines_copied + np.arange(width)) % N_TEMPLATES
+        np.take(self._templates, lines, axis=0, out=self._raw)
+        self._dc[:] = np.mean(self._raw, axis=0)
+        dst = out[:width * halfwidth].reshape(width, halfwidth)
+        np.take(self._processed_templates, lines, axis=0, out=dst)
+        dst += self._noise[(self._rng.integers(N_NOISE) + np.arange(width)) % N_NOISE]
+        self._buffers_copied += 1
+        self._lines_copied += width
+        return index
+
+    def octCopyDCSpectrum(self, out=None):
+        """
+        :param out: float32 array to copy the DC spectrum to. Allocated if None
+        """
+        if out is None:
+            return self._dc.copy()
+        np.copyto(out, self._dc)
+        return out
+
+    def octCopySpectrum(self, line, out=None):
+        """
+        :param out: float32 array to copy the DC-subtracted spectrum of the line to. Allocated if None
+        """
+        return np.subtract(self._raw[line], self._dc, out=out, dtype=np.float32)
+
+    # -- Synthetic data ----------------------------------------------------------------------------------------------
+
+    def _wait_for_buffer(self):
+        """
+        Blocks until the next buffer would have been released by a camera running at line_rate
+        """
+        if self.line_rate is None:
+            return
+        t_ready = self._t_start + (self._lines_copied + self._roi[2]) / self.line_rate
+        wait = t_ready - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _generate_templates(self):
+        aline_size = self._roi[3]
+        k = 2 * np.pi / self._lam
+        k_span = abs(k[0] - k[-1])
+        center = np.mean(self._lam)
+        source = np.exp(-((self._lam - center) / (0.3 * np.ptp(self._lam))) ** 2)
+        # A tilted, three-layer sample; surface depth in pixels of the spatial A-line
+        halfwidth = aline_size // 2 + 1
+        surface = halfwidth * (0.15 + 0.1 * np.sin(np.linspace(0, 2 * np.pi, N_TEMPLATES, endpoint=False)))
+        layers = np.array([0, 40, 110])
+        reflectivity = np.array([0.2, 0.08, 0.04])
+        depth = surface[:, None] + layers[None, :]  # (templates, layers)
+        phase = 2 * np.pi * depth[:, :, None] * (k - k[0])[None, None, :] / k_span
+        speckle = self._rng.uniform(0.5, 1.5, size=depth.shape)
+        fringes = np.sum((reflectivity * speckle)[:, :, None] * np.cos(phase), axis=1)
+        raw = 2000 * source[None, :] * (1 + fringes) + 200
+        self._templates = np.clip(raw, 0, 4095).astype(np.uint16)
+        self._processed_templates = self._processor.process(self._templates)
+        noise = self._rng.normal(scale=20 * np.sqrt(aline_size), size=(N_NOISE, halfwidth, 2)).astype(np.float32)
+        self._noise = noise.view(np.complex64)[:, :, 0]
+        self._raw_noise = self._rng.normal(scale=20, size=(N_NOISE, aline_size)).astype(np.int16)
+
+
+class ReplayIMAQ(SimulatedIMAQ):
+    """
+    Stand-in for the PyIMAQ module which streams previously saved raw spectra in place of a camera
+    """
+
+    def __init__(self, path, line_rate=76000, seed=0):
+        """
+        :param path: Path to a .npy file of raw spectra whose last axis is the A-line size
+        :param line_rate: A-line rate in Hz that buffers are released at. If None, buffers are released as fast as they
+        are copied
+        """
+        super(ReplayIMAQ, self).__init__(line_rate=line_rate, seed=seed)
+        self._path = path
+        self._spectra = None
+        self._seek = 0  # Index of the next saved A-line to be streamed
+
+    def imgInitBuffer(self, number_of_buffers):
+        saved = np.load(self._path, mmap_mode='r')
+        if saved.shape[-1] != self._roi[3]:
+            print('ReplayIMAQ:', self._path, 'has A-line size', saved.shape[-1], 'but', self._roi[3], 'was requested')
+            return -1
+        self._spectra = saved.reshape(-1, saved.shape[-1])
+        self._seek = 0
+        return super(ReplayIMAQ, self).imgInitBuffer(number_of_buffers)
+
+    def octCopyBuffer(self, index, out):
+        if not self._acquiring or self._spectra is None:
+            return -1
+        self._wait_for_buffer()
+        width = self._roi[2]
+        halfwidth = self._roi[3] // 2 + 1
+        lines = (self._seek + np.arange(width)) % len(self._spectra)
+        self._raw[:] = self._spectra[lines]
+        self._seek = (self._seek + width) % len(self._spectra)
+        self._processor.process(self._raw, out=out[:width * halfwidth])
+        self._dc[:] = self._processor.dc
+        self._buffers_copied += 1
+        self._lines_copied += width
+        return index
+
+    def imgCopyBuffer(self, index, out):
+        if not self._acquiring or self._spectra is None:
+            return -1
+        self._wait_for_buffer()
+        width = self._roi[2]
+        dst = np.reshape(out, (-1,))[:width * self._roi[3]].reshape(width, self._roi[3])
+        lines = (self._seek + np.arange(width)) % len(self._spectra)
+        dst[:] = self._spectra[lines]
+        self._seek = (self._seek + width) % len(self._spectra)
+        self._raw[:] = dst
+        self._dc[:] = np.mean(dst, axis=0)
+        self._buffers_copied += 1
+        self._lines_copied += width
+        return index
+
+    def _generate_templates(self):
+        self._processed_templates = ()  # Nothing to synthesize; spectra are processed as they are streamed
@@ -7,6 +7,8 @@ from PyQt5 import uic
 from PyQt5.QtCore import QTimer, QRectF
 from PyQt5.QtWidgets import QWidget, QRadioButton, QCheckBox, QSlider, QLabel
 
+from Display import SliceRenderer, PREVIEW_MIP
+
 
 class RunningPlotWidget(pyqtgraph.GraphicsWindow):
     def __init__(self, window_length=512, x=None, miny=-2000, maxy=2000):
@@ -98,18 +100,33 @@ class OCTViewer(pyqtgraph.GraphicsLayoutWidget):
         self._plot.addItem(self.image)
 
         self._sf_undo = [1, 1]
+        self._pixel_size = [1, 1]
+        self._decimation = [1, 1]
 
     def set_aspect(self, dx, dy, nx, ny):
+        self._pixel_size = [dx, dy]
+        self._rescale()
+
+    def set_decimation(self, fx, fy):
+        """
+        :param fx: Pixels of the full resolution image each displayed pixel spans along x
+        :param fy: Pixels of the full resolution image each displayed pixel spans along y
+        """
+        if [fx, fy] != self._decimation:
+            self._decimation = [fx, fy]
+            self._rescale()
+
+    def _rescale(self):
         self.image.scale(1 / self._sf_undo[0], 1 / self._sf_undo[1])  # Undo any previous scaling
-        sfx = dx
-        sfy = dy
+        sfx = self._pixel_size[0] * self._decimation[0]
+        sfy = self._pixel_size[1] * self._decimation[1]
         self.image.scale(sfx, sfy)
         self._sf_undo = [sfx, sfy]
 
-    def setImage(self, img):
+    def setImage(self, img, levels=None):
         dim = np.shape(img)
         self._plot.getAxis('bottom')
-        self.image.setImage(np.rot90(img), opacity=0.9)
+        self.image.setImage(np.rot90(img), opacity=0.9, levels=levels)
 
     def setLevels(self, levels):
         self.image.setLevels(levels)
@@ -184,6 +201,9 @@ class BScanView3D(QWidget):
         self._current_slice = 1  # Index from 1
         self._slice_max = 0
         self.enface_enabled = None
+        self._renderer = SliceRenderer()  # Converts only the slice or projection displayed
+        self._aline_roll = 0
+        self._enface_mip = None
 
         self._dx = 1
         self._dy = 1
@@ -215,30 +235,102 @@ class BScanView3D(QWidget):
         if len(self._frame_shape) > 0:
             self._set_orientation()
 
-    def draw(self, frame):
+    def draw(self, frame, aline_roll=0, enface_mip=None):
+        """
+        :param frame: Volume, (z, A-lines, B-lines). Only the slice or projection displayed is read
+        :param aline_roll: A-lines the displayed image is rolled by, as np.roll
+        :param enface_mip: Axial MIP of frame, (A-lines, B-lines), already computed. Displayed instead of projecting
+        frame in en face MIP mode
+        """
         # print('BScanView: updating display')
         if self._scan_check.isChecked():
             self._slice_thru_advance()
-        self._frame_shape = np.shape(frame)
+        self.set_frame_shape(np.shape(frame))
+        self._aline_roll = aline_roll
+        self._enface_mip = enface_mip
+        self._draw_frame(frame)
+
+    def set_frame_shape(self, shape):
+        """
+        Sets the shape of the volume displayed without drawing it
+        :param shape: (z, A-lines, B-lines)
+        """
+        self._frame_shape = tuple(shape)
         if self.enface_enabled is None:  # First time
             self._set_orientation()
-        self._draw_frame(frame)
+
+    def get_view(self):
+        """
+        :return: If en face, the index of the slice displayed from 0 or Display.PREVIEW_MIP, if in dB, and the most
+        pixels the viewer can display along an axis, as taken by OCTAControlProcess.set_preview
+        """
+        index = PREVIEW_MIP if self._mip_check.isChecked() else self._current_slice - 1
+        return bool(self.enface_enabled), index, self._db_check.isChecked(), max(self.viewer.width(),
+                                                                               self.viewer.height())
+
+    def is_scanning_through(self):
+        """
+        :return: True if B-scans are scanned through one at a time, so that each can be displayed as it is acquired
+        """
+        return self._scan_check.isChecked() and not self.enface_enabled and not self._mip_check.isChecked()
+
+    def draw_bline(self, bscan, bline, aline_roll=0):
+        """
+        Displays a B-scan as soon as it is acquired, moving the slice to it
+        :param bscan: Complex B-scan, (z, A-lines)
+        :param bline: Index of the B-scan in its volume
+        :param aline_roll: A-lines the displayed image is rolled by, as np.roll
+        """
+        if bline < self._slice_max:
+            self._set_slice(bline + 1)
+        self.viewer.set_decimation(1, 1)
+        image = self._renderer.render(bscan, db=self._db_check.isChecked())
+        if aline_roll != 0:
+            image = np.roll(image, aline_roll, axis=1)
+        self.viewer.setImage(image, levels=(0, 255))
+
+    def draw_preview(self, image, frame_shape, aline_roll=0):
+        """
+        Displays a preview rendered by the controller in place of the volume it was rendered from
+        :param image: uint8 slice or MIP, decimated to the size of the viewer
+        :param frame_shape: Shape of the volume, (z, A-lines, B-lines)
+        :param aline_roll: A-lines of the volume the displayed image is rolled by, as np.roll
+        """
+        if self._scan_check.isChecked():
+            self._slice_thru_advance()
+        self.set_frame_shape(frame_shape)
+        full = self._frame_shape[1:] if self.enface_enabled else self._frame_shape[:2]
+        fy, fx = full[0] / np.shape(image)[0], full[1] / np.shape(image)[1]  # np.rot90 puts axis 1 along x
+        self.viewer.set_decimation(fx, fy)
+        if aline_roll != 0:
+            aline_axis = 0 if self.enface_enabled else 1
+            image = np.roll(image, int(round(aline_roll * np.shape(image)[aline_axis] / full[aline_axis])),
+                            axis=aline_axis)
+        self.viewer.setImage(image, levels=(0, 255))
 
     def _draw_frame(self, frame):
-        frame = np.abs(np.real(frame))  # TODO make abs vs real vs imag etc parameters
+        self.viewer.set_decimation(1, 1)
+        # The slice or MIP is taken first so that only displayed pixels are converted
+        # TODO make abs vs real vs imag etc parameters
         try:
-            if self._db_check.isChecked():
-                frame = 20 * np.log10(frame)
             if self.enface_enabled:  # Enface mode
-                if self._mip_check.isChecked():  # MIP
-                    self.viewer.setImage(np.max(frame, axis=0))  # Axial MIP
+                if self._mip_check.isChecked() and self._enface_mip is not None:
+                    image = self._enface_mip
+                elif self._mip_check.isChecked():  # MIP
+                    image = self._renderer.project(frame, 0)  # Axial MIP
                 else:
-                    self.viewer.setImage(frame[self._current_slice - 1, :, :])  # Slice is indexed from 1
+                    image = frame[self._current_slice - 1, :, :]  # Slice is indexed from 1
+                aline_axis = 0
             else:  # B-scan mode
                 if self._mip_check.isChecked():  # MIP
-                    self.viewer.setImage(np.max(frame, axis=2))  # MIP across slow axis
+                    image = self._renderer.project(frame, 2)  # MIP across slow axis
                 else:
-                    self.viewer.setImage(frame[:, :, self._current_slice - 1])
+                    image = frame[:, :, self._current_slice - 1]
+                aline_axis = 1
+            image = self._renderer.render(image, db=self._db_check.isChecked())
+            if self._aline_roll != 0:
+                image = np.roll(image, self._aline_roll, axis=aline_axis)
+            self.viewer.setImage(image, levels=(0, 255))
             return 0
         except IndexError:  # Occurs when a new frame has been added with different dimensions
             return -1
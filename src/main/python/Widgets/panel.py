@@ -7,6 +7,10 @@ from PyQt5.QtCore import pyqtSignal, pyqtSlot
 from PyQt5.QtWidgets import QGroupBox, QLineEdit, QComboBox, QToolButton, QFileDialog, QSpinBox, QDoubleSpinBox, \
     QCheckBox, QPushButton, QLabel
 
+from Angiography import METRICS
+from Container import CONTAINER_TYPE
+from NpyWriterProcess import ENCODINGS
+
 RATES = {
     "76 kHz": 76000,
     "146 kHz": 146000
@@ -438,8 +442,13 @@ class SpectralRadarConfigPanel(QGroupBox):
         return str(self._apod_combo.text())
 
 
+ANGIOGRAPHY_METRICS = [None] + METRICS  # In the order of comboAngiography. None computes no angiogram
+
+
 class RepeatsPanel(QGroupBox):
 
+    changedRepeats = pyqtSignal()
+
     def __init__(self):
         super(QGroupBox, self).__init__()
         ui = os.path.dirname(
@@ -449,29 +458,43 @@ class RepeatsPanel(QGroupBox):
         self._a_repeat_spin = self.findChild(QSpinBox, "spinARepeat")
         self._b_repeat_spin = self.findChild(QSpinBox, "spinBRepeat")
         self._avg_check = self.findChild(QCheckBox, "checkAveraging")
+        self._angiography_combo = self.findChild(QComboBox, "comboAngiography")
+
+        self.toggled.connect(self.changedRepeats.emit)
+        self._a_repeat_spin.valueChanged.connect(self.changedRepeats.emit)
+        self._b_repeat_spin.valueChanged.connect(self.changedRepeats.emit)
+        self._avg_check.toggled.connect(self.changedRepeats.emit)
+        self._angiography_combo.currentIndexChanged.connect(self.changedRepeats.emit)
 
     def get_a_repeat(self):
-        if self.isEnabled():
+        if self.isEnabled() and self.isChecked():
             return self._a_repeat_spin.value()
         else:
             return 1
 
     def get_b_repeat(self):
-        if self.isEnabled():
+        if self.isEnabled() and self.isChecked():
             return self._b_repeat_spin.value()
         else:
             return 1
 
     def get_averaging(self):
-        if self.isEnabled():
-            return self._avg_check.checked()
+        if self.isEnabled() and self.isChecked():
+            return self._avg_check.isChecked()
         else:
             return False
 
+    def get_angiography(self):
+        if self.isEnabled() and self.isChecked():
+            return ANGIOGRAPHY_METRICS[self._angiography_combo.currentIndex()]
+        else:
+            return None
+
 
 FILETYPES = [
     ".npy",
-    ".mat"
+    ".mat",
+    CONTAINER_TYPE  # Chunked, indexed container
 ]
 
 FILESIZES = [
@@ -490,6 +513,8 @@ BYTES = [
     3 * 10**9
 ]
 
+SAMPLE_FORMATS = ENCODINGS  # Encodings understood by NpyWriterProcess, in the order of comboSampleFormat
+
 
 class FilePanel(QGroupBox):
 
@@ -504,6 +529,7 @@ class FilePanel(QGroupBox):
         self._trial_name_line = self.findChild(QLineEdit, "lineFileName")
         self._file_type_combo = self.findChild(QComboBox, "comboFileType")
         self._file_size_combo = self.findChild(QComboBox, "comboFileSize")
+        self._sample_format_combo = self.findChild(QComboBox, "comboSampleFormat")
 
         self._file_browse_button = self.findChild(QToolButton, "buttonBrowse")
         self._file_browse_button.clicked.connect(self.browse_for_file)
@@ -528,9 +554,18 @@ class FilePanel(QGroupBox):
     # Getters
 
     def get_experiment_directory(self):
-        if not os.path.isdir(self._exp_dir_line.text()):
-            os.mkdir(self._exp_dir_line.text())
-        return self._exp_dir_line.text()
+        return self.get_experiment_directories()[0]
+
+    def get_experiment_directories(self):
+        """
+        Returns list of experiment directories. Several directories, e.g. one per disk, may be separated by ';', in
+        which case recordings are striped across them
+        """
+        directories = [d.strip() for d in self._exp_dir_line.text().split(';') if len(d.strip()) > 0]
+        for directory in directories:
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+        return directories
 
     def get_trial_name(self):
         return self._trial_name_line.text()
@@ -543,3 +578,6 @@ class FilePanel(QGroupBox):
 
     def get_file_size_bytes(self):
         return int(BYTES[self._file_size_combo.currentIndex()])
+
+    def get_sample_format(self):
+        return SAMPLE_FORMATS[self._sample_format_combo.currentIndex()]
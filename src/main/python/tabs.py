@@ -1,16 +1,21 @@
 import multiprocessing as mp
+import os
 import time
 
 import matplotlib
 import numpy as np
 from PyQt5.QtCore import QTimer, Qt
 from PyQt5.QtWidgets import QWidget, QGridLayout, QProgressDialog
-from PyQt5.QtWidgets import QApplication
 
 from Control import INSTR_OPEN, INSTR_START_ACQ, INSTR_UPDATE_ACQ, INSTR_STOP_ACQ, INSTR_CLOSE, INSTR_BEGIN_SAVE,\
     INSTR_END_SAVE
+from Control import CLOSE_TIMEOUT_SEC
 from Control import OCTAControlProcess, OCTAMessage
 from Control import STATUS_READY, STATUS_ACQUIRING, STATUS_NOT_READY
+from Control import BACKEND_NI
+from Averaging import AVERAGING_MAGNITUDE
+from Projection import PROJECTION_MAX
+from Display import PREVIEW_MIP
 from PyScanPattern.Patterns import RasterScanPattern
 from Widgets.graph import BScanView3D, SpectrumView
 from Widgets.panel import FilePanel, RepeatsPanel, ProcessingConfigPanel, ControlPanel, \
@@ -22,6 +27,27 @@ matplotlib.use('Qt5Agg')
 ALINE_SIZE = 2048
 HALFWIDTH = int(ALINE_SIZE / 2 + 1)
 
+# Acquisition backend: BACKEND_NI for the rig, or BACKEND_SIMULATED/BACKEND_REPLAY to run without hardware
+BACKEND = os.environ.get("PYIMAGEOCT_BACKEND", BACKEND_NI)
+REPLAY_PATH = os.environ.get("PYIMAGEOCT_REPLAY_PATH")  # .npy of raw spectra for BACKEND_REPLAY
+LINE_RATE = float(os.environ.get("PYIMAGEOCT_LINE_RATE", 76000))  # A-line rate of the hardware-free backends
+# Grab, crop and publish volumes on three overlapping threads of the controller. Set to 0 to run them in turn
+PIPELINED = os.environ.get("PYIMAGEOCT_PIPELINED", "1") != "0"
+
+# Processes which process raw B-lines in Python when the backend provides them. 0 leaves processing to the IMAQ interface
+PROCESSING_WORKERS = int(os.environ.get("PYIMAGEOCT_PROCESSING_WORKERS", 0))
+
+# lambda to k resampling, one of Processing.METHODS. Unset, the spectra are processed as linear in k, as on the rig
+RESAMPLING_METHOD = os.environ.get("PYIMAGEOCT_RESAMPLING")
+
+# How repeats are averaged when averaging is checked, one of Averaging.AVERAGING_MODES
+AVERAGING_MODE = AVERAGING_MAGNITUDE
+
+PREALLOCATE_FILES = True  # Allocate each file at full size and write volumes into a memory map
+
+DISPLAY_RATE = 30  # Frames per second the frame server tries to display
+MAX_POLL_INTERVAL_MS = 100  # Longest interval the frame server backs off to while no new frames arrive
+
 _frame_server_timer = QTimer()
 
 
@@ -49,6 +75,7 @@ class TabOCTA(QWidget):
         self._layout.addWidget(self._scanPanel)
 
         self._repeatsPanel = RepeatsPanel()
+        self._repeatsPanel.changedRepeats.connect(self._set_restart_required)
         self._layout.addWidget(self._repeatsPanel)
 
         self._controlPanel = ControlPanel()
@@ -63,8 +90,7 @@ class TabOCTA(QWidget):
 
         self._spectrumView = SpectrumView()
         self._layout.addWidget(self._spectrumView, 3, 1, 2, 1)
-        chirp = np.linspace(self._configPanel.get_lambda_range()[0], self._configPanel.get_lambda_range()[1], ALINE_SIZE)
-        self._spectrumView.viewer.set_chirp(chirp)
+        self._spectrumView.viewer.set_chirp(self._get_lambda_data())
 
         self.setLayout(self._layout)
 
@@ -78,15 +104,30 @@ class TabOCTA(QWidget):
         self._controller = None
 
         self._restart_required = False
+        self._poll_interval = 1000 / DISPLAY_RATE  # Current interval of the frame server in ms
+        self._shown_skipped = 0  # Skipped frame count last shown in the status bar
+        self._preview_view = None  # View last selected for the controller's previews
 
         self._pattern = RasterScanPattern()
         self._update_scan_pattern()
 
     def _update_scan_pattern(self):
         print("Scan pattern dim", self._scanPanel.get_dim())
+        repeats = {}  # Repeats are acquired consecutively: each A-line a_repeat times, then each B-line b_repeat times
+        if self._repeatsPanel.get_a_repeat() > 1:
+            repeats['aline_repeat'] = self._repeatsPanel.get_a_repeat()
+        if self._repeatsPanel.get_b_repeat() > 1:
+            repeats['bline_repeat'] = self._repeatsPanel.get_b_repeat()
         self._pattern.generate(alines=self._scanPanel.get_dim()[0],
                                blines=self._scanPanel.get_dim()[1],
-                               fov=self._scanPanel.get_fov())
+                               fov=self._scanPanel.get_fov(), **repeats)
+
+    def _get_acq_dim(self):
+        """
+        :return: A-lines per B-line and B-lines per volume as acquired, including repeats
+        """
+        return [self._scanPanel.get_dim()[0] * self._repeatsPanel.get_a_repeat(),
+                self._scanPanel.get_dim()[1] * self._repeatsPanel.get_b_repeat()]
 
     def _start_scan(self):
         if self._restart_required:
@@ -112,8 +153,12 @@ class TabOCTA(QWidget):
 
     def _start_save(self):
         msg = OCTAMessage(INSTR_BEGIN_SAVE)
-        msg.writer.fpath = self._filePanel.get_experiment_directory() + '/' + self._filePanel.get_trial_name()
+        msg.writer.fpath = [directory + '/' + self._filePanel.get_trial_name()
+                            for directory in self._filePanel.get_experiment_directories()]
         msg.writer.max_bytes = self._filePanel.get_file_size_bytes()
+        msg.writer.preallocate = PREALLOCATE_FILES
+        msg.writer.encoding = self._filePanel.get_sample_format()
+        msg.writer.type = self._filePanel.get_file_type()
 
         self._controller.send_msg(msg)
 
@@ -139,6 +184,9 @@ class TabOCTA(QWidget):
         msg.niconfig.y_ch = 'ao2'
         msg.niconfig.number_of_imaq_buffers = NUMBER_OF_IMAQ_BUFFERS
         msg.niconfig.dac_rate = self._pattern.get_sample_rate()
+        msg.niconfig.backend = BACKEND
+        msg.niconfig.line_rate = LINE_RATE
+        msg.niconfig.replay_path = REPLAY_PATH
 
         msg.scansig.line_trig_sig = self._pattern.get_line_trig() * TRIGGER_GAIN
         msg.scansig.frame_trig_sig = self._pattern.get_frame_trig() * TRIGGER_GAIN
@@ -150,45 +198,65 @@ class TabOCTA(QWidget):
         msg.scansig.y_sig = y
 
         msg.oct.aline_size = ALINE_SIZE
-        msg.oct.alines_per_buffer = self._scanPanel.get_dim()[0] * self._scanPanel.get_dim()[1]
-        msg.oct.alines_per_bline = self._scanPanel.get_dim()[0]
-        msg.oct.number_of_blines = self._scanPanel.get_dim()[1]
+        msg.oct.alines_per_buffer = self._get_acq_dim()[0] * self._get_acq_dim()[1]
+        msg.oct.alines_per_bline = self._get_acq_dim()[0]
+        msg.oct.number_of_blines = self._get_acq_dim()[1]
+        msg.oct.a_repeat = self._repeatsPanel.get_a_repeat()
+        msg.oct.b_repeat = self._repeatsPanel.get_b_repeat()
+        msg.oct.angiography = self._repeatsPanel.get_angiography()
+        msg.oct.averaging = AVERAGING_MODE if self._repeatsPanel.get_averaging() else None
         msg.oct.ztop = self._scanPanel.get_z_roi()[0]
         msg.oct.zbottom = self._scanPanel.get_z_roi()[1]
+        msg.oct.slabs = [[msg.oct.ztop, msg.oct.zbottom]]  # The whole crop, projected while the en face MIP is shown
         msg.oct.apod_window = np.hanning(ALINE_SIZE).astype(np.float32)  # TODO get from config
+        msg.oct.lambda_range = self._configPanel.get_lambda_range()  # Resampled by the controller with its cached table
+        msg.oct.resampling = RESAMPLING_METHOD
         # msg.oct.apod_window = None
 
         msg.writer.fpath = self._filePanel.get_experiment_directory() + self._filePanel.get_trial_name()
         msg.writer.max_bytes = self._filePanel.get_file_size_bytes()
 
-        chirp = np.linspace(self._configPanel.get_lambda_range()[0], self._configPanel.get_lambda_range()[1], ALINE_SIZE)
-        self._spectrumView.viewer.set_chirp(chirp)
+        self._spectrumView.viewer.set_chirp(self._get_lambda_data())
         self.rescale_plots()
 
         # Save the dimensions last sent to controller
-        self._acq_dim = self._scanPanel.get_dim()
+        self._acq_dim = self._get_acq_dim()
 
         self._controller.send_msg(msg)
 
+    def _get_lambda_data(self):
+        """
+        :return: Wavelength of each spectrometer pixel of the calibration set in the GUI
+        """
+        lambda_range = self._configPanel.get_lambda_range()
+        return np.linspace(lambda_range[0], lambda_range[1], ALINE_SIZE)
+
     def _start_controller(self):
 
         self._parent.show_status("Initializing hardware interface...")
 
         self._controller_exit = mp.Event()
-        self._controller = OCTAControlProcess(self._controller_exit)
+        # Changing the repeats restarts the controller, so room for angiograms is only made if they are computed. The
+        # en face MIP is the one slab _program_controller configures
+        self._controller = OCTAControlProcess(self._controller_exit, ALINE_SIZE, *self._get_acq_dim(),
+                                              processing_workers=PROCESSING_WORKERS, pipelined=PIPELINED,
+                                              angiography=self._repeatsPanel.get_angiography() is not None,
+                                              max_slabs=1)
         self._controller.start()
 
         # Program with initial conditions
         self._program_controller(INSTR_OPEN)
 
         # Start the server thread
-        _frame_server_timer.start(int(1 / 60))
+        self._poll_interval = 1000 / DISPLAY_RATE
+        self._preview_view = None
+        _frame_server_timer.start(int(self._poll_interval))
 
     def _close_controller(self):
 
         self._controller.send_msg(OCTAMessage(INSTR_CLOSE))
         self._controller_exit.set()
-        self._controller.join(timeout=2)  # Wait 2 seconds for the process to clean itself up
+        self._controller.join(timeout=CLOSE_TIMEOUT_SEC)  # Wait for the process to clean itself up and finish its files
         if self._controller.is_alive():  # If it's stuck, terminate it
             self._controller.terminate()
             print(type(self).__name__ + ': controller terminated!')
@@ -220,42 +288,105 @@ class TabOCTA(QWidget):
 
     def _frame_server(self):
         """
-        Displays buffered frames and keeps controller up to date with parameters
-        from GUI
+        Displays the latest frame at up to DISPLAY_RATE, backing off while there is nothing new, and keeps the GUI up
+        to date with the controller's status. Panels are only updated when the status changes
         """
+        if self._controller.status_changed.is_set():
+            self._controller.status_changed.clear()  # Before reading, so that a change during the update is not lost
+            self._update_gui_status()
+
         if self._controller.status.value is STATUS_ACQUIRING:
 
-            f = self._controller.grab_frame()
+            # Scanning through B-scans, each is displayed as soon as it is acquired rather than with its volume, unless
+            # the controller cannot publish them as they are acquired
+            streaming = self._bscanView.is_scanning_through() and self._controller.bline_supported.value == 1
+            if streaming != bool(self._controller.bline_streaming.value):
+                self._controller.bline_streaming.value = int(streaming)
+
+            view = self._bscanView.get_view()
+            if streaming:
+                view = view[:3] + (0,)  # No previews
+            if view != self._preview_view:  # The controller previews what is displayed, so the volume need not be read
+                self._controller.set_preview(*view)
+                self._preview_view = view
+
+            projecting = view[0] and view[1] == PREVIEW_MIP  # Only the en face MIP displays the projections
+            if projecting != bool(self._controller.projecting.value):
+                self._controller.set_projection(projecting)
+
+            if streaming:
+                b = self._controller.grab_bline(timeout=0)
+                if b is not None:
+                    self._bscanView.draw_bline(b.rr, b.bline, aline_roll=-2)
+                    self._controller.release_bline()
+                    self._poll_interval = 1000 / DISPLAY_RATE
+
+            f = self._controller.grab_frame(timeout=0, latest=True)  # Never blocks; None if nothing new
 
             if f is not None:
-                self._bscanView.draw(np.roll(f.rr, -2, axis=1))
-                if self._spectrumView.get_dc():
+                roll = 0 if f.angio is not None else -2
+                if streaming:  # B-scans have been displayed as they were acquired
+                    self._bscanView.set_frame_shape(np.shape(f.rr))
+                elif f.preview is not None and bool(f.preview_view[0]) == view[0]:  # Preview of the current orientation
+                    self._bscanView.draw_preview(f.preview, np.shape(f.angio if f.angio is not None else f.rr), roll)
+                elif f.preview is not None:
+                    pass  # Orientation was changed after the frame was previewed; the next frame will show it
+                elif f.angio is not None:  # Angiography is on
+                    self._bscanView.draw(f.angio)
+                elif f.proj is not None:  # En face MIP projected by the controller
+                    self._bscanView.draw(f.rr, aline_roll=-2, enface_mip=f.proj[0, PROJECTION_MAX])
+                else:
+                    self._bscanView.draw(f.rr, aline_roll=-2)
+                if f.spec is None:  # Spectrum slot was busy
+                    pass
+                elif self._spectrumView.get_dc():
                     self._spectrumView.draw(f.spec)
                 else:
                     self._spectrumView.draw(f.dc)
-            else:
-                self._stop_scan()
-                print("Grab failed. Stopping scan")
+                self._controller.release_frame()
+                self._poll_interval = 1000 / DISPLAY_RATE
+            elif not streaming or b is None:
+                self._poll_interval = min(2 * self._poll_interval, MAX_POLL_INTERVAL_MS)
+
+            if self._controller.skipped_frames.value != self._shown_skipped:
+                self._update_gui_status()
+        else:
+            self._poll_interval = MAX_POLL_INTERVAL_MS
 
+        if _frame_server_timer.interval() != int(self._poll_interval):
+            _frame_server_timer.setInterval(int(self._poll_interval))
+
+    def _update_gui_status(self):
+        """
+        Sets the panels and status bar from the controller's status
+        """
+        if self._controller.status.value is STATUS_ACQUIRING:
             self._set_gui_scanning()
+            self._shown_skipped = self._controller.skipped_frames.value
             if self._controller.saving.value is 1:  # If saving
                 self._controlPanel.set_acquiring()
                 self._filePanel.setEnabled(False)
-                self._parent.show_status("Acquiring data to "+str(self._filePanel.get_experiment_directory()), timeout=300)
+                self._parent.show_status("Acquiring data to "+str(self._filePanel.get_experiment_directory()), timeout=0)
             else:  # If not saving
                 self._controlPanel.set_scanning()
                 self._filePanel.setEnabled(True)
-                self._parent.show_status("Scanning...", timeout=300)
+                if self._shown_skipped > 0:
+                    self._parent.show_status("Scanning... " + str(self._shown_skipped) + " frames not displayed",
+                                             timeout=0)
+                else:
+                    self._parent.show_status("Scanning...", timeout=0)
 
         elif self._controller.status.value is STATUS_READY:
-            self._parent.show_status("Ready to scan", timeout=300)
+            self._parent.show_status("Ready to scan", timeout=0)
             self._set_gui_ready()
 
         elif self._controller.status.value is STATUS_NOT_READY:
-            self._parent.show_status("Please wait...", timeout=300)
+            self._parent.show_status("Please wait...", timeout=0)
             self._set_gui_not_ready()
 
-        QApplication.processEvents()
+        error = self._controller.take_error()
+        if error is not None:  # Shown in place of the status until it next changes
+            self._parent.show_status("Error: " + error, timeout=0)
 
     def rescale_plots(self):
         dxdy = np.array(self._scanPanel.get_fov()) / np.array(self._scanPanel.get_dim()) * 10**-3  # in meters